@@ -3,7 +3,7 @@
 Scripts to consume amqp messages generated by donkey car.
 
 Usage:
-car_consumer.py (-u USERID | --userid=USERID) --password=PASSWORD --hostname=HOSTNAME --path_root=TUB_PATH_ROOT [--topic=TOPIC]
+car_consumer.py (-u USERID | --userid=USERID) --password=PASSWORD --hostname=HOSTNAME --path_root=TUB_PATH_ROOT [--topic=TOPIC] [--workers=WORKERS]
 
 Options:
 -h --help                                       Show this screen.
@@ -12,24 +12,30 @@ Options:
 -H HOSTNAME --hostname=HOSTNAME                 Server host
 -p TUB_PATH_ROOT --path_root=TUB_PATH_ROOT  Path where to write messages
 -t TOPIC --topic=TOPIC                          Topic name [default: fous_du_volant]
+-w WORKERS --workers=WORKERS                    Number of threads decoding messages [default: 4]
 
 """
 import base64
 import json
 import logging
-import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from os import path
-from pathlib import Path
+from queue import Queue
+from threading import Event, Lock, Thread
 
 import paho.mqtt.client as mqtt
 from docopt import docopt
 
+from donkeycar import wire
+from donkeycar.parts.datastore import TubStore
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def run_consumer(hostname, topic, userid, password, tub_path_root):
-    consumer = Consumer(tub_path_root=tub_path_root)
+def run_consumer(hostname, topic, userid, password, tub_path_root, workers=4):
+    consumer = Consumer(tub_path_root=tub_path_root, workers=workers)
 
     def on_connect(client, userdata, flags, rc):
         logger.info("Connected with result code %s", rc)
@@ -45,49 +51,215 @@ def run_consumer(hostname, topic, userid, password, tub_path_root):
     mqtt_client.connect(host=hostname)
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
-    mqtt_client.loop_forever()
+    try:
+        mqtt_client.loop_forever()
+    finally:
+        consumer.shutdown()
 
 
 class Consumer:
+    """
+    Write the messages received from the cars into tubs, in the append-only format of `TubStore`.
+
+    The mqtt callback only queues messages: they are decoded on a pool of `workers` threads and appended to the tubs
+    in batches by a writer thread. At most `max_pending_bytes` of received messages wait for decoding or writing,
+    beyond that messages are dropped and counted in `dropped`: the callback runs on the network thread of the mqtt
+    client, blocking it would stop keepalives. Ingest rate and lag are logged every `report_interval` seconds.
+    """
 
-    def __init__(self, tub_path_root):
+    def __init__(self, tub_path_root, workers=4, max_pending_bytes=64 * 1024 * 1024, batch_size=64,
+                 report_interval=10.0):
         self._tub_path_root = tub_path_root
+        self._stores = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._max_pending_bytes = max_pending_bytes
+        self._pending_bytes = 0
+        self._writes = Queue()
+        self._batch_size = batch_size
+        self._report_interval = report_interval
+        self._stats_lock = Lock()
+        self._received = 0
+        self._received_bytes = 0
+        self._decoding = 0
+        self._written = 0
+        self._lag = 0.0
+        self.dropped = 0
+        self._dropped_since_report = 0
+        self._last_report = time.monotonic()
+        self._stopped = Event()
+        self._writer = Thread(target=self._write_loop, name='tub-writer', daemon=True)
+        self._writer.start()
+        self._reporter = Thread(target=self._report_loop, name='ingest-report', daemon=True)
+        self._reporter.start()
 
     def run(self, message: mqtt.MQTTMessage):
-        msg = json.loads(message.payload.decode('utf-8'), encoding='utf8')
-        logger.debug('Received a message: %s', msg['application_headers'])
+        size = len(message.payload)
+        with self._stats_lock:
+            if self._pending_bytes + size > self._max_pending_bytes:
+                self.dropped += 1
+                self._dropped_since_report += 1
+                # once per report, the report gives the count
+                if self._dropped_since_report == 1:
+                    logger.warning('Drop message on %s, %s bytes waiting for decoding or writing', message.topic,
+                                   self._pending_bytes)
+                return
+            self._pending_bytes += size
+            self._received += 1
+            self._received_bytes += size
+            self._decoding += 1
+        self._executor.submit(self._process, message.payload, time.monotonic())
 
-        tub_path = self._mkdir_tub(msg['application_headers'])
-        if msg['content_type'] == 'application/json':
-            part = 'record'
-        else:
-            part = msg['application_headers']['part']
+    def shutdown(self):
+        """
+        Write all received messages and stop workers.
+        """
+        self._executor.shutdown(wait=True)
+        self._writes.put(None)
+        self._writer.join()
+        self._stopped.set()
+        self._reporter.join()
 
-        file_ext = msg['application_headers']['name'].split('.')[-1]
-        file_name = '{0}/{1}_{2}.{3}'.format(tub_path,
-                                             part,
-                                             '{:09d}'.format(msg['application_headers']['index']),
-                                             file_ext)
-        print(str(msg['application_headers']['index']) + '                  ', end='\r')
+    def _process(self, payload: bytes, received_at: float):
+        writes = []
+        try:
+            msg = self._decode(payload)
+            messages = msg['payload'] if msg['content_type'] == wire.CONTENT_TYPE_BATCH else [msg]
+            writes = [self._write_of(m) for m in messages]
+        except Exception:
+            logger.exception('Unable to process message')
+        finally:
+            with self._stats_lock:
+                self._decoding -= 1
+                if not writes:
+                    self._pending_bytes -= len(payload)
+        # bytes of the message are released once its last record or image is written
+        for i, write in enumerate(writes):
+            size = len(payload) if i == len(writes) - 1 else 0
+            self._writes.put(write + (size, received_at))
 
-        self._write_content(file_name, msg)
+    def _write_of(self, msg: dict) -> tuple:
+        logger.debug('Received a message: %s', msg['application_headers'])
+        return (msg['application_headers']['tub_name'], msg['content_type'],
+                msg['application_headers'].get('part'), msg['application_headers']['index'],
+                self._content(msg))
 
     @staticmethod
-    def _write_content(file_name: str, msg: dict):
-        Path(file_name).parent.mkdir(parents=True, exist_ok=True)
+    def _decode(payload: bytes) -> dict:
+        """
+        Decode a message published either in the json or in the binary wire format.
+        """
+        if wire.is_binary(payload):
+            return wire.decode(payload)
+        return json.loads(payload.decode('utf-8'))
+
+    @staticmethod
+    def _content(msg: dict):
+        content = msg['payload']
         if msg['content_type'] == "application/json":
-            logger.debug('Content: %s', msg['payload'])
-            with open(file_name, encoding='utf-8', mode='wt') as json_file:
-                json_file.write(json.dumps(msg['payload']))
+            logger.debug('Content: %s', content)
+            return content
+
+        if isinstance(content, str):
+            content = base64.standard_b64decode(content)
+        return content
+
+    def _write_loop(self):
+        running = True
+        while running:
+            batch = [self._writes.get()]
+            while len(batch) < self._batch_size and not self._writes.empty():
+                batch.append(self._writes.get_nowait())
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+            if not batch:
+                continue
+            try:
+                self._write_batch(batch)
+            except Exception:
+                # keep the writer alive, the next batches may go to other tubs
+                logger.exception('Unable to write %s records and images', len(batch))
+            finally:
+                with self._stats_lock:
+                    self._pending_bytes -= sum(item[5] for item in batch)
+        for store in self._stores.values():
+            store.close()
+
+    def _write_batch(self, batch):
+        """
+        Append records and images to the store of their tub: received tubs are readable by `Tub` without scanning
+        a directory of files.
+        """
+        stores = set()
+        for tub_name, content_type, part, index, content, _, _ in batch:
+            store = self._store(tub_name)
+            if content_type == 'application/json':
+                self._update_meta(store, content)
+                store.append_record(index, content)
+            else:
+                store.append_image(index, part, content)
+            stores.add(store)
+        for store in stores:
+            store.flush()
+        with self._stats_lock:
+            self._written += len(batch)
+            self._lag = time.monotonic() - batch[-1][-1]
+
+    @staticmethod
+    def _update_meta(store: TubStore, record: dict):
+        inputs = store.meta['inputs']
+        if all(key in inputs for key in record):
+            return
+        types = store.meta['types']
+        for key, value in record.items():
+            if key not in inputs:
+                inputs.append(key)
+                types.append(_record_type(key, value, store.meta['image_keys']))
+        store.write_meta(inputs, types)
+
+    def _report_loop(self):
+        while not self._stopped.wait(self._report_interval):
+            self._report()
+
+    def _report(self):
+        now = time.monotonic()
+        elapsed = now - self._last_report
+        with self._stats_lock:
+            logger.log(logging.WARNING if self._dropped_since_report else logging.INFO,
+                       'Ingest: %.1f msg/s, %.1f kB/s, %s records and images written, %s messages to decode, '
+                       '%s to write, %s kB pending, lag %.0f ms, %s dropped',
+                       self._received / elapsed, self._received_bytes / elapsed / 1000, self._written,
+                       self._decoding, self._writes.qsize(), self._pending_bytes // 1000, self._lag * 1000,
+                       self.dropped)
+            self._dropped_since_report = 0
+            self._received = 0
+            self._received_bytes = 0
+            self._written = 0
+        self._last_report = now
+
+    def _store(self, tub_name) -> TubStore:
+        store = self._stores.get(tub_name)
+        if store is None:
+            store = TubStore(path.join(self._tub_path_root, tub_name))
+            self._stores[tub_name] = store
+        return store
 
-        if msg['content_type'] == "image/jpeg":
-            with open(file_name, mode='wb') as image_file:
-                image_file.write(base64.standard_b64decode(msg['payload']))
 
-    def _mkdir_tub(self, application_headers):
-        tub_path = path.join(self._tub_path_root, application_headers['tub_name'])
-        os.makedirs(tub_path, exist_ok=True)
-        return tub_path
+def _record_type(key, value, image_keys) -> str:
+    """
+    Guess the tub type of a record value published by a car.
+    """
+    if key in image_keys or (isinstance(value, str) and value.endswith('.jpg')):
+        return 'image_array'
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, str):
+        return 'str'
+    return 'list'
 
 
 if __name__ == '__main__':
@@ -96,5 +268,6 @@ if __name__ == '__main__':
                  topic=args['--topic'],
                  userid=args['--userid'],
                  password=args['--password'],
-                 tub_path_root=args['--path_root']
+                 tub_path_root=args['--path_root'],
+                 workers=int(args['--workers'])
                  )
@@ -0,0 +1,93 @@
+"""
+benchmark.py
+
+Measure the time spent by the Vehicle drive loop itself, outside of the parts work, compared to the loop of
+previous versions that looked up part entries and memory keys on every tick.
+
+Usage:
+    python -m donkeycar.benchmark
+"""
+import time
+
+from donkeycar.memory import Memory, SlotMemory
+from donkeycar.parts.transform import Lambda
+from donkeycar.vehicle import Vehicle
+
+
+def _source():
+    return 0, True
+
+
+def _noop(*args):
+    return 0
+
+
+def _bench_vehicle(nb_parts, mem: Memory = None) -> Vehicle:
+    vehicle = Vehicle(mem=mem)
+    vehicle.register(Lambda(_source, outputs=['bench/0', 'bench/enabled']))
+    for i in range(1, nb_parts):
+        vehicle.register(Lambda(_noop, inputs=['bench/{}'.format(i - 1), 'bench/enabled'],
+                                outputs=['bench/{}'.format(i)]),
+                         run_condition='bench/enabled' if i % 3 == 0 else None)
+    return vehicle
+
+
+def baseline_update_parts(vehicle: Vehicle):
+    """
+    Drive loop tick as run before parts were compiled into a plan.
+    """
+    for entry in vehicle.parts:
+        # don't run if there is a run condition that is False
+        run = True
+        if entry.get('run_condition'):
+            run_condition = entry.get('run_condition')
+            run = vehicle.mem.get([run_condition])[0]
+
+        if run:
+            p = entry['part']
+            # get inputs from memory
+            inputs = vehicle.mem.get(entry['inputs'])
+
+            # run the part
+            if entry.get('thread'):
+                outputs = p.run_threaded(*inputs)
+            else:
+                outputs = p.run(*inputs)
+
+            # save the output to memory
+            if outputs is not None:
+                vehicle.mem.put(entry['outputs'], outputs)
+
+
+def _best_tick(update, ticks, repeat) -> float:
+    # First tick warms up memory and compiles anything the vehicle needs
+    update()
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(ticks):
+            update()
+        best = min(best, time.perf_counter() - start)
+    return best / ticks * 1e6
+
+
+def vehicle_overhead(nb_parts=15, ticks=10000, repeat=5, mem: Memory = None, baseline=False) -> float:
+    """
+    Run `ticks` iterations of the drive loop over `nb_parts` no-op parts chained by their inputs/outputs and
+    return the mean framework overhead of one tick, in microseconds (best of `repeat` runs). With `baseline`, ticks
+    are run by `baseline_update_parts`.
+    """
+    vehicle = _bench_vehicle(nb_parts, mem=mem)
+    if baseline:
+        return _best_tick(lambda: baseline_update_parts(vehicle), ticks, repeat)
+    return _best_tick(vehicle.update_parts, ticks, repeat)
+
+
+if __name__ == '__main__':
+    baseline = vehicle_overhead(mem=Memory(), baseline=True)
+    print('Baseline loop with Memory: {:.1f} us/tick'.format(baseline))
+    for mem in (Memory(), SlotMemory()):
+        overhead = vehicle_overhead(mem=mem)
+        print('Vehicle overhead with {}: {:.1f} us/tick ({:.1f}x faster than baseline)'
+              .format(mem.__class__.__name__, overhead, baseline / overhead))
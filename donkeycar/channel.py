@@ -0,0 +1,144 @@
+"""
+channel.py
+
+Lossy channel to hand off drive loop values to another process without blocking the loop.
+"""
+import logging
+import pickle
+from multiprocessing import Event, Lock, RawArray
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Counters shared by both ends of the channel
+_HEAD = 0
+_TAIL = 1
+_SENT = 2
+_DROPPED = 3
+_OVERSIZED = 4
+
+
+class DropOldestChannel:
+    """
+    Bounded channel of value dicts between processes; when it is full the oldest value is dropped.
+
+    Values are written in a ring of `slots` fixed size buffers in shared memory: numpy arrays (camera frames...)
+    are copied as raw bytes, only the other values (object arrays included) and the array descriptions are
+    pickled. Writers never wait for the reader, a value that doesn't fit in a slot is dropped and counted as
+    oversized. The lock is shared with the reader process: if it can't be taken within `lock_timeout` seconds
+    (reader killed while holding it), the value is dropped.
+    """
+
+    def __init__(self, slots=4, slot_size=1024 * 1024, lock_timeout=0.1):
+        self._slots = slots
+        self._slot_size = slot_size
+        self._lock_timeout = lock_timeout
+        self._buffer = RawArray('B', slots * slot_size)
+        self._lengths = RawArray('q', slots)
+        self._header_lengths = RawArray('q', slots)
+        self._counters = RawArray('q', 5)
+        self._lock = Lock()
+        self._not_empty = Event()
+
+    @property
+    def sent(self) -> int:
+        return self._counters[_SENT]
+
+    @property
+    def dropped(self) -> int:
+        return self._counters[_DROPPED]
+
+    @property
+    def oversized(self) -> int:
+        return self._counters[_OVERSIZED]
+
+    def __len__(self):
+        return self._counters[_HEAD] - self._counters[_TAIL]
+
+    def put(self, values: Dict[str, Any]) -> bool:
+        """
+        Write values to the channel, dropping the oldest one if it is full. Return False if values are too large
+        or the channel is locked by the reader, or if a value can't be pickled (counted as dropped).
+        """
+        scalars = {}
+        arrays = []
+        offset = 0
+        for key, value in values.items():
+            # object arrays only hold references, they are pickled with the header
+            if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+                arrays.append((key, value.dtype.str, value.shape, offset))
+                offset += value.nbytes
+            else:
+                scalars[key] = value
+        try:
+            header = pickle.dumps((scalars, arrays), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # never break the drive loop for values that can't be sent
+            self._counters[_DROPPED] += 1
+            logger.warning('Drop values that can not be pickled', exc_info=True)
+            return False
+        length = len(header) + offset
+        if length > self._slot_size:
+            self._counters[_OVERSIZED] += 1
+            logger.debug('Drop values of %s bytes, larger than channel slots', length)
+            return False
+
+        if not self._lock.acquire(timeout=self._lock_timeout):
+            self._counters[_DROPPED] += 1
+            logger.warning('Drop values, channel locked for more than %ss', self._lock_timeout)
+            return False
+        try:
+            counters = self._counters
+            if counters[_HEAD] - counters[_TAIL] >= self._slots:
+                counters[_TAIL] += 1
+                counters[_DROPPED] += 1
+            slot = counters[_HEAD] % self._slots
+            start = slot * self._slot_size
+            view = np.frombuffer(self._buffer, dtype=np.uint8)[start:start + length]
+            view[:len(header)] = np.frombuffer(header, dtype=np.uint8)
+            data = view[len(header):]
+            for key, _, _, array_offset in arrays:
+                value = values[key]
+                data[array_offset:array_offset + value.nbytes].view(value.dtype).reshape(value.shape)[...] = value
+            self._lengths[slot] = length
+            self._header_lengths[slot] = len(header)
+            counters[_HEAD] += 1
+            counters[_SENT] += 1
+        finally:
+            self._lock.release()
+        self._not_empty.set()
+        return True
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """
+        Read the oldest values of the channel, waiting up to `timeout` seconds. Return None if nothing was written.
+        """
+        with self._lock:
+            raw, header_length = self._pop()
+        if raw is None:
+            self._not_empty.wait(timeout)
+            self._not_empty.clear()
+            with self._lock:
+                raw, header_length = self._pop()
+            if raw is None:
+                return None
+
+        scalars, arrays = pickle.loads(raw[:header_length])
+        data = memoryview(raw)[header_length:]
+        for key, dtype, shape, offset in arrays:
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            scalars[key] = np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(shape)
+        return scalars
+
+    def _pop(self) -> Tuple[Optional[bytes], int]:
+        counters = self._counters
+        if counters[_HEAD] == counters[_TAIL]:
+            return None, 0
+        slot = counters[_TAIL] % self._slots
+        start = slot * self._slot_size
+        raw = np.frombuffer(self._buffer, dtype=np.uint8)[start:start + self._lengths[slot]].tobytes()
+        counters[_TAIL] += 1
+        return raw, self._header_lengths[slot]
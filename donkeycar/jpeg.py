@@ -0,0 +1,95 @@
+"""
+jpeg.py
+
+JPEG encoding service shared by the frame consumers (mqtt telemetry, mjpeg video, tubs).
+"""
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Hashable, Optional
+
+import numpy as np
+
+from donkeycar import utils
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUALITY = 75
+
+
+class JpegEncoder:
+    """
+    Encode frames on a pool of worker threads, each frame at most once per quality.
+
+    A frame is identified by `key` (see `frame_key`) or, by default, by the array object
+    itself when it is read-only: published camera frames are read-only and a new array is allocated for each
+    frame. Writeable arrays without key may be reused buffers and are always encoded. The last `cache_size`
+    encodings are kept, so consumers of the same frame share the same bytes.
+    """
+
+    def __init__(self, workers=2, cache_size=16, quality=DEFAULT_QUALITY):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = Lock()
+        self.quality = quality
+        self.encoded = 0
+        self.hits = 0
+
+    def submit(self, arr: np.ndarray, key: Hashable = None, quality: int = None) -> Future:
+        """
+        Return a future of the JPEG bytes of `arr`, encoding it only if it wasn't already.
+        """
+        if quality is None:
+            quality = self.quality
+        if key is None and arr.flags.writeable:
+            self.encoded += 1
+            return self._executor.submit(utils.arr_to_binary, arr, quality)
+        cache_key = (id(arr) if key is None else key, quality)
+        with self._lock:
+            entry = self._cache.get(cache_key)
+            # the id of a collected array can be reused, check it is still the same array
+            if entry is not None and (key is not None or entry[0] is arr):
+                self._cache.move_to_end(cache_key)
+                self.hits += 1
+                return entry[1]
+
+            future = self._executor.submit(utils.arr_to_binary, arr, quality)
+            self._cache[cache_key] = (arr, future)
+            self.encoded += 1
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+            return future
+
+    def encode(self, arr: np.ndarray, key: Hashable = None, quality: int = None) -> bytes:
+        return self.submit(arr, key=key, quality=quality).result()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+        with self._lock:
+            self._cache.clear()
+
+
+def frame_key(key: str, frame_id=None) -> Optional[Hashable]:
+    """
+    Cache key of the image stored under memory `key` for camera frame `frame_id`, the same for all consumers so
+    they share its encoding. None when the frame id is unknown: the array identity is then used.
+    """
+    return None if frame_id is None else (key, frame_id)
+
+
+_shared_encoder = None
+_shared_encoder_lock = Lock()
+
+
+def shared_encoder() -> JpegEncoder:
+    """
+    Return the encoder shared by the parts of the process. Encodings are not shared with other processes: the
+    multiprocessing mqtt publisher encodes images in the vehicle process before handing them to its child.
+    """
+    global _shared_encoder
+    with _shared_encoder_lock:
+        if _shared_encoder is None:
+            _shared_encoder = JpegEncoder()
+        return _shared_encoder
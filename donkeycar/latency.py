@@ -0,0 +1,40 @@
+"""
+latency.py
+
+Rolling latency statistics for the parts of the drive loop.
+"""
+from typing import Dict
+
+import numpy as np
+
+PERCENTILES = (50, 95, 99)
+
+
+class LatencyHistogram:
+    """
+    Keep the last `size` durations (in seconds) of a part in a preallocated ring buffer.
+    """
+
+    def __init__(self, size=256):
+        self._samples = [0.0] * size
+        self._size = size
+        self._index = 0
+        self.count = 0
+        self.last = 0.0
+
+    def add(self, duration: float):
+        self._samples[self._index] = duration
+        self._index = (self._index + 1) % self._size
+        self.count += 1
+        self.last = duration
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Return p50/p95/p99/max over the rolling window, in milliseconds.
+        """
+        if self.count == 0:
+            return {}
+        window = np.array(self._samples[:min(self.count, self._size)]) * 1000
+        stats = {'p{}'.format(p): v for p, v in zip(PERCENTILES, np.percentile(window, PERCENTILES))}
+        stats['max'] = float(window.max())
+        return stats
@@ -6,7 +6,7 @@ import socket
 import sys
 
 import donkeycar as dk
-from donkeycar.parts.datastore import Tub
+from donkeycar.parts.datastore import Tub, FrameStore, convert_tub
 from .tub import TubManager
 
 logger = logging.getLogger(__name__)
@@ -309,6 +309,52 @@ class TubCheck(BaseCommand):
         self.check(args.tubs)
 
 
+class TubConvert(BaseCommand):
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='tubconvert', usage='%(prog)s [options]')
+        parser.add_argument('tub', help='path of the tub to convert')
+        parser.add_argument('out', help='path of the converted tub, it must not exist')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def convert(self, tub_path, out_path):
+        '''
+        Copy a tub with one file per record and image into a tub in the append-only packed format.
+        '''
+        if os.path.exists(os.path.expanduser(out_path)):
+            print('The converted tub {} already exists.'.format(out_path))
+            return
+        tub = convert_tub(tub_path, out_path)
+        print('Converted {} records into {}.'.format(tub.get_num_records(), tub.path))
+
+    def run(self, args):
+        args = self.parse_args(args)
+        self.convert(args.tub, args.out)
+
+
+class TubFrames(BaseCommand):
+    def parse_args(self, args):
+        parser = argparse.ArgumentParser(prog='tubframes', usage='%(prog)s [options]')
+        parser.add_argument('tubs', nargs='+', help='paths to tubs')
+        parser.add_argument('--key', default='cam/image_array', help='key of the images to decode')
+        parser.add_argument('--workers', type=int, default=4, help='threads decoding the images')
+        parsed_args = parser.parse_args(args)
+        return parsed_args
+
+    def convert(self, tub_paths, key, workers=4):
+        '''
+        Decode the images of the tubs into memory-mapped frame arrays read by training instead of the JPEG files.
+        '''
+        for tub_path in tub_paths:
+            frame_store = FrameStore.build(Tub(tub_path), key=key, workers=workers)
+            print('Decoded {} frames of {} into {}.'.format(frame_store.frames.shape[0], frame_store.frames.shape[1:],
+                                                             os.path.join(frame_store.path, FrameStore.FILE)))
+
+    def run(self, args):
+        args = self.parse_args(args)
+        self.convert(args.tubs, args.key, args.workers)
+
+
 class ShowHistogram(BaseCommand):
 
     def parse_args(self, args):
@@ -409,6 +455,8 @@ def execute_from_command_line():
         'tubhist': ShowHistogram,
         'tubplot': ShowPredictionPlots,
         'tubcheck': TubCheck,
+        'tubconvert': TubConvert,
+        'tubframes': TubFrames,
         'makemovie': MakeMovie,
         'sim': Sim,
     }
@@ -8,6 +8,7 @@ import os, sys, time
 import json
 import tornado.web
 from stat import S_ISREG, ST_MTIME, ST_MODE, ST_CTIME, ST_ATIME
+from donkeycar.parts.datastore import Tub, read_image
 
 
 class TubManager:
@@ -18,9 +19,11 @@ class TubManager:
 
 class WebServer(tornado.web.Application):
 
-    def __init__(self, data_path):
+    def __init__(self, data_path, debug=True):
         if not os.path.exists(data_path):
             raise ValueError('The path {} does not exist.'.format(data_path))
+        self.data_path = data_path
+        self._tubs = {}
 
         this_dir = os.path.dirname(os.path.realpath(__file__))
         static_file_path = os.path.join(this_dir, 'tub_web', 'static')
@@ -31,15 +34,27 @@ class WebServer(tornado.web.Application):
             (r"/", tornado.web.RedirectHandler, dict(url="/tubs")),
             (r"/tubs", TubsView, dict(data_path=data_path)),
             (r"/tubs/?(?P<tub_id>[^/]+)?", TubView),
+            (r"/api/tubs/(?P<tub_id>[^/]+)/(?P<ix>[0-9]+)", TubRecordApi),
+            (r"/api/tubs/(?P<tub_id>[^/]+)/(?P<ix>[0-9]+)/image", TubImageApi),
             (r"/api/tubs/?(?P<tub_id>[^/]+)?", TubApi, dict(data_path=data_path)),
             (r"/static/(.*)", tornado.web.StaticFileHandler, {"path": static_file_path}),
             (r"/tub_data/(.*)", tornado.web.StaticFileHandler, {"path": data_path}),
             ]
 
-        settings = {'debug': True}
+        settings = {'debug': debug}
 
         super().__init__(handlers, **settings)
 
+    def tub(self, tub_id) -> Tub:
+        """
+        Return the opened tub `tub_id`, records and images of packed tubs are only readable through `Tub`.
+        """
+        tub = self._tubs.get(tub_id)
+        if tub is None:
+            tub = Tub(os.path.join(self.data_path, tub_id))
+            self._tubs[tub_id] = tub
+        return tub
+
     def start(self, port=8886):
         self.port = int(port)
         self.listen(self.port)
@@ -78,16 +93,21 @@ class TubApi(tornado.web.RequestHandler):
     def record_path(self, tub_path, frame_id):
         return os.path.join(tub_path, "record_" + frame_id + ".json")
 
-    def clips_of_tub(self, tub_path):
-        seqs = [ int(f.split("_")[0]) for f in os.listdir(tub_path) if f.endswith('.jpg') ]
-        seqs.sort()
-
-        entries = ((os.stat(self.image_path(tub_path, seq))[ST_ATIME], seq) for seq in seqs)
-
-        (last_ts, seq) = next(entries)
-        clips = [[seq]]
-        for next_ts, next_seq in entries:
-            if next_ts - last_ts > 100:  #greater than 1s apart
+    def clips_of_tub(self, tub):
+        if tub.store is None:
+            seqs = [seq for seq in tub.get_index(shuffled=False) if os.path.exists(self.image_path(tub.path, seq))]
+            timestamps = [os.stat(self.image_path(tub.path, seq))[ST_ATIME] for seq in seqs]
+            max_gap = 100
+        else:
+            # a packed tub has no file per image, split clips on gaps in record numbers
+            seqs = tub.get_index(shuffled=False)
+            timestamps = seqs
+            max_gap = 1
+
+        clips = []
+        last_ts = None
+        for next_ts, next_seq in zip(timestamps, seqs):
+            if last_ts is None or next_ts - last_ts > max_gap:
                 clips.append([next_seq])
             else:
                 clips[-1].append(next_seq)
@@ -96,20 +116,42 @@ class TubApi(tornado.web.RequestHandler):
         return clips
 
     def get(self, tub_id):
-        clips = self.clips_of_tub(os.path.join(self.data_path, tub_id))
+        clips = self.clips_of_tub(self.application.tub(tub_id))
 
         self.set_header("Content-Type", "application/json; charset=UTF-8")
         self.write(json.dumps({'clips': clips}))
 
     def post(self, tub_id):
-        tub_path = os.path.join(self.data_path, tub_id)
-        old_clips = self.clips_of_tub(tub_path)
+        tub = self.application.tub(tub_id)
+        old_clips = self.clips_of_tub(tub)
         new_clips = tornado.escape.json_decode(self.request.body)
 
         import itertools
         old_frames = list(itertools.chain(*old_clips))
         new_frames = list(itertools.chain(*new_clips['clips']))
-        frames_to_delete = [str(item) for item in old_frames if item not in new_frames]
+        frames_to_delete = [item for item in old_frames if item not in new_frames]
         for frm in frames_to_delete:
-            os.remove(self.record_path(tub_path, frm))
-            os.remove(self.image_path(tub_path, frm))
+            tub.remove_record(frm, remove_images=True)
+
+
+class TubRecordApi(tornado.web.RequestHandler):
+
+    def get(self, tub_id, ix):
+        try:
+            record = self.application.tub(tub_id).get_json_record(int(ix))
+        except FileNotFoundError:
+            raise tornado.web.HTTPError(404)
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(json.dumps(record))
+
+
+class TubImageApi(tornado.web.RequestHandler):
+
+    def get(self, tub_id, ix):
+        try:
+            record = self.application.tub(tub_id).get_json_record(int(ix))
+            content = read_image(record['cam/image_array'])
+        except (FileNotFoundError, KeyError):
+            raise tornado.web.HTTPError(404)
+        self.set_header("Content-Type", "image/jpeg")
+        self.write(content)
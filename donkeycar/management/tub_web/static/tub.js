@@ -49,9 +49,9 @@ $(document).ready(function(){
     // UI elements update
     var updateStreamImg = function() {
         var curFrame = selectedClip().frames[currentFrameIdx];
-        $('#img-preview').attr('src', '/tub_data/' + tubId + '/' + curFrame + '_cam-image_array_.jpg');
+        $('#img-preview').attr('src', '/api/tubs/' + tubId + '/' + curFrame + '/image');
         $('#cur-frame').text(curFrame);
-        $.getJSON('/tub_data/' + tubId + '/' + 'record_' + curFrame + '.json', function(data) {
+        $.getJSON('/api/tubs/' + tubId + '/' + curFrame, function(data) {
             var angle = data["user/angle"];
             var steeringPercent = Math.round(Math.abs(angle) * 100) + '%';
             var steeringRounded = angle.toFixed(2)
@@ -103,7 +103,7 @@ $(document).ready(function(){
             return Math.round(frames.length/16*i);
         })
         .map(function(frameIdx) {
-            return '<img class="clip-thumbnail" src="/tub_data/' + tubId + '/' + frames[frameIdx] + '_cam-image_array_.jpg" />';
+            return '<img class="clip-thumbnail" src="/api/tubs/' + tubId + '/' + frames[frameIdx] + '/image" />';
         })
         .join('');
 
@@ -5,6 +5,9 @@ Created on Sun Jun 25 11:07:48 2017
 
 @author: wroscoe
 """
+from collections.abc import MutableMapping
+from operator import itemgetter
+
 
 class Memory:
     """
@@ -48,12 +51,209 @@ class Memory:
     def get(self, keys):
         result = [self.d.get(k) for k in keys]
         return result
-    
+
+    def intern(self, keys):
+        """
+        Declare keys that will be used by parts. Nothing to prepare for a dict backed memory.
+        """
+        pass
+
+    def reader(self, keys):
+        """
+        Resolve keys once and return a callable that returns their current values (None for missing keys).
+        """
+        get = self.d.get
+        keys = tuple(keys)
+        if not keys:
+            return tuple
+        if len(keys) == 1:
+            key = keys[0]
+            return lambda: (get(key),)
+        return lambda: tuple(map(get, keys))
+
+    def writer(self, keys):
+        """
+        Resolve keys once and return a callable that saves part outputs, with the same semantic than `put`.
+        """
+        d = self.d
+        keys = tuple(keys)
+        if not keys:
+            return lambda outputs: None
+        if len(keys) == 1:
+            key = keys[0]
+
+            def write_one(outputs):
+                d[key] = outputs
+
+            return write_one
+
+        nb_keys = len(keys)
+
+        def write_many(outputs):
+            if len(outputs) < nb_keys:
+                raise IndexError('tuple index out of range issue with keys: ' + str(keys[len(outputs)]))
+            d.update(zip(keys, outputs))
+
+        return write_many
+
     def keys(self):
         return self.d.keys()
+
+    def key_count(self) -> int:
+        """
+        Number of keys, keys are never removed: a change of count means new keys.
+        """
+        return len(self.d)
     
     def values(self):
         return self.d.values()
     
     def iteritems(self):
-        return self.d.iteritems()
\ No newline at end of file
+        return self.d.iteritems()
+
+
+class _SlotMapping(MutableMapping):
+    """
+    Dict view of a `SlotMemory`, writes go to the slots. Keys can't be removed.
+    """
+
+    def __init__(self, mem):
+        self._mem = mem
+
+    def __getitem__(self, key):
+        return self._mem[key]
+
+    def __setitem__(self, key, value):
+        self._mem[key] = value
+
+    def __delitem__(self, key):
+        raise TypeError('Keys of a SlotMemory can not be removed')
+
+    def __iter__(self):
+        return iter(self._mem.keys())
+
+    def __len__(self):
+        return self._mem.key_count()
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class SlotMemory(Memory):
+    """
+    Memory that interns every key into an integer slot and stores values in a preallocated list.
+
+    Keys are interned when parts are added to the vehicle, so readers and writers built for the drive loop only
+    index a list. Interned keys not yet written hold None.
+    """
+
+    def __init__(self, *args, **kw):
+        self._slots = {}
+        self._keys = []
+        self._values = []
+
+    @property
+    def d(self):
+        return _SlotMapping(self)
+
+    def intern(self, keys):
+        """
+        Allocate a slot for each unknown key and return slots of all keys.
+        """
+        slots = self._slots
+        for k in keys:
+            if k not in slots:
+                slots[k] = len(self._keys)
+                self._keys.append(k)
+                self._values.append(None)
+        return [slots[k] for k in keys]
+
+    def slot(self, key):
+        return self._slots[key]
+
+    def __setitem__(self, key, value):
+        if type(key) is not tuple:
+            key = (key,)
+            value = (value,)
+        for i, s in enumerate(self.intern(key)):
+            self._values[s] = value[i]
+
+    def __getitem__(self, key):
+        if type(key) is tuple:
+            return [self._values[self._slots[k]] for k in key]
+        return self._values[self._slots[key]]
+
+    def update(self, new_d):
+        self[tuple(new_d.keys())] = tuple(new_d.values())
+
+    def put(self, keys, inputs):
+        slots = self.intern(keys)
+        if len(slots) > 1:
+            for i, s in enumerate(slots):
+                try:
+                    self._values[s] = inputs[i]
+                except IndexError as e:
+                    error = str(e) + ' issue with keys: ' + str(keys[i])
+                    raise IndexError(error)
+        else:
+            self._values[slots[0]] = inputs
+
+    def get(self, keys):
+        slots = self._slots
+        values = self._values
+        return [values[slots[k]] if k in slots else None for k in keys]
+
+    def reader(self, keys):
+        values = self._values
+        slots = tuple(self.intern(keys))
+        if not slots:
+            return tuple
+        if len(slots) == 1:
+            s = slots[0]
+            return lambda: (values[s],)
+        getter = itemgetter(*slots)
+        return lambda: getter(values)
+
+    def writer(self, keys):
+        values = self._values
+        slots = tuple(self.intern(keys))
+        if not slots:
+            return lambda outputs: None
+        if len(slots) == 1:
+            s = slots[0]
+
+            def write_one(outputs):
+                values[s] = outputs
+
+            return write_one
+
+        nb_slots = len(slots)
+        if slots == tuple(range(slots[0], slots[0] + nb_slots)):
+            # Outputs interned together are contiguous: assign them as a slice
+            start, end = slots[0], slots[0] + nb_slots
+
+            def write_contiguous(outputs):
+                if len(outputs) != nb_slots:
+                    if len(outputs) < nb_slots:
+                        raise IndexError('tuple index out of range issue with keys: ' + str(keys[len(outputs)]))
+                    outputs = outputs[:nb_slots]
+                values[start:end] = outputs
+
+            return write_contiguous
+
+        def write_many(outputs):
+            if len(outputs) < nb_slots:
+                raise IndexError('tuple index out of range issue with keys: ' + str(keys[len(outputs)]))
+            for s, v in zip(slots, outputs):
+                values[s] = v
+
+        return write_many
+
+    def keys(self):
+        return list(self._keys)
+
+    def key_count(self) -> int:
+        return len(self._keys)
+
+    def values(self):
+        return list(self._values)
@@ -197,6 +197,7 @@ class AngleProcessorMiddleLine(Part):
 
 
 class AngleDebug(Part):
+    sheddable = True
 
     def __init__(self, config: AngleConfigController):
         self._config = config
@@ -256,6 +257,7 @@ class AngleDebug(Part):
 
 
 class AngleContourDebug(Part):
+    sheddable = True
 
     def __init__(self, config: AngleConfigController):
         self._config = config
@@ -349,6 +351,7 @@ class AngleRoadPart(Part):
 
 class RoadEllipseDebugPart(Part):
     IMG_ROAD_ELLIPSE = 'img/road_ellipse'
+    sheddable = True
 
     def run(self, img: ndarray, road_ellipse: Ellipse, angle: float) -> ndarray:
         x_center = int(img.shape[1] / 2)
@@ -3,7 +3,8 @@ import logging
 import os
 import time
 from pathlib import Path
-from typing import List
+from threading import Lock
+from typing import List, Optional, Tuple
 
 import cv2
 import numpy as np
@@ -12,21 +13,83 @@ from PIL import Image
 from donkeycar.parts.part import ThreadedPart, Part
 
 CAM_IMAGE = 'cam/image_array'
+# Sequence number of the frame in `cam/image_array`, it only changes when the camera delivers a new frame
+CAM_FRAME_ID = 'cam/frame_id'
 
 logger = logging.getLogger(__name__)
 
 
+class FrameBuffer:
+    """
+    Hand off frames from a capture thread to the drive loop.
+
+    The capture thread gives up ownership of each frame it puts: the last frame is published by reference, with a
+    sequence number, and readers get a read-only view of it. Nobody writes into a published frame, so readers never
+    see a torn frame and don't need to copy it. Parts drawing on their input image must draw on a copy.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._frame = None
+        self.seq = 0
+        self.timestamp = 0.0
+
+    def put(self, frame):
+        """
+        Publish a new frame; the caller must not modify it afterwards.
+        """
+        if isinstance(frame, np.ndarray):
+            frame = frame.view()
+            frame.flags.writeable = False
+        with self._lock:
+            self.seq += 1
+            self.timestamp = time.time()
+            self._frame = frame
+
+    def read(self) -> Tuple[Optional[np.ndarray], int, float]:
+        """
+        Return last frame, its sequence number and its capture timestamp.
+        """
+        with self._lock:
+            return self._frame, self.seq, self.timestamp
+
+
 class BaseCamera:
+    """
+    With `frame_id=True`, the camera also outputs `cam/frame_id`, the sequence number of the frame, so that image
+    parts can be triggered by new frames.
+    """
+
+    def __init__(self, frame_id=False):
+        self.frame_buffer = FrameBuffer()
+        self.frame_id = frame_id
+
+    @property
+    def frame(self):
+        return self.frame_buffer.read()[0]
+
+    @frame.setter
+    def frame(self, frame):
+        self.frame_buffer.put(frame)
 
     def run_threaded(self):
-        return self.frame
+        frame, seq, _ = self.frame_buffer.read()
+        if self.frame_id:
+            return frame, seq
+        return frame
+
+    def get_outputs_keys(self) -> List[str]:
+        if self.frame_id:
+            return [CAM_IMAGE, CAM_FRAME_ID]
+        return [CAM_IMAGE]
 
 
 class PiCamera(BaseCamera, ThreadedPart):
 
-    def __init__(self, resolution=(120, 160), framerate=20, rotation=0):
+    def __init__(self, resolution=(120, 160), framerate=20, rotation=0, frame_id=False):
         from picamera.array import PiRGBArray
         from picamera import PiCamera
+        super().__init__(frame_id=frame_id)
         resolution = (resolution[1], resolution[0])
         # initialize the camera and stream
         self.camera = PiCamera()  # PiCamera gets resolution (height, width)
@@ -37,9 +100,8 @@ class PiCamera(BaseCamera, ThreadedPart):
         self.stream = self.camera.capture_continuous(self.rawCapture,
                                                      format="rgb", use_video_port=True)
 
-        # initialize the frame and the variable used to indicate
+        # initialize the variable used to indicate
         # if the thread should be stopped
-        self.frame = None
         self.on = True
 
         logger.info('PiCamera loaded.. .warming camera')
@@ -55,7 +117,8 @@ class PiCamera(BaseCamera, ThreadedPart):
         # keep looping infinitely until the thread is stopped
         for f in self.stream:
             # grab the frame from the stream and clear the stream in
-            # preparation for the next frame
+            # preparation for the next frame. Each capture allocates a new array
+            # so it can be handed off without copy.
             self.frame = f.array
             self.rawCapture.truncate(0)
 
@@ -75,33 +138,35 @@ class PiCamera(BaseCamera, ThreadedPart):
     def get_inputs_keys(self) -> List[str]:
         return []
 
-    def get_outputs_keys(self) -> List[str]:
-        return [CAM_IMAGE]
-
 
 class WebcamCV(BaseCamera):
     """
     Use webcam with opencv
     """
 
-    def __init__(self, resolution=(120, 160), framerate=20, index=0):
-        super().__init__()
+    def __init__(self, resolution=(120, 160), framerate=20, index=0, frame_id=False):
+        super().__init__(frame_id=frame_id)
         import numpy as np
         self.cap = cv2.VideoCapture(index)
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, resolution[0])
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, resolution[1])
         self.frame = np.zeros(resolution)
+        self.framerate = framerate
+        self.on = True
 
     def update(self):
-        while True:
-            # Capture frame-by-frame
-            ret, self.frame = self.cap.read()
-
-    def run_threaded(self):
-        return self.frame
+        while self.on:
+            # Capture frame-by-frame, read() allocates a new array for each frame and blocks until it is available
+            ret, frame = self.cap.read()
+            if ret:
+                self.frame = frame
+            else:
+                # no frame available, don't spin on the capture device
+                time.sleep(1 / self.framerate)
 
     def shutdown(self):
         # indicate that the thread should be stopped
+        self.on = False
         logger.info('stoping Webcam')
         self.cap.release()
         cv2.destroyAllWindows()
@@ -109,10 +174,10 @@ class WebcamCV(BaseCamera):
 
 
 class Webcam(BaseCamera):
-    def __init__(self, resolution=(120, 160), framerate=20):
+    def __init__(self, resolution=(120, 160), framerate=20, frame_id=False):
         import pygame.camera
 
-        super().__init__()
+        super().__init__(frame_id=frame_id)
 
         pygame.init()
         pygame.camera.init()
@@ -125,7 +190,6 @@ class Webcam(BaseCamera):
 
         # initialize variable used to indicate
         # if the thread should be stopped
-        self.frame = None
         self.on = True
 
         logger.info('WebcamVideoStream loaded.. .warming camera')
@@ -153,9 +217,6 @@ class Webcam(BaseCamera):
 
         self.cam.stop()
 
-    def run_threaded(self):
-        return self.frame
-
     def shutdown(self):
         # indicate that the thread should be stopped
         self.on = False
@@ -168,7 +229,8 @@ class MockCamera(BaseCamera):
     Fake camera. Returns only a single static frame
     '''
 
-    def __init__(self, resolution=(160, 120), image=None):
+    def __init__(self, resolution=(160, 120), image=None, frame_id=False):
+        super().__init__(frame_id=frame_id)
         if image is not None:
             self.frame = image
         else:
@@ -186,7 +248,8 @@ class ImageListCamera(BaseCamera, ThreadedPart):
     Use the images from a tub as a fake camera output
     """
 
-    def __init__(self, path_mask='~/d2/data/**/*.jpg'):
+    def __init__(self, path_mask='~/d2/data/**/*.jpg', frame_id=False):
+        super().__init__(frame_id=frame_id)
         self.image_filenames = glob.glob(os.path.expanduser(path_mask), recursive=True)
 
         def get_image_index(fnm):
@@ -204,7 +267,6 @@ class ImageListCamera(BaseCamera, ThreadedPart):
         self.num_images = len(self.image_filenames)
         print(self.image_filenames[:10])
         self.i_frame = 0
-        self.frame = None
         self.update()
 
     def update(self):
@@ -215,21 +277,24 @@ class ImageListCamera(BaseCamera, ThreadedPart):
             self.i_frame = (self.i_frame + 1) % self.num_images
             self.frame = np.array(Image.open(self.image_filenames[self.i_frame]))
 
-        return self.frame
+        return super().run_threaded()
 
     def get_inputs_keys(self) -> List[str]:
         return []
 
-    def get_outputs_keys(self) -> List[str]:
-        return [CAM_IMAGE]
-
 
 class VideoCamera(Part):
-    def __init__(self, video: Path):
+    def __init__(self, video: Path, frame_id=False):
         self._video_capture = cv2.VideoCapture(str(video))
+        self._frame_id = 0
+        self.frame_id = frame_id
 
     def run(self, **kw):
-        _, frame = self._video_capture.read()
+        ret, frame = self._video_capture.read()
+        if ret:
+            self._frame_id += 1
+        if self.frame_id:
+            return frame, self._frame_id
         return frame
 
     def shutdown(self):
@@ -239,4 +304,6 @@ class VideoCamera(Part):
         return []
 
     def get_outputs_keys(self) -> List[str]:
+        if self.frame_id:
+            return [CAM_IMAGE, CAM_FRAME_ID]
         return [CAM_IMAGE]
@@ -6,18 +6,30 @@ Created on Tue Jul  4 12:32:53 2017
 @author: wroscoe
 """
 import datetime
+import io
+import itertools
 import json
+import logging
 import os
 import random
 import sys
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from queue import Full, Queue
+from threading import Lock, Thread
 
 import numpy as np
 import pandas as pd
 import time
+import zlib
+from typing import Dict, List, Optional, Tuple
 from PIL import Image
 
-from donkeycar import utils
+from donkeycar import utils, wire
+from donkeycar.jpeg import frame_key, shared_encoder
+from donkeycar.parts.camera import CAM_IMAGE, CAM_FRAME_ID
 
+logger = logging.getLogger(__name__)
 
 class OriginalWriter:
     """
@@ -131,6 +143,437 @@ class OriginalWriter:
         pass
 
 
+class TubStore:
+    """
+    Append-only storage of a tub in a few files instead of one file per record and image:
+
+    - `catalog.jsonl`: records, one JSON document per line,
+    - `catalog.idx`: fixed width entries with the index of a record and the offset and length of its line,
+    - `images.pack`: JPEG images one after another,
+    - `images.idx`: fixed width entries with the index of a record, the number of the image key (its position in the
+      `image_keys` of `meta.json`) and the offset and length of the image in the pack.
+
+    Index entries are only written by `flush`, after the data they point to: a write interrupted at the end of a file
+    is never referenced. When a record index appears several times, the last entry wins; an entry of length 0 marks
+    a removed record.
+
+    Images are referenced from outside of the store as `<path>/images.pack#<offset>:<length>`, see `load_image`.
+    """
+
+    CATALOG = 'catalog.jsonl'
+    CATALOG_INDEX = 'catalog.idx'
+    IMAGES = 'images.pack'
+    IMAGES_INDEX = 'images.idx'
+    CATALOG_INDEX_DTYPE = np.dtype([('ix', '<i8'), ('offset', '<u8'), ('length', '<u4')])
+    IMAGES_INDEX_DTYPE = np.dtype([('ix', '<i8'), ('key', '<u2'), ('offset', '<u8'), ('length', '<u4')])
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        os.makedirs(self.path, exist_ok=True)
+        self.meta_path = os.path.join(self.path, 'meta.json')
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {'inputs': [], 'types': []}
+        self.meta['format'] = 'packed'
+        self.meta.setdefault('image_keys', [])
+        self._files = {}
+        self._catalog_entries = []
+        self._images_entries = []
+        # parsed indexes and the number of bytes of the index files they were parsed from
+        self._catalog_index = ({}, 0)
+        self._images_index = ({}, 0)
+
+    @staticmethod
+    def is_packed(path) -> bool:
+        return os.path.exists(os.path.join(os.path.expanduser(path), TubStore.CATALOG_INDEX))
+
+    def write_meta(self, inputs=None, types=None):
+        if inputs is not None:
+            self.meta['inputs'] = list(inputs)
+            self.meta['types'] = list(types)
+        with open(self.meta_path, 'w') as f:
+            json.dump(self.meta, f)
+
+    def _file(self, name, mode='ab'):
+        f = self._files.get((name, mode))
+        if f is None:
+            f = open(os.path.join(self.path, name), mode)
+            self._files[(name, mode)] = f
+        return f
+
+    def append_record(self, ix, record: dict):
+        line = json.dumps(record).encode('utf-8') + b'\n'
+        f = self._file(self.CATALOG)
+        self._catalog_entries.append((ix, f.tell(), len(line)))
+        f.write(line)
+
+    def append_image(self, ix, key, content: bytes):
+        image_keys = self.meta['image_keys']
+        if key not in image_keys:
+            image_keys.append(key)
+            self.write_meta()
+        f = self._file(self.IMAGES)
+        self._images_entries.append((ix, image_keys.index(key), f.tell(), len(content)))
+        f.write(content)
+
+    def remove_record(self, ix):
+        self._catalog_entries.append((ix, 0, 0))
+
+    def flush(self):
+        """
+        Make appended records and images readable.
+        """
+        for name in (self.CATALOG, self.IMAGES):
+            if (name, 'ab') in self._files:
+                self._files[(name, 'ab')].flush()
+        for name, dtype, entries in ((self.CATALOG_INDEX, self.CATALOG_INDEX_DTYPE, self._catalog_entries),
+                                     (self.IMAGES_INDEX, self.IMAGES_INDEX_DTYPE, self._images_entries)):
+            if entries:
+                f = self._file(name)
+                f.write(np.array(entries, dtype=dtype).tobytes())
+                f.flush()
+        self._catalog_entries = []
+        self._images_entries = []
+
+    def _read_index(self, name, dtype, start) -> Tuple[np.ndarray, int]:
+        """
+        Return the entries of an index file after byte `start` and the number of bytes read up to the last one.
+        """
+        path = os.path.join(self.path, name)
+        if not os.path.exists(path):
+            return np.zeros(0, dtype=dtype), start
+        # ignore a partially written last entry
+        count = (os.path.getsize(path) - start) // dtype.itemsize
+        entries = np.fromfile(path, dtype=dtype, count=count, offset=start)
+        return entries, start + count * dtype.itemsize
+
+    def catalog_index(self) -> Dict[int, Tuple[int, int]]:
+        """
+        Return offset and length in the catalog of each record, by record index. The index is updated in place by
+        later calls, copy it to keep it.
+        """
+        index, size = self._catalog_index
+        entries, size = self._read_index(self.CATALOG_INDEX, self.CATALOG_INDEX_DTYPE, size)
+        if len(entries):
+            for ix, offset, length in entries.tolist():
+                if length > 0:
+                    index[ix] = (offset, length)
+                else:
+                    index.pop(ix, None)
+        self._catalog_index = (index, size)
+        return index
+
+    def images_index(self) -> Dict[Tuple[int, str], Tuple[int, int]]:
+        """
+        Return offset and length in the pack of each image, by record index and key.
+        """
+        index, size = self._images_index
+        entries, size = self._read_index(self.IMAGES_INDEX, self.IMAGES_INDEX_DTYPE, size)
+        if len(entries):
+            keys = self.meta['image_keys']
+            if entries['key'].max() >= len(keys):
+                # image keys were added by another writer
+                with open(self.meta_path, 'r') as f:
+                    keys = self.meta['image_keys'] = json.load(f)['image_keys']
+            index.update(((ix, keys[key]), (offset, length)) for ix, key, offset, length in entries.tolist())
+        self._images_index = (index, size)
+        return index
+
+    def read(self, name, offset, length) -> bytes:
+        f = self._file(name, mode='rb')
+        f.seek(offset)
+        return f.read(length)
+
+    def read_records(self, catalog_index: Dict[int, Tuple[int, int]], ixs: List[int]) -> List[dict]:
+        """
+        Parse the records `ixs` of `catalog_index` with a single read of the catalog and a single JSON document.
+        """
+        if not ixs:
+            return []
+        entries = [catalog_index[ix] for ix in ixs]
+        end = max(offset + length for offset, length in entries)
+        data = self.read(self.CATALOG, 0, end)
+        lines = b','.join(data[offset:offset + length].rstrip(b'\n') for offset, length in entries)
+        return json.loads(b'[' + lines + b']')
+
+    def image_ref(self, offset, length) -> str:
+        return '{}#{}:{}'.format(os.path.join(self.path, self.IMAGES), offset, length)
+
+    def close(self):
+        self.flush()
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+class TubIndex:
+    """
+    Persistent index of the records of a tub with one file per record, so opening and counting a tub doesn't list
+    its directory.
+
+    `records.idx` is a log of fixed width entries: the index of a record and whether it was added or removed. It is
+    replayed when the tub is opened and rebuilt from the record files by `rebuild`, when it doesn't exist yet, when
+    `Tub.check` is run or when the directory was modified after the last entry (files copied or removed by hand).
+    """
+
+    FILE = 'records.idx'
+    DTYPE = np.dtype([('ix', '<i8'), ('removed', '<u1')])
+
+    def __init__(self, path):
+        self.path = os.path.join(path, self.FILE)
+        self._file = None
+        self.last_ix = 0
+        if os.path.exists(self.path) and not self._is_stale():
+            # ignore a partially written last entry
+            count = os.path.getsize(self.path) // self.DTYPE.itemsize
+            entries = np.fromfile(self.path, dtype=self.DTYPE, count=count)
+            self._records = {}
+            for ix, removed in entries.tolist():
+                if removed:
+                    self._records.pop(ix, None)
+                else:
+                    self._records[ix] = None
+            if len(entries):
+                self.last_ix = int(entries['ix'].max())
+        else:
+            self.rebuild()
+
+    def _is_stale(self) -> bool:
+        # the index is written after the record files, files changed outside of the tub modify the directory later
+        return os.stat(os.path.dirname(self.path)).st_mtime_ns > os.stat(self.path).st_mtime_ns
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __contains__(self, ix):
+        return ix in self._records
+
+    def rebuild(self):
+        """
+        Write the index of the record files of the tub.
+        """
+        self.close()
+        nums = []
+        for file_name in next(os.walk(os.path.dirname(self.path)))[2]:
+            if file_name.startswith('record_') and file_name.endswith('.json'):
+                try:
+                    nums.append(int(file_name[len('record_'):-len('.json')]))
+                except ValueError:
+                    logger.warning('Ignore record file %s', file_name)
+        nums.sort()
+        self._records = dict.fromkeys(nums)
+        self.last_ix = max(nums, default=0)
+        entries = np.zeros(len(nums), dtype=self.DTYPE)
+        entries['ix'] = nums
+        tmp_path = self.path + '.tmp'
+        try:
+            entries.tofile(tmp_path)
+            os.replace(tmp_path, self.path)
+            # replacing the index modifies the directory
+            os.utime(self.path)
+        except OSError:
+            logger.warning('Unable to write the index of tub %s', os.path.dirname(self.path), exc_info=True)
+
+    def touch(self):
+        """
+        Keep the index up to date with the directory after writing a file that isn't a record.
+        """
+        os.utime(self.path)
+
+    def _append(self, ix, removed):
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+        self._file.write(np.array([(ix, removed)], dtype=self.DTYPE).tobytes())
+        self._file.flush()
+
+    def add(self, ix):
+        self._append(ix, False)
+        self._records[ix] = None
+        self.last_ix = max(self.last_ix, ix)
+
+    def remove(self, ix):
+        self._append(ix, True)
+        self._records.pop(ix, None)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _read_json_records(paths: List[str]) -> List[dict]:
+    records = []
+    for path in paths:
+        with open(path, 'r') as fp:
+            records.append(json.load(fp))
+    return records
+
+
+def read_json_records(paths: List[str], chunk_size=2000) -> List[dict]:
+    """
+    Parse record files, on a process pool when there are more than `chunk_size` of them.
+    """
+    if len(paths) <= chunk_size:
+        return _read_json_records(paths)
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    with ProcessPoolExecutor() as executor:
+        return [record for records in executor.map(_read_json_records, chunks) for record in records]
+
+
+class ImageCache:
+    """
+    Decoded images by path, the least recently used are evicted beyond `max_bytes`.
+
+    Cached arrays are shared by all the records using them and are read-only.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._images = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._images)
+
+    def get(self, path) -> np.ndarray:
+        with self._lock:
+            arr = self._images.get(path)
+            if arr is not None:
+                self._images.move_to_end(path)
+                self.hits += 1
+                return arr
+            self.misses += 1
+
+        # decode outside of the lock, several threads can load images at the same time
+        arr = np.array(load_image(path))
+        arr.flags.writeable = False
+        if arr.nbytes > self.max_bytes:
+            return arr
+        with self._lock:
+            if path not in self._images:
+                self._images[path] = arr
+                self.nbytes += arr.nbytes
+                while self.nbytes > self.max_bytes:
+                    _, evicted = self._images.popitem(last=False)
+                    self.nbytes -= evicted.nbytes
+        return arr
+
+
+class FrameStore:
+    """
+    Images of a tub decoded once into `frames.npy`, an N x H x W x C uint8 array read memory-mapped, so training
+    doesn't decode JPEG. `frames.json` has the image key and, for each row, the image of the record it was decoded
+    from, relative to the tub.
+    """
+
+    FILE = 'frames.npy'
+    CATALOG = 'frames.json'
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        with open(os.path.join(self.path, self.CATALOG), 'r') as f:
+            catalog = json.load(f)
+        self.key = catalog['key']
+        self.frames = np.load(os.path.join(self.path, self.FILE), mmap_mode='r')
+        self.rows = {os.path.join(self.path, name): row for row, name in enumerate(catalog['names'])}
+
+    @staticmethod
+    def exists(path) -> bool:
+        return os.path.exists(os.path.join(os.path.expanduser(path), FrameStore.CATALOG))
+
+    def get(self, image_path) -> Optional[np.ndarray]:
+        """
+        Return a read-only view of the frame decoded from `image_path`, None if it wasn't converted.
+        """
+        row = self.rows.get(image_path)
+        if row is None:
+            return None
+        return self.frames[row]
+
+    @classmethod
+    def build(cls, tub, key='cam/image_array', workers=4) -> 'FrameStore':
+        """
+        Decode the `key` images of the records of `tub` into its frame store.
+        """
+        images = [val for val in tub.get_df()[key].tolist() if type(val) == str]
+        if not images:
+            raise ValueError('No {} image in tub {}'.format(key, tub.path))
+        first = np.array(load_image(images[0]))
+        frames_path = os.path.join(tub.path, cls.FILE)
+        frames = np.lib.format.open_memmap(frames_path + '.tmp', mode='w+', dtype=np.uint8,
+                                           shape=(len(images),) + first.shape)
+
+        def decode(row):
+            arr = np.array(load_image(images[row]))
+            if arr.shape != first.shape:
+                raise ValueError('Image {} is {}, expected {}'.format(images[row], arr.shape, first.shape))
+            frames[row] = arr
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(decode, range(len(images))):
+                pass
+        frames.flush()
+        del frames
+        os.replace(frames_path + '.tmp', frames_path)
+        with open(os.path.join(tub.path, cls.CATALOG), 'w') as f:
+            json.dump({'key': key, 'names': [os.path.relpath(image, tub.path) for image in images]}, f)
+        if tub.index is not None:
+            # the frame files are not records, don't let the index and its catalog cache look stale
+            tub.index.touch()
+        return cls(tub.path)
+
+
+def read_image(path) -> bytes:
+    """
+    Return the content of an image file or of an image of the pack of a `TubStore`.
+    """
+    pack, sep, location = path.rpartition('#')
+    if not sep or not pack.endswith(TubStore.IMAGES):
+        with open(path, 'rb') as f:
+            return f.read()
+    offset, length = (int(v) for v in location.split(':'))
+    with open(pack, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def load_image(path) -> Image.Image:
+    """
+    Open an image file or an image of the pack of a `TubStore`.
+    """
+    pack, sep, _ = path.rpartition('#')
+    if not sep or not pack.endswith(TubStore.IMAGES):
+        return Image.open(path)
+    return Image.open(io.BytesIO(read_image(path)))
+
+
+def convert_tub(legacy_path, packed_path):
+    """
+    Copy a tub with one file per record and image into a new tub in the append-only format of `TubStore`.
+    """
+    legacy = Tub(legacy_path)
+    store = TubStore(packed_path)
+    store.write_meta(legacy.inputs, legacy.types)
+    for ix in legacy.get_index(shuffled=False):
+        with open(legacy.get_json_record_path(ix), 'r') as fp:
+            record = json.load(fp)
+        for key, val in record.items():
+            if legacy.get_input_type(key) in ('image', 'image_array'):
+                with open(os.path.join(legacy.path, val), 'rb') as img_file:
+                    store.append_image(ix, key, img_file.read())
+        store.append_record(ix, record)
+    store.close()
+    return Tub(packed_path)
+
+
 class Tub(object):
     """
     A datastore to store sensor data in a key, value format.
@@ -145,14 +588,36 @@ class Tub(object):
     >>> types = ['float', 'image']
     >>> t=Tub(path=path, inputs=inputs, types=types)
 
+    With `packed=True` a new tub is written in the append-only format of `TubStore` instead of one file per record
+    and image. Existing tubs are read in the format they were written.
+
+    The records of a tub with one file per record are cached in `catalog_cache.json` by `get_df`, only the records
+    added since the last call are parsed.
+
+    With `image_cache_mb`, up to that many MB of decoded images are kept in memory by `read_record`, so training
+    epochs don't decode the same JPEG again. With `frames=True`, images converted to a `FrameStore` are read-only
+    slices of its memory-mapped array. Images of such tubs are read-only arrays.
     """
 
-    def __init__(self, path, inputs=None, types=None):
+    CATALOG_CACHE = 'catalog_cache.json'
+    image_cache = None
+    frame_stores = ()
+
+    def __init__(self, path, inputs=None, types=None, packed=False, image_cache_mb=None, frames=False):
 
         self.path = os.path.expanduser(path)
         print('path_in_tub:', self.path)
         self.meta_path = os.path.join(self.path, 'meta.json')
         self.df = None
+        self.store = None
+        self.index = None
+        if image_cache_mb:
+            self.image_cache = ImageCache(image_cache_mb * 1024 * 1024)
+        if frames:
+            if FrameStore.exists(self.path):
+                self.frame_stores = [FrameStore(self.path)]
+            else:
+                logger.warning('Tub %s is not converted to frames, its images are decoded', self.path)
 
         exists = os.path.exists(self.path)
 
@@ -161,15 +626,25 @@ class Tub(object):
             print("Tub exists: {}".format(self.path))
             with open(self.meta_path, 'r') as f:
                 self.meta = json.load(f)
+            if self.meta.get('format') == 'packed' or TubStore.is_packed(self.path):
+                self.store = TubStore(self.path)
+            else:
+                self.index = TubIndex(self.path)
             self.current_ix = self.get_last_ix() + 1
 
         elif not exists and inputs:
             print('Tub does NOT exist. Creating new tub...')
             # create log and save meta
-            os.makedirs(self.path)
-            self.meta = {'inputs': inputs, 'types': types}
-            with open(self.meta_path, 'w') as f:
-                json.dump(self.meta, f)
+            if packed:
+                self.store = TubStore(self.path)
+                self.store.write_meta(inputs, types)
+                self.meta = self.store.meta
+            else:
+                os.makedirs(self.path)
+                self.meta = {'inputs': inputs, 'types': types}
+                with open(self.meta_path, 'w') as f:
+                    json.dump(self.meta, f)
+                self.index = TubIndex(self.path)
             self.current_ix = 0
             print('New tub created at: {}'.format(self.path))
         else:
@@ -181,12 +656,87 @@ class Tub(object):
         self.start_time = time.time()
 
     def get_last_ix(self):
+        if self.index is not None:
+            return self.index.last_ix
         index = self.get_index()
-        return max(index)
+        return max(index, default=0)
 
     def update_df(self):
-        df = pd.DataFrame([self.get_json_record(i) for i in self.get_index(shuffled=False)])
-        self.df = df
+        if self.store is not None:
+            df = self._load_packed_df()
+        else:
+            df = self._load_df()
+        if wire.IMAGES_DROPPED in df.columns:
+            # records published without their images are only telemetry
+            df = df[~df[wire.IMAGES_DROPPED].isin([True])]
+        self.df = df.reset_index(drop=True)
+
+    def _load_packed_df(self):
+        catalog_index = self.store.catalog_index()
+        ixs = sorted(catalog_index)
+        df = pd.DataFrame(self.store.read_records(catalog_index, ixs), index=ixs)
+        # images are referenced in the pack instead of by file name
+        images_index = self.store.images_index()
+        for key in self.store.meta['image_keys']:
+            if key in df.columns:
+                entries = (images_index.get((ix, key)) for ix in ixs)
+                df[key] = [val if entry is None else self.store.image_ref(*entry)
+                           for entry, val in zip(entries, df[key])]
+        return df
+
+    def _load_df(self):
+        """
+        Return the records indexed by record index, from the cache and the record files added since it was written.
+        """
+        cache_path = os.path.join(self.path, self.CATALOG_CACHE)
+        # the cache is valid for the records of the index it was written from: records.idx is only appended to
+        # until it is rebuilt (new file) when the directory is modified outside of the tub or by `check`
+        index_inode, index_log = None, b''
+        cached_df = None
+        try:
+            with open(self.index.path, 'rb') as f:
+                index_inode = os.fstat(f.fileno()).st_ino
+                index_log = f.read()
+            with open(cache_path, 'r') as f:
+                cache = json.load(f)
+            index_size = cache['index_size']
+            if (cache['index_inode'] == index_inode and index_size <= len(index_log)
+                    and zlib.crc32(index_log[:index_size]) == cache['index_crc']):
+                cached_df = pd.DataFrame(cache['columns'], index=pd.Index(cache['index'], dtype='int64'),
+                                         columns=list(cache['columns']))
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logger.warning('Ignore unreadable catalog cache of tub %s', self.path, exc_info=True)
+
+        ixs = pd.Index(sorted(self.index), dtype='int64')
+        if cached_df is None:
+            df = pd.DataFrame(index=ixs[:0])
+        else:
+            df = cached_df[cached_df.index.isin(ixs)]
+        new_ixs = ixs.difference(df.index)
+        if len(new_ixs):
+            records = read_json_records([self.get_json_record_path(ix) for ix in new_ixs])
+            new_df = pd.DataFrame(records, index=new_ixs)
+            df = new_df if df.empty else pd.concat([df, new_df], axis=0).sort_index()
+        if cached_df is None or len(new_ixs) or len(df) != len(cached_df):
+            try:
+                with open(cache_path + '.tmp', 'w') as f:
+                    json.dump({'index_inode': index_inode, 'index_size': len(index_log),
+                               'index_crc': zlib.crc32(index_log),
+                               'index': df.index.tolist(),
+                               'columns': {column: df[column].tolist() for column in df.columns}}, f)
+                os.replace(cache_path + '.tmp', cache_path)
+                self.index.touch()
+            except OSError:
+                logger.warning('Unable to write the catalog cache of tub %s', self.path, exc_info=True)
+
+        # make paths absolute, the cache stays valid if the tub is moved
+        df = df.copy()
+        for column in df.columns:
+            if df[column].dtype.kind not in 'biufcmM':
+                df[column] = [os.path.join(self.path, v) if type(v) == str and '.' in v else v for v in df[column]]
+        return df
 
     def get_df(self):
         if self.df is None:
@@ -194,18 +744,10 @@ class Tub(object):
         return self.df
 
     def get_index(self, shuffled=True):
-        files = next(os.walk(self.path))[2]
-        record_files = [f for f in files if f[:6] == 'record']
-
-        def get_file_ix(file_name):
-            try:
-                name = file_name.split('.')[0]
-                num = int(name.split('_')[1])
-            except:
-                num = 0
-            return num
-
-        nums = [get_file_ix(f) for f in record_files]
+        if self.store is not None:
+            nums = list(self.store.catalog_index())
+        else:
+            nums = list(self.index)
 
         if shuffled:
             random.shuffle(nums)
@@ -241,9 +783,9 @@ class Tub(object):
             raise
 
     def get_num_records(self):
-        import glob
-        files = glob.glob(os.path.join(self.path, 'record_*.json'))
-        return len(files)
+        if self.store is not None:
+            return len(self.store.catalog_index())
+        return len(self.index)
 
     def make_record_paths_absolute(self, record_dict):
         # make paths absolute
@@ -262,6 +804,8 @@ class Tub(object):
         Optionally remove records that cause a problem.
         """
         print('Checking tub:%s.' % self.path)
+        if self.index is not None:
+            self.index.rebuild()
         print('Found: %d records.' % self.get_num_records())
         problems = False
         for ix in self.get_index(shuffled=False):
@@ -277,12 +821,22 @@ class Tub(object):
         if not problems:
             print("No problems found.")
 
-    def remove_record(self, ix):
+    def remove_record(self, ix, remove_images=False):
         """
-        remove data associate with a record
+        remove data associate with a record, and its image files with `remove_images`. Images of a packed tub stay
+        in the pack but are no longer referenced.
         """
+        if self.store is not None:
+            self.store.remove_record(ix)
+            self.store.flush()
+            return
+        if remove_images:
+            for key, val in self.get_json_record(ix).items():
+                if self.get_input_type(key) in ('image', 'image_array') and os.path.exists(val):
+                    os.unlink(val)
         record = self.get_json_record_path(ix)
         os.unlink(record)
+        self.index.remove(ix)
 
     def put_record(self, data):
         """
@@ -299,28 +853,62 @@ class Tub(object):
             if typ in ['str', 'float', 'int', 'boolean']:
                 json_data[key] = val
 
-            elif typ is 'image':
+            elif typ == 'image' and self.store is not None:
+                name = self.make_file_name(key, ext='.jpg')
+                content = io.BytesIO()
+                val.save(content, format='jpeg')
+                self.store.append_image(self.current_ix, key, content.getvalue())
+                json_data[key] = name
+
+            elif typ == 'image':
                 path = self.make_file_path(key)
                 val.save(path)
                 json_data[key] = path
 
             elif typ == 'image_array':
-                img = Image.fromarray(np.uint8(val))
                 name = self.make_file_name(key, ext='.jpg')
-                img.save(os.path.join(self.path, name))
+                # reuse the encoding of the camera frame if it was already sent or streamed
+                cache_key = frame_key(key, data.get(CAM_FRAME_ID)) if key == CAM_IMAGE else None
+                content = shared_encoder().encode(val, key=cache_key)
+                if self.store is not None:
+                    self.store.append_image(self.current_ix, key, content)
+                else:
+                    with open(os.path.join(self.path, name), 'wb') as img_file:
+                        img_file.write(content)
                 json_data[key] = name
 
             else:
                 msg = 'Tub does not know what to do with this type {}'.format(typ)
                 raise TypeError(msg)
 
-        self.write_json_record(json_data)
+        if self.store is not None:
+            self.store.append_record(self.current_ix, json_data)
+            self.store.flush()
+        else:
+            self.write_json_record(json_data)
+            self.index.add(self.current_ix)
         return self.current_ix
 
     def get_json_record_path(self, ix):
         return os.path.join(self.path, 'record_' + str(ix) + '.json')
 
+    def _packed_json_record(self, ix, json_data, images_index):
+        # images are referenced in the pack instead of by file name
+        record_dict = dict(json_data)
+        for key in record_dict:
+            entry = images_index.get((ix, key))
+            if entry is not None:
+                record_dict[key] = self.store.image_ref(*entry)
+        return record_dict
+
     def get_json_record(self, ix):
+        if self.store is not None:
+            entry = self.store.catalog_index().get(ix)
+            if entry is None:
+                raise FileNotFoundError('no record {} in tub {}'.format(ix, self.path))
+            json_data = json.loads(self.store.read(TubStore.CATALOG, *entry).decode('utf-8'))
+            return self._packed_json_record(ix, json_data, self.store.images_index())
+
         path = self.get_json_record_path(ix)
         try:
             with open(path, 'r') as fp:
@@ -349,8 +937,20 @@ class Tub(object):
 
             # load objects that were saved as separate files
             if typ == 'image_array':
-                img = Image.open(val)
-                val = np.array(img)
+                if not isinstance(val, str):
+                    # the record has no image for this key (NaN in the data frame)
+                    continue
+                frame = None
+                for frame_store in self.frame_stores:
+                    frame = frame_store.get(val)
+                    if frame is not None:
+                        break
+                if frame is not None:
+                    val = frame
+                elif self.image_cache is not None:
+                    val = self.image_cache.get(val)
+                else:
+                    val = np.array(load_image(val))
 
             data[key] = val
 
@@ -367,31 +967,65 @@ class Tub(object):
         shutil.rmtree(self.path)
 
     def shutdown(self):
-        pass
+        if self.store is not None:
+            self.store.close()
+        if self.index is not None:
+            self.index.close()
 
     def get_record_gen(self, record_transform=None, shuffle=True, df=None):
+        """
+        Yield the records of `df`, epoch after epoch, each epoch in a new random order if `shuffle`.
+        """
+        for record_dict in self.get_record_dict_gen(record_transform, shuffle=shuffle, df=df):
+            yield self.read_record(record_dict)
 
+    def get_record_dict_gen(self, record_transform=None, shuffle=True, df=None):
+        """
+        Same as `get_record_gen`, without loading the files (images...) of the records.
+        """
         if df is None:
             df = self.get_df()
 
+        # select records in python lists of the columns rather than in the data frame
+        columns = {key: df[key].tolist() for key in df.columns}
+        count = len(df)
+        if count == 0:
+            return
+
         while True:
-            for row in self.df.iterrows():
-                if shuffle:
-                    record_dict = df.sample(n=1).to_dict(orient='record')[0]
+            order = np.random.permutation(count).tolist() if shuffle else range(count)
+            for i in order:
+                record_dict = {key: values[i] for key, values in columns.items()}
 
                 if record_transform:
                     record_dict = record_transform(record_dict)
 
-                record_dict = self.read_record(record_dict)
-
                 yield record_dict
 
-    def get_batch_gen(self, keys, record_transform=None, batch_size=128, shuffle=True, df=None):
-
-        record_gen = self.get_record_gen(record_transform, shuffle=shuffle, df=df)
+    def get_batch_gen(self, keys, record_transform=None, batch_size=128, shuffle=True, df=None, workers=0,
+                      prefetch=None):
+        """
+        Yield dicts of arrays of `batch_size` records by key. With `workers`, batches are loaded by a
+        `BatchPrefetcher`.
+        """
+        if df is None:
+            df = self.get_df()
 
         if keys is None:
-            keys = list(self.df.columns)
+            keys = list(df.columns)
+        # skip records missing one of the loaded values, like images not published with their record
+        df = df.dropna(subset=[key for key in keys if key in df.columns])
+
+        if len(df) == 0:
+            raise ValueError('No records to load batches from in tub {}'.format(self.path))
+
+        if workers:
+            return BatchPrefetcher(self, keys, record_transform=record_transform, batch_size=batch_size,
+                                   shuffle=shuffle, df=df, workers=workers, prefetch=prefetch)
+        return self._batch_gen(keys, record_transform, batch_size, shuffle, df)
+
+    def _batch_gen(self, keys, record_transform, batch_size, shuffle, df):
+        record_gen = self.get_record_gen(record_transform, shuffle=shuffle, df=df)
 
         while True:
             record_list = []
@@ -407,10 +1041,12 @@ class Tub(object):
 
             yield batch_arrays
 
-    def get_train_gen(self, X_keys, Y_keys, batch_size=128, record_transform=None, df=None):
+    def get_train_gen(self, X_keys, Y_keys, batch_size=128, record_transform=None, df=None, workers=0,
+                      prefetch=None):
 
         batch_gen = self.get_batch_gen(X_keys + Y_keys,
-                                       batch_size=batch_size, record_transform=record_transform, df=df)
+                                       batch_size=batch_size, record_transform=record_transform, df=df,
+                                       workers=workers, prefetch=prefetch)
 
         while True:
             batch = next(batch_gen)
@@ -418,22 +1054,120 @@ class Tub(object):
             Y = [batch[k] for k in Y_keys]
             yield X, Y
 
-    def get_train_val_gen(self, X_keys, Y_keys, batch_size=128, record_transform=None, train_frac=.8):
+    def get_train_val_gen(self, X_keys, Y_keys, batch_size=128, record_transform=None, train_frac=.8, workers=0,
+                          prefetch=None):
         train_df = train = self.df.sample(frac=train_frac, random_state=200)
         val_df = self.df.drop(train_df.index)
 
         train_gen = self.get_train_gen(X_keys=X_keys, Y_keys=Y_keys, batch_size=batch_size,
-                                       record_transform=record_transform, df=train_df)
+                                       record_transform=record_transform, df=train_df,
+                                       workers=workers, prefetch=prefetch)
 
         val_gen = self.get_train_gen(X_keys=X_keys, Y_keys=Y_keys, batch_size=batch_size,
-                                     record_transform=record_transform, df=val_df)
+                                     record_transform=record_transform, df=val_df,
+                                     workers=workers, prefetch=prefetch)
 
         return train_gen, val_gen
 
 
+class BatchPrefetcher:
+    """
+    Iterator over the batches of a tub, loaded ahead of time by a pool of `workers` threads (JPEG decoding releases
+    the GIL) while the model trains on the previous batches.
+
+    Up to `prefetch` batches are loaded in advance, each one by a worker, in new arrays: returned batches are
+    never reused, whatever the number of batches queued by the consumer (Keras `fit_generator`). `next` can be
+    called from several threads. `waited` is the total time the consumer waited for a batch and `starved` the
+    number of batches that weren't ready when asked for.
+    """
+
+    def __init__(self, tub, keys, record_transform=None, batch_size=128, shuffle=True, df=None, workers=4,
+                 prefetch=None):
+        self._tub = tub
+        self._keys = keys
+        self._batch_size = batch_size
+        self._prefetch = prefetch or 2 * workers
+        self._records = tub.get_record_dict_gen(record_transform, shuffle=shuffle, df=df)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='BatchPrefetcher')
+        self._pending = deque()
+        self._lock = Lock()
+        self.batches = 0
+        self.waited = 0.0
+        self.starved = 0
+
+        # shapes and types of the arrays of the batches, from the first record
+        first = next(self._records, None)
+        if first is None:
+            self._executor.shutdown(wait=False)
+            raise ValueError('No records to load batches from in tub {}'.format(tub.path))
+        record = tub.read_record(first)
+        self._records = itertools.chain([first], self._records)
+        self._layout = {}
+        for key in keys:
+            value = np.asarray(record[key])
+            self._layout[key] = (value.shape, object if value.dtype.kind in 'OSU' else value.dtype)
+
+        for _ in range(self._prefetch):
+            self._submit()
+
+    def _submit(self):
+        records = list(itertools.islice(self._records, self._batch_size))
+        self._pending.append(self._executor.submit(self._fill, records))
+
+    def _fill(self, records):
+        batch = {key: np.empty((self._batch_size,) + shape, dtype=dtype)
+                 for key, (shape, dtype) in self._layout.items()}
+        for i, record_dict in enumerate(records):
+            record = self._tub.read_record(record_dict)
+            for key, arr in batch.items():
+                arr[i] = record[key]
+        return batch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Dict[str, np.ndarray]:
+        with self._lock:
+            future = self._pending.popleft()
+            if not future.done():
+                self.starved += 1
+                start = time.monotonic()
+                batch = future.result()
+                self.waited += time.monotonic() - start
+            else:
+                batch = future.result()
+            self.batches += 1
+            if self.batches % 1000 == 0:
+                logger.info('Prefetched %s batches, %s not ready, waited %.1fs for them', self.batches,
+                            self.starved, self.waited)
+            self._submit()
+        return batch
+
+    def close(self):
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+
 class TubWriter(Tub):
-    def __init__(self, *args, **kwargs):
+    """
+    Tub part saving its inputs as a record at each run.
+
+    With `asynchronous=True` records are queued and saved by a writer thread, so a slow SD card never delays the
+    drive loop. At most `max_pending` records wait to be written, beyond that new records are dropped and counted in
+    `dropped`. `shutdown` writes the pending records before returning.
+    """
+
+    def __init__(self, *args, asynchronous=False, max_pending=100, **kwargs):
         super(TubWriter, self).__init__(*args, **kwargs)
+        self.written = 0
+        self.dropped = 0
+        self._queue = None
+        self._writer = None
+        if asynchronous:
+            self._queue = Queue(maxsize=max_pending)
+            self._writer = Thread(target=self._write_loop, name='TubWriter')
+            self._writer.start()
 
     def run(self, *args):
         """
@@ -446,7 +1180,50 @@ class TubWriter(Tub):
 
         self.record_time = int(time.time() - self.start_time)
         record = dict(zip(self.inputs, args))
-        self.put_record(record)
+        if self._queue is None:
+            self.put_record(record)
+            self.written += 1
+            return
+
+        # published frames are read-only, only copy arrays someone could still modify
+        for key, val in record.items():
+            if isinstance(val, np.ndarray) and val.flags.writeable:
+                record[key] = val.copy()
+        try:
+            self._queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                logger.warning('Tub writer is late, %s records dropped', self.dropped)
+
+    def _write_loop(self):
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:
+                    return
+                self.put_record(record)
+                self.written += 1
+            except Exception:
+                logger.exception('Unable to write record in tub %s', self.path)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """
+        Wait until the queued records are written.
+        """
+        if self._queue is not None:
+            self._queue.join()
+
+    def shutdown(self):
+        if self._writer is not None:
+            # the writer drains the queue before reading the end marker
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+            logger.info('Tub %s: %s records written, %s dropped', self.path, self.written, self.dropped)
+        super(TubWriter, self).shutdown()
 
 
 class TubReader(Tub):
@@ -494,9 +1271,9 @@ class TubHandler:
         tub_path = os.path.join(self.path, name)
         return tub_path
 
-    def new_tub_writer(self, inputs, types):
+    def new_tub_writer(self, inputs, types, **kwargs):
         tub_path = self.create_tub_path()
-        tw = TubWriter(path=tub_path, inputs=inputs, types=types)
+        tw = TubWriter(path=tub_path, inputs=inputs, types=types, **kwargs)
         return tw
 
 
@@ -615,7 +1392,7 @@ class TubTimeStacker(TubImageStacker):
 
 
 class TubGroup(Tub):
-    def __init__(self, tub_paths_arg):
+    def __init__(self, tub_paths_arg, image_cache_mb=None, frames=False):
         tub_paths = utils.expand_path_arg(tub_paths_arg)
         print('TubGroup:tubpaths:', tub_paths)
         tubs = [Tub(path) for path in tub_paths]
@@ -627,10 +1404,16 @@ class TubGroup(Tub):
             record_count += len(t.df)
             self.input_types.update(dict(zip(t.inputs, t.types)))
 
-        print('joining the tubs {} records together. This could take {} minutes.'.format(record_count,
-                                                                                         int(record_count / 300000)))
+        print('joining the tubs {} records together.'.format(record_count))
 
         self.meta = {'inputs': list(self.input_types.keys()),
                      'types': list(self.input_types.values())}
+        self.store = None
+        self.index = None
+        if image_cache_mb:
+            self.image_cache = ImageCache(image_cache_mb * 1024 * 1024)
+        if frames:
+            # tubs not converted to frames are decoded
+            self.frame_stores = [FrameStore(t.path) for t in tubs if FrameStore.exists(t.path)]
 
         self.df = pd.concat([t.df for t in tubs], axis=0, join='inner')
@@ -22,7 +22,7 @@ class HistogramPart(Part):
     def run(self, img_gray: ndarray) -> Optional[ndarray]:
         try:
             clahe = cv2.createCLAHE(clipLimit=self._clip_limit, tileGridSize=self._tile_grid_size)
-            return clahe.apply(img_gray.copy())
+            return clahe.apply(img_gray)
         except Exception:
             logging.exception("Unexpected error")
             return None
@@ -44,7 +44,7 @@ class BlurPart(Part):
 
     def run(self, img: ndarray) -> Optional[ndarray]:
         try:
-            return cv2.blur(img.copy(), self._kernel_size)
+            return cv2.blur(img, self._kernel_size)
         except Exception:
             logging.exception("Unexpected error")
             return None
@@ -111,7 +111,7 @@ class ConvertToGrayPart(Part):
 
     def run(self, img: ndarray) -> ndarray:
         try:
-            return cv2.cvtColor(img.copy(), cv2.COLOR_RGB2GRAY)
+            return cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
         except Exception:
             logging.exception("Unexpected error")
             return np.zeros(img.shape)
@@ -144,7 +144,7 @@ class DilatePart(Part):
     def run(self, img: ndarray):
         kernel = np.ones((3, 3), np.uint8)
         # opening = cv.morphologyEx(img,cv.MORPH_OPEN,kernel, iterations = 2)
-        return cv2.dilate(src=img.copy(), kernel=kernel, iterations=2)
+        return cv2.dilate(src=img, kernel=kernel, iterations=2)
 
     def get_inputs_keys(self) -> List[str]:
         return [self._input]
@@ -162,7 +162,7 @@ class MorphologyOpenPart(Part):
         self._kernel = np.ones((kernel_size, kernel_size), np.uint8)
 
     def run(self, img: ndarray):
-        return cv2.morphologyEx(src=img.copy(), op=cv2.MORPH_OPEN, kernel=self._kernel, iterations=self._iterations)
+        return cv2.morphologyEx(src=img, op=cv2.MORPH_OPEN, kernel=self._kernel, iterations=self._iterations)
 
     def get_inputs_keys(self) -> List[str]:
         return [self._input]
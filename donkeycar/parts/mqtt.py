@@ -3,22 +3,36 @@ import json
 import logging
 import time
 from abc import abstractmethod
+from collections import deque
 from datetime import datetime
-from multiprocessing import Process, Queue
-from typing import Dict, Any, Callable, List
+from multiprocessing import Process
+from threading import Lock
+from typing import Dict, Any, Callable, Iterable, List
 from typing import Tuple
 
+import cv2
 import numpy
 from paho.mqtt import client as mqtt
 from paho.mqtt.client import MQTTMessage, Client
 
-from donkeycar import utils
+from donkeycar import wire
+from donkeycar.channel import DropOldestChannel
+from donkeycar.jpeg import frame_key, shared_encoder
+from donkeycar.parts.camera import CAM_IMAGE, CAM_FRAME_ID
 from donkeycar.parts.part import Part
-from donkeycar.vehicle import MetricsPublisher
+from donkeycar.vehicle import MetricsPublisher, KeyProjection
 
 USER_MODE = 'user/mode'
 CTRL_RECORD = 'ctrl/record'
 
+# Published keys by default: debug images are large, only the camera and the road ellipse are sent
+DEFAULT_INCLUDE_KEYS = ('*', CAM_IMAGE, 'img/road_ellipse')
+DEFAULT_EXCLUDE_KEYS = ('img/*',)
+
+# Wire formats of the published messages
+WIRE_FORMAT_JSON = 'json'
+WIRE_FORMAT_BINARY = 'binary'
+
 logger = logging.getLogger(__name__)
 
 
@@ -31,34 +45,214 @@ class NumpyEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def _is_recording(values: Dict[str, Any]) -> bool:
+    return CTRL_RECORD not in values or bool(values[CTRL_RECORD])
+
+
+class AdaptiveDownsampler:
+    """
+    Degrade published images to keep the mqtt link within a target bandwidth.
+
+    Published bytes, messages in flight (published but not yet acknowledged) and acknowledgement latency are
+    measured over windows of `window` seconds. When one of them is over its limit, images go one level down the
+    `LEVELS` ladder: lower JPEG quality, then fewer images, then lower resolution. When the link has room again,
+    they go back up one level per window. Records are not concerned and keep flowing at full rate.
+    """
+
+    # (publish one image every n records, image scale, JPEG quality)
+    LEVELS = ((1, 1.0, 75), (1, 1.0, 50), (2, 1.0, 50), (2, 0.5, 50), (4, 0.5, 30), (8, 0.5, 20))
+
+    def __init__(self, target_bandwidth: float, max_inflight=20, max_latency=0.5, window=1.0):
+        self.target_bandwidth = target_bandwidth
+        self.max_inflight = max_inflight
+        self.max_latency = max_latency
+        self.window = window
+        self.level = 0
+        self.bandwidth = 0.0
+        self.latency = 0.0
+        self._lock = Lock()
+        self._inflight = {}
+        self._acked_before_sent = set()
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_latencies = []
+
+    @property
+    def inflight(self) -> int:
+        return len(self._inflight)
+
+    @property
+    def image_interval(self) -> int:
+        return self.LEVELS[self.level][0]
+
+    @property
+    def scale(self) -> float:
+        return self.LEVELS[self.level][1]
+
+    @property
+    def quality(self) -> int:
+        return self.LEVELS[self.level][2]
+
+    def sent(self, mid: int, size: int):
+        now = time.monotonic()
+        with self._lock:
+            self._window_bytes += size
+            if mid in self._acked_before_sent:
+                # acknowledged by the network thread before publish returned
+                self._acked_before_sent.discard(mid)
+                self._window_latencies.append(0.0)
+            else:
+                self._inflight[mid] = now
+
+    def acked(self, mid: int):
+        now = time.monotonic()
+        with self._lock:
+            sent_at = self._inflight.pop(mid, None)
+            if sent_at is None:
+                self._acked_before_sent.add(mid)
+            else:
+                self._window_latencies.append(now - sent_at)
+
+    def keep_image(self, index: int) -> bool:
+        return index % self.image_interval == 0
+
+    def update(self):
+        """
+        Choose the level of the next window once the current one is over.
+        """
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.window:
+            return
+        with self._lock:
+            self.bandwidth = self._window_bytes / elapsed
+            latencies = self._window_latencies + [now - t for t in self._inflight.values()]
+            self.latency = max(latencies) if latencies else 0.0
+            inflight = len(self._inflight)
+            self._window_bytes = 0
+            self._window_latencies = []
+            self._window_start = now
+
+        if (self.bandwidth > self.target_bandwidth or inflight > self.max_inflight
+                or self.latency > self.max_latency):
+            if self.level < len(self.LEVELS) - 1:
+                self.level += 1
+                logger.info('Link overloaded (%.0f B/s, %s in flight, %.0f ms), degrade images to level %s',
+                            self.bandwidth, inflight, self.latency * 1000, self.level)
+        elif (self.level > 0 and self.bandwidth < self.target_bandwidth / 2 and inflight <= self.max_inflight / 2
+              and self.latency < self.max_latency / 2):
+            self.level -= 1
+            logger.info('Link has room (%.0f B/s), restore images to level %s', self.bandwidth, self.level)
+
+
+class _EncodingWriter:
+    """
+    Write values to a channel once their images are encoded, in publication order.
+
+    uint8 arrays are encoded by the shared encoder of the process, so the mqtt child process receives the JPEG
+    bytes already produced for the tub and the video stream instead of encoding the frame again. Values are
+    written by the encoder threads when their images are ready: the drive loop never waits for an encoding. At most
+    `max_pending` values wait for their images, beyond that the oldest ones are dropped and counted in `dropped`.
+    """
+
+    def __init__(self, channel: DropOldestChannel, max_pending=4):
+        self.channel = channel
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending = deque()
+        self._lock = Lock()
+
+    def put(self, values: Dict[str, Any]):
+        images = []
+        for key, val in values.items():
+            if isinstance(val, numpy.ndarray) and val.dtype == numpy.uint8:
+                cache_key = frame_key(key, values.get(CAM_FRAME_ID)) if key == CAM_IMAGE else None
+                images.append((key, shared_encoder().submit(val, key=cache_key)))
+        with self._lock:
+            self._pending.append((values, images))
+            if len(self._pending) > self.max_pending:
+                self._pending.popleft()
+                self.dropped += 1
+        for _, future in images:
+            future.add_done_callback(self._write_ready)
+        self._write_ready()
+
+    def _write_ready(self, _=None):
+        with self._lock:
+            while self._pending and all(future.done() for _, future in self._pending[0][1]):
+                values, images = self._pending.popleft()
+                if images:
+                    values = dict(values)
+                    for key, future in images:
+                        try:
+                            values[key] = future.result()
+                        except Exception:
+                            logger.exception('Unable to encode %s', key)
+                            del values[key]
+                self.channel.put(values)
+
+
 class MultiProcessingMetringPublisher(MetricsPublisher):
+    """
+    Publish metrics from a child process.
+
+    Values go through a bounded channel in shared memory: the drive loop never waits for the mqtt process, when the
+    channel is full the oldest values are dropped.
+
+    Images are encoded in the vehicle process (see `_EncodingWriter`), where their encoding is shared with the other
+    consumers of the frame. With `target_bandwidth`, raw images are sent to the child that downsamples them.
+    """
 
     def __init__(self, topic: str = 'car', client_id: str = 'test', mqtt_address: Tuple[str, int] = ('localhost', 1883),
-                 mqtt_user: str = 'guest', mqtt_password: str = 'guest', qos=0) -> None:
-        self.queue = Queue()
+                 mqtt_user: str = 'guest', mqtt_password: str = 'guest', qos=0, channel_slots=4,
+                 channel_slot_size=1024 * 1024, wire_format=WIRE_FORMAT_JSON, batch_size=1,
+                 batch_interval_ms=None, target_bandwidth=None, include_keys=DEFAULT_INCLUDE_KEYS,
+                 exclude_keys=DEFAULT_EXCLUDE_KEYS, key_rates=None) -> None:
+        # applied by the vehicle before values are copied to the channel
+        self.projection = KeyProjection(include=include_keys, exclude=exclude_keys, rates=key_rates)
+        self.channel = DropOldestChannel(slots=channel_slots, slot_size=channel_slot_size)
+        self._writer = None if target_bandwidth else _EncodingWriter(self.channel, max_pending=channel_slots)
+        self._recording = True
         self._process = Process(target=run_process,
-                                args=(self.queue, topic, client_id, mqtt_address, mqtt_user, mqtt_password, qos))
+                                args=(self.channel, topic, client_id, mqtt_address, mqtt_user, mqtt_password, qos,
+                                      wire_format, batch_size, batch_interval_ms, target_bandwidth))
+        self._process.daemon = True
         self._process.start()
 
     def publish(self, values: Dict[str, Any]):
         logger.debug("Put message %s", values)
-        self.queue.put(values, block=True)
+        self._recording = _is_recording(values)
+        if self._writer is None or not self._recording:
+            # the child doesn't publish records that are not recorded, don't encode their images
+            self.channel.put(values)
+            return
+        self._writer.put(values)
+
+    def is_watched(self, keys: Iterable[str] = None) -> bool:
+        return self._recording and super().is_watched(keys)
 
     def shutdown(self):
-        self.queue.close()
+        logger.info('Metrics sent: %s, dropped: %s, oversized: %s',
+                    self.channel.sent, self.channel.dropped + (self._writer.dropped if self._writer else 0),
+                    self.channel.oversized)
         self._process.terminate()
 
 
-def run_process(queue: Queue, topic: str, client_id: str, mqtt_address: Tuple[str, int], mqtt_user: str,
-                mqtt_password: str, qos: int):
+def run_process(channel: DropOldestChannel, topic: str, client_id: str, mqtt_address: Tuple[str, int],
+                mqtt_user: str, mqtt_password: str, qos: int, wire_format: str = WIRE_FORMAT_JSON,
+                batch_size: int = 1, batch_interval_ms: int = None, target_bandwidth: float = None):
     try:
         publisher = MqttMetricsPublisher(topic=topic, client_id=client_id, hostname=mqtt_address[0],
                                          port=mqtt_address[1],
                                          username=mqtt_user, password=mqtt_password,
-                                         qos=qos)
+                                         qos=qos, wire_format=wire_format, batch_size=batch_size,
+                                         batch_interval_ms=batch_interval_ms, target_bandwidth=target_bandwidth)
         while True:
             logger.debug('Wait message')
-            metrics = queue.get(block=True)
+            metrics = channel.get(timeout=1.0)
+            if metrics is None:
+                publisher.flush(force=False)
+                continue
             logger.debug("Receive msg %s", metrics)
 
             publisher.publish(metrics)
@@ -67,19 +261,52 @@ def run_process(queue: Queue, topic: str, client_id: str, mqtt_address: Tuple[st
 
 
 class MqttMetricsPublisher(MetricsPublisher):
+    """
+    Publish records and their images to a mqtt broker.
+
+    With the `json` wire format, messages are JSON documents and images are base64 encoded. The `binary` format
+    (see `donkeycar.wire`) sends raw JPEG bytes and packed record fields.
+
+    With `batch_size` > 1 or `batch_interval_ms`, records and images are accumulated and sent in one batch message
+    on the `<topic>/batch` topic when `batch_size` records are pending or the oldest one is `batch_interval_ms` old.
+    Each message of the batch keeps its own headers (tub name, index...).
+
+    With `target_bandwidth` (bytes/s), images are downsampled when the link is overloaded (see
+    `AdaptiveDownsampler`).
+
+    Published keys are selected by `include_keys`, `exclude_keys` and `key_rates` (see `KeyProjection`); uint8
+    arrays among them are sent as JPEG images.
+    """
 
     def __init__(self, topic='car', hostname='localhost', port=1883,
-                 client_id="parts_publish", username=None, password=None, qos=1, publish_all_events=True):
+                 client_id="parts_publish", username=None, password=None, qos=1, publish_all_events=True,
+                 wire_format=WIRE_FORMAT_JSON, batch_size=1, batch_interval_ms=None, target_bandwidth=None,
+                 include_keys=DEFAULT_INCLUDE_KEYS, exclude_keys=DEFAULT_EXCLUDE_KEYS, key_rates=None):
+        if wire_format not in (WIRE_FORMAT_JSON, WIRE_FORMAT_BINARY):
+            raise ValueError('Unknown wire format {}'.format(wire_format))
+        self._wire_format = wire_format
+        self.projection = KeyProjection(include=include_keys, exclude=exclude_keys, rates=key_rates)
+        self._batch_interval = batch_interval_ms / 1000 if batch_interval_ms else None
+        self._batching = batch_size > 1 or self._batch_interval is not None
+        # Without size limit, batches are only flushed on interval
+        self._batch_size = batch_size if batch_size > 1 else float('inf')
+        self._batch = []
+        self._batch_records = 0
+        self._batch_start = 0.0
         self._qos = qos
         self._previous_mode = None
+        self._recording = True
         self.record_time = 0
         self.start_time = time.time()
         self._reset_tub_name()
+        self.downsampler = AdaptiveDownsampler(target_bandwidth) if target_bandwidth else None
 
         self._mqtt_client = mqtt.Client(client_id=client_id + "-", clean_session=False, userdata=None,
                                         protocol=mqtt.MQTTv311)
         if username:
             self._mqtt_client.username_pw_set(username=username, password=password)
+        if self.downsampler:
+            self._mqtt_client.on_publish = lambda client, userdata, mid: self.downsampler.acked(mid)
         self._mqtt_client.connect(hostname, port, 60)
         self._mqtt_client.loop_start()
         self._topic = topic
@@ -96,7 +323,35 @@ class MqttMetricsPublisher(MetricsPublisher):
 
     def publish(self, record):
         self.record_time = int(time.time() - self.start_time)
+        self._recording = _is_recording(record)
+        if self.downsampler:
+            self.downsampler.update()
         self._send_record(record)
+        if self._batching:
+            self.flush(force=False)
+
+    def flush(self, force=True):
+        """
+        Send pending batched messages; unless `force`, only when the batch is full or old enough.
+        """
+        if not self._batch:
+            return
+        if not force and self._batch_records < self._batch_size and (
+                self._batch_interval is None or time.monotonic() - self._batch_start < self._batch_interval):
+            return
+        if self._wire_format == WIRE_FORMAT_BINARY:
+            payload = wire.encode_batch(self._batch)
+        else:
+            payload = json.dumps({'content_type': wire.CONTENT_TYPE_BATCH,
+                                  'application_headers': {'count': len(self._batch)},
+                                  'payload': self._batch},
+                                 cls=NumpyEncoder)
+        self._batch = []
+        self._batch_records = 0
+        self._publish_payload(payload, topic=self._topic + '/batch')
+
+    def is_watched(self, keys: Iterable[str] = None) -> bool:
+        return self._recording and super().is_watched(keys)
 
     def _send_record(self, data):
         if CTRL_RECORD in data and not data[CTRL_RECORD]:
@@ -117,39 +372,75 @@ class MqttMetricsPublisher(MetricsPublisher):
             # Don't send event when autonomous drive not active
             return
 
+        images = []
+        downsampler = self.downsampler
+        # records keep flowing at full rate, only images are dropped when the link is overloaded
+        keep_images = downsampler is None or downsampler.keep_image(self._current_idx)
         for key, val in data.items():
 
             if isinstance(val, tuple):
                 json_data[key] = list(val)
             elif isinstance(val, bytes):
+                if not keep_images:
+                    json_data[wire.IMAGES_DROPPED] = True
+                    continue
                 name = self.make_file_name(key, ext='.jpg')
-                message = self._build_image_message(image_name=name, img_content=val, part=key)
                 json_data[key] = name
-                self._publish(message, topic=self._topic + "/image/" + key)
+                self._publish_image(image_name=name, img_content=val, part=key)
             elif isinstance(val, numpy.ndarray):
-                if key not in ['cam/image_array', 'img/road_ellipse']:
+                # keys are selected by the projection, other arrays than images (contours...) are not sent
+                if val.dtype != numpy.uint8:
                     continue
-                img_content = utils.arr_to_binary(val)
+                if not keep_images:
+                    json_data[wire.IMAGES_DROPPED] = True
+                    continue
+                cache_key = frame_key(key, data.get(CAM_FRAME_ID)) if key == CAM_IMAGE else None
+                quality = None
+                if downsampler is not None:
+                    quality = downsampler.quality
+                    if downsampler.scale != 1.0:
+                        val = cv2.resize(val, None, fx=downsampler.scale, fy=downsampler.scale,
+                                         interpolation=cv2.INTER_AREA)
+                        cache_key = cache_key and cache_key + (downsampler.scale,)
                 name = self.make_file_name(key, ext='.jpg')
-                message = self._build_image_message(image_name=name, img_content=img_content, part=key)
                 json_data[key] = name
-                self._publish(message, topic=self._topic + "/image/" + key)
+                # images of the record are encoded concurrently, or reused if the frame was already encoded
+                images.append((name, key, shared_encoder().submit(val, key=cache_key, quality=quality)))
             elif not val or isinstance(val, (str, float, int, bool, list)):
                 json_data[key] = val
 
             else:
                 logger.warning('Tub does not know what to do with this for key %s: %s', key, val)
                 return
-        msg = {
-            'content_type': 'application/json',
-            'application_headers': {
-                'name': self._get_json_record_name(),
-                'tub_name': self._tub_name,
-                'index': self._current_idx
-            },
-            'payload': json_data
+        for name, key, img_content in images:
+            self._publish_image(image_name=name, img_content=img_content.result(), part=key)
+        application_headers = {
+            'name': self._get_json_record_name(),
+            'tub_name': self._tub_name,
+            'index': self._current_idx
         }
+        if self._wire_format == WIRE_FORMAT_BINARY:
+            msg = wire.encode_record(application_headers, json_data)
+        else:
+            msg = {
+                'content_type': 'application/json',
+                'application_headers': application_headers,
+                'payload': json_data
+            }
         self._publish(message=msg, topic=self._topic + '/parts')
+        self._batch_records += 1
+
+    def _publish_image(self, image_name, part, img_content: bytes):
+        topic = self._topic + "/image/" + part
+        if self._wire_format == WIRE_FORMAT_BINARY:
+            application_headers = {'name': image_name,
+                                   'part': part,
+                                   'tub_name': self._tub_name,
+                                   'index': self._current_idx}
+            self._publish(wire.encode_image(application_headers, img_content), topic=topic)
+        else:
+            self._publish(self._build_image_message(image_name=image_name, img_content=img_content, part=part),
+                          topic=topic)
 
     def _build_image_message(self, image_name, part, img_content: bytes) -> Dict[str, Any]:
         return {'payload': base64.standard_b64encode(img_content).decode('utf-8'),
@@ -171,11 +462,26 @@ class MqttMetricsPublisher(MetricsPublisher):
         return name
 
     def _publish(self, message, topic):
-        self._mqtt_client.publish(payload=json.dumps(message, cls=NumpyEncoder), topic=topic,
-                                  qos=self._qos)
+        """
+        Publish a message, a JSON document or an encoded binary message, or add it to the pending batch.
+        """
+        if self._batching:
+            if not self._batch:
+                self._batch_start = time.monotonic()
+            self._batch.append(message)
+            return
+        if not isinstance(message, bytes):
+            message = json.dumps(message, cls=NumpyEncoder)
+        self._publish_payload(message, topic=topic)
+
+    def _publish_payload(self, payload, topic):
+        info = self._mqtt_client.publish(payload=payload, topic=topic, qos=self._qos)
+        if self.downsampler:
+            self.downsampler.sent(info.mid, len(payload))
 
     def shutdown(self):
         if self._mqtt_client:
+            self.flush()
             self._mqtt_client.loop_stop()
             self._mqtt_client.disconnect()
 
@@ -1,8 +1,11 @@
 from abc import ABC, abstractmethod
-from typing import List
+from typing import Iterable, List
 
 
 class Part(ABC):
+    # A sheddable part (debug overlays...) only runs when its outputs are watched or when the drive loop has
+    # enough time left before its deadline
+    sheddable = False
 
     @abstractmethod
     def run(self, **kw):
@@ -31,3 +34,16 @@ class ThreadedPart(Part):
     @abstractmethod
     def run_threaded(self, **kw):
         pass
+
+
+class Viewer(ABC):
+    """
+    Something exposing vehicle outputs to the outside world (video stream, telemetry...)
+    """
+
+    @abstractmethod
+    def is_watched(self, keys: Iterable[str] = None) -> bool:
+        """
+        Return True when someone is currently consuming one of the memory `keys`, or any output if None
+        """
+        pass
@@ -283,6 +283,7 @@ class RoadEllipsePart(Part):
 
 class RoadDebugPart(Part):
     IMG_ROAD = "img/road"
+    sheddable = True
 
     def run(self, road_shape: Shape, horizon: Tuple[Tuple[int, int], Tuple[int, int]], img: ndarray) \
             -> ndarray:
@@ -218,18 +218,18 @@ class ThresholdController(Part):
 
     def _threshold(self, img: ndarray) -> (ndarray, ndarray):
         img_horizon, img_debug = self._apply_horizon(img)
-        (_, binary_min) = cv2.threshold(img_horizon.copy(), self._config.limit_min, 255, 0, cv2.THRESH_BINARY)
-        (_, binary_max) = cv2.threshold(img_horizon.copy(), self._config.limit_max, 255, 0, cv2.THRESH_BINARY_INV)
+        (_, binary_min) = cv2.threshold(img_horizon, self._config.limit_min, 255, 0, cv2.THRESH_BINARY)
+        (_, binary_max) = cv2.threshold(img_horizon, self._config.limit_max, 255, 0, cv2.THRESH_BINARY_INV)
         return cv2.bitwise_xor(src1=binary_min, src2=binary_max), img_debug
 
     def _apply_horizon(self, img: ndarray):
         horizon = int(img.shape[0] * self._config.horizon)
         if horizon < 1:
-            return img.copy(), img.copy()
+            return img, img.copy()
 
         img_horizon = cv2.rectangle(img=img.copy(), pt1=(0, 0), pt2=(img.shape[1], horizon - 1),
                                     thickness=cv2.FILLED, color=(0,))
-        img_debug = cv2.cvtColor(img.copy(), cv2.COLOR_GRAY2RGB)
+        img_debug = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
         img_debug = cv2.line(img=img_debug, pt1=(0, horizon - 1), pt2=(img.shape[1], horizon - 1),
                              thickness=2, color=(0, 0, 250))
         return img_horizon, img_debug
@@ -289,7 +289,7 @@ class ThresholdValueEstimator(Part):
 
     def run(self, img_gray: ndarray) -> int:
         try:
-            (_, binary) = cv2.threshold(img_gray.copy(), self._config.centroid_value, 255, 0, cv2.THRESH_BINARY)
+            (_, binary) = cv2.threshold(img_gray, self._config.centroid_value, 255, 0, cv2.THRESH_BINARY)
             (shapes, centroids) = self._contours_detector.process_image(img_binarized=binary)
 
             if not centroids:
@@ -372,7 +372,7 @@ class ContourController(Part):
     def _process_contours(self, img_gray: ndarray) -> (ndarray, List[Centroid]):
         shapes, centroids = self._contours_detector.process_image(img_gray)
 
-        img = cv2.cvtColor(img_gray.copy(), cv2.COLOR_GRAY2RGB)
+        img = cv2.cvtColor(img_gray, cv2.COLOR_GRAY2RGB)
         for centroid in centroids:
             cv2.circle(img, centroid, 3, (0, 100, 100), 1)
 
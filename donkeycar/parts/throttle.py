@@ -217,12 +217,16 @@ class ThrottleEllipsePart(Part):
 
 
 class ThrottleDebugPart(Part):
+    sheddable = True
+
     def __init__(self, input_img_key: str):
         self._input_key = input_img_key
 
     def run(self, img, throttle):
         if not throttle:
             throttle = 0.0
+        # the input image can be a read-only camera frame
+        img = img.copy()
         y_pt1 = 50
         y_pt2 = 45
         green = 255
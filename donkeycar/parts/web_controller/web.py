@@ -13,18 +13,18 @@ import json
 import logging
 import os
 import time
-from typing import List
+from typing import Iterable, List
 
 import requests
 import tornado.gen
 import tornado.ioloop
 import tornado.web
 
+from donkeycar.jpeg import frame_key, shared_encoder
 from donkeycar.parts.arduino import DRIVE_MODE_USER
-from donkeycar.parts.camera import CAM_IMAGE
+from donkeycar.parts.camera import CAM_IMAGE, CAM_FRAME_ID
 from donkeycar.parts.mqtt import USER_MODE
-from donkeycar.parts.part import ThreadedPart
-from ... import utils
+from donkeycar.parts.part import ThreadedPart, Viewer
 
 RECORDING = 'recording'
 
@@ -100,7 +100,7 @@ class RemoteWebServer():
         return angle, throttle, drive_mode, recording
 
 
-class LocalWebController(tornado.web.Application, ThreadedPart):
+class LocalWebController(tornado.web.Application, ThreadedPart, Viewer):
 
     def __init__(self):
         """
@@ -136,18 +136,27 @@ class LocalWebController(tornado.web.Application, ThreadedPart):
         self.listen(self.port)
         tornado.ioloop.IOLoop.instance().start()
 
-    def run_threaded(self, img_arr=None, user_mode: str = DRIVE_MODE_USER):
-        self.img_arr = img_arr
+    def run_threaded(self, img_arr=None, user_mode: str = DRIVE_MODE_USER, frame_id=None):
+        self._set_frame(img_arr, frame_id)
         self.mode = user_mode
         return self.angle, self.throttle, self.mode, self.recording
 
-    def run(self, img_arr=None, user_mode: str = DRIVE_MODE_USER):
-        self.img_arr = img_arr
+    def run(self, img_arr=None, user_mode: str = DRIVE_MODE_USER, frame_id=None):
+        self._set_frame(img_arr, frame_id)
         self.mode = user_mode
         return self.recording
 
+    def _set_frame(self, img_arr, frame_id):
+        self.img_arr = img_arr
+        # read by the video handlers, the image and its cache key are replaced together
+        self.frame = (img_arr, frame_key(CAM_IMAGE, frame_id))
+
+    def is_watched(self, keys: Iterable[str] = None) -> bool:
+        # video clients only stream the camera image
+        return VideoStreamHandler.clients > 0 and (keys is None or CAM_IMAGE in keys)
+
     def get_inputs_keys(self) -> List[str]:
-        return [CAM_IMAGE, USER_MODE]
+        return [CAM_IMAGE, USER_MODE, CAM_FRAME_ID]
 
     def get_outputs_keys(self) -> List[str]:
         return [RECORDING]
@@ -175,7 +184,21 @@ class DriveAPI(tornado.web.RequestHandler):
             self.application.recording = data['recording']
 
 
-class VideoAPI(tornado.web.RequestHandler):
+class VideoStreamHandler(tornado.web.RequestHandler):
+    """
+    Base of the MJPEG handlers: `clients` counts the clients streaming from any of them.
+    """
+
+    clients = 0
+
+    def on_stream_start(self):
+        VideoStreamHandler.clients += 1
+
+    def on_stream_end(self):
+        VideoStreamHandler.clients -= 1
+
+
+class VideoAPI(VideoStreamHandler):
     """
     Serves a MJPEG of the images posted from the vehicle.
     """
@@ -189,23 +212,29 @@ class VideoAPI(tornado.web.RequestHandler):
 
         self.served_image_timestamp = time.time()
         my_boundary = "--boundarydonotcross"
-        while True:
-
-            interval = .1
-            if self.served_image_timestamp + interval < time.time():
-                img = utils.arr_to_binary(self.application.img_arr)
-
-                self.write(my_boundary)
-                self.write("Content-type: image/jpeg\r\n")
-                self.write("Content-length: %s\r\n\r\n" % len(img))
-                self.write(img)
-                self.served_image_timestamp = time.time()
-                yield tornado.gen.Task(self.flush)
-            else:
-                yield tornado.gen.Task(ioloop.add_timeout, ioloop.time() + interval)
-
-
-class VideoAPI2(tornado.web.RequestHandler):
+        self.on_stream_start()
+        try:
+            while True:
+
+                interval = .1
+                if self.served_image_timestamp + interval < time.time():
+                    # encoded once per frame whatever the number of clients, without blocking the ioloop
+                    img_arr, key = self.application.frame
+                    img = yield shared_encoder().submit(img_arr, key=key)
+
+                    self.write(my_boundary)
+                    self.write("Content-type: image/jpeg\r\n")
+                    self.write("Content-length: %s\r\n\r\n" % len(img))
+                    self.write(img)
+                    self.served_image_timestamp = time.time()
+                    yield tornado.gen.Task(self.flush)
+                else:
+                    yield tornado.gen.Task(ioloop.add_timeout, ioloop.time() + interval)
+        finally:
+            self.on_stream_end()
+
+
+class VideoAPI2(VideoStreamHandler):
     """
     Serves a MJPEG of the images posted from the vehicle.
     """
@@ -223,18 +252,22 @@ class VideoAPI2(tornado.web.RequestHandler):
 
         self.served_image_timestamp = time.time()
         my_boundary = "--boundarydonotcross"
-        while True:
-
-            interval = .1
-            if self.served_image_timestamp + interval < time.time():
-
-                img = utils.arr_to_binary(self._video_part.video_frame())
-
-                self.write(my_boundary)
-                self.write("Content-type: image/jpeg\r\n")
-                self.write("Content-length: %s\r\n\r\n" % len(img))
-                self.write(img)
-                self.served_image_timestamp = time.time()
-                yield tornado.gen.Task(self.flush)
-            else:
-                yield tornado.gen.Task(ioloop.add_timeout, ioloop.time() + interval)
+        self.on_stream_start()
+        try:
+            while True:
+
+                interval = .1
+                if self.served_image_timestamp + interval < time.time():
+
+                    img = yield shared_encoder().submit(self._video_part.video_frame())
+
+                    self.write(my_boundary)
+                    self.write("Content-type: image/jpeg\r\n")
+                    self.write("Content-length: %s\r\n\r\n" % len(img))
+                    self.write(img)
+                    self.served_image_timestamp = time.time()
+                    yield tornado.gen.Task(self.flush)
+                else:
+                    yield tornado.gen.Task(ioloop.add_timeout, ioloop.time() + interval)
+        finally:
+            self.on_stream_end()
@@ -19,9 +19,21 @@ CAR_PATH = PACKAGE_PATH = os.path.dirname(os.path.realpath(__file__))
 DATA_PATH = os.path.join(CAR_PATH, 'data')
 MODELS_PATH = os.path.join(CAR_PATH, 'models')
 
+# RECORDING
+# Write tub records from a background thread, dropping records when more than TUB_MAX_PENDING wait to be written
+TUB_ASYNC_WRITER = False
+TUB_MAX_PENDING = 100
+
 # VEHICLE
 DRIVE_LOOP_HZ = 20
 MAX_LOOPS = 100000
+# 'serial' or 'parallel' to run parts that share no data concurrently
+DRIVE_LOOP_SCHEDULER = 'serial'
+DRIVE_LOOP_WORKERS = 4
+# What to do when a loop misses its deadline: None, 'skip', 'shed' (drop debug parts) or 'degrade' (lower frequency)
+DRIVE_LOOP_OVERRUN_POLICY = None
+# Don't run parts whose outputs are neither read by another part nor published
+DRIVE_LOOP_PRUNE = False
 
 # CAMERA
 CAMERA_RESOLUTION = (128, 160)  # (height, width)
@@ -62,6 +74,14 @@ THROTTLE_STOP_ON_SHOCK = False
 # TRAINING
 BATCH_SIZE = 128
 TRAIN_TEST_SPLIT = 0.8
+# Threads loading the batches ahead of the training, 0 to load them in the training loop
+TRAIN_WORKERS = 0
+# Batches loaded in advance, None for twice TRAIN_WORKERS
+TRAIN_PREFETCH = None
+# MB of decoded images kept in memory between epochs (57 KB per 160x120 frame), None to decode them at each epoch
+TRAIN_IMAGE_CACHE_MB = None
+# Read images from the frames of the tubs converted with `donkey tubframes`
+TRAIN_USE_FRAMES = False
 
 # JOYSTICK
 USE_JOYSTICK_AS_DEFAULT = False
@@ -114,3 +134,15 @@ MQTT_PUBLISH_ALL_EVENTS = True
 MQTT_HOSTNAME = 'localhost'
 MQTT_PORT = 1883
 MQTT_QOS = 0
+# Wire format of the published messages: 'json' (base64 images) or 'binary' (raw jpeg and packed fields)
+MQTT_WIRE_FORMAT = 'json'
+# Send records in batches of MQTT_BATCH_SIZE records or every MQTT_BATCH_INTERVAL_MS ms, 1/None to disable
+MQTT_BATCH_SIZE = 1
+MQTT_BATCH_INTERVAL_MS = None
+# Downsample published images to keep the link under this bandwidth (bytes/s), None to always send full images
+MQTT_TARGET_BANDWIDTH = None
+# Published memory keys: patterns of included and excluded keys (keys explicitly included win over exclusions)
+# and max publishing rate (Hz) by key pattern
+MQTT_INCLUDE_KEYS = ['*', 'cam/image_array', 'img/road_ellipse']
+MQTT_EXCLUDE_KEYS = ['img/*']
+MQTT_KEY_RATES = {}
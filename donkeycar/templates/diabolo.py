@@ -27,7 +27,7 @@ class Diabolo(BaseVehicle):
         self.register(GpioMotor())
 
     def _configure_camera(self, cfg):
-        self.register(PiCamera(resolution=cfg.CAMERA_RESOLUTION, rotation=180))
+        self.register(PiCamera(resolution=cfg.CAMERA_RESOLUTION, rotation=180, frame_id=True))
 
     def _configure_arduino(self, cfg):
         pass
@@ -43,4 +43,8 @@ if __name__ == '__main__':
 
         # run the vehicle
         vehicle.start(rate_hz=cfg.DRIVE_LOOP_HZ,
-                      max_loop_count=cfg.MAX_LOOPS)
+                      max_loop_count=cfg.MAX_LOOPS,
+                      scheduler=cfg.DRIVE_LOOP_SCHEDULER,
+                      max_workers=cfg.DRIVE_LOOP_WORKERS,
+                      overrun_policy=cfg.DRIVE_LOOP_OVERRUN_POLICY,
+                      prune=cfg.DRIVE_LOOP_PRUNE)
@@ -2,12 +2,12 @@ import logging
 import platform
 from pathlib import Path
 
-from donkeycar import Vehicle
+from donkeycar import Vehicle, SlotMemory
 from donkeycar.parts.actuator import ANGLE, THROTTLE
 from donkeycar.parts.angle import PILOT_ANGLE, \
     AngleRoadPart, RoadEllipseDebugPart
 from donkeycar.parts.arduino import SerialPart, DRIVE_MODE_USER, DRIVE_MODE_LOCAL_ANGLE, USER_THROTTLE, USER_ANGLE
-from donkeycar.parts.camera import CAM_IMAGE
+from donkeycar.parts.camera import CAM_IMAGE, CAM_FRAME_ID
 from donkeycar.parts.keras2 import KerasPilot
 from donkeycar.parts.mqtt import MultiProcessingMetringPublisher
 from donkeycar.parts.mqtt import USER_MODE
@@ -30,8 +30,15 @@ class BaseVehicle(Vehicle):
                                                              mqtt_address=(cfg.MQTT_HOSTNAME, cfg.MQTT_PORT),
                                                              qos=cfg.MQTT_QOS,
                                                              mqtt_user=platform.node(),
-                                                             mqtt_password=platform.node())
-        super().__init__(metrics_publisher=mqtt_publisher)
+                                                             mqtt_password=platform.node(),
+                                                             wire_format=cfg.MQTT_WIRE_FORMAT,
+                                                             batch_size=cfg.MQTT_BATCH_SIZE,
+                                                             batch_interval_ms=cfg.MQTT_BATCH_INTERVAL_MS,
+                                                             target_bandwidth=cfg.MQTT_TARGET_BANDWIDTH,
+                                                             include_keys=cfg.MQTT_INCLUDE_KEYS,
+                                                             exclude_keys=cfg.MQTT_EXCLUDE_KEYS,
+                                                             key_rates=cfg.MQTT_KEY_RATES)
+        super().__init__(mem=SlotMemory(), metrics_publisher=mqtt_publisher)
         self._configure(cfg)
 
     def _configure(self, cfg):
@@ -44,10 +51,14 @@ class BaseVehicle(Vehicle):
         cfg.DRIVE_LOOP_HZ assuming each part finishes processing in a timely manner.
         Parts may have named outputs and inputs. The framework handles passing named outputs
         to parts requesting the same named input.
+
+        Image processing parts (road detection, pilot, debug images) only run when the camera delivered a new
+        frame, so `_configure_camera` must register a camera created with `frame_id=True`. The web controller,
+        throttle, actuators and indicators still run every tick.
         """
 
         self._configure_camera(cfg)
-        self.register(ComponentRoadPart2())
+        self.register(ComponentRoadPart2(), trigger=CAM_FRAME_ID)
 
         # This web controller will create a web server that is capable
         # of managing steering, throttle, and modes, and more.
@@ -103,7 +114,7 @@ class BaseVehicle(Vehicle):
 
     def _configure_angle_part(self, cfg):
         if 'keras' == cfg.ANGLE_ALGO:
-            self.register(KerasPilot(img_input=CAM_IMAGE, model_path=Path(cfg.KERAS_MODEL)))
+            self.register(KerasPilot(img_input=CAM_IMAGE, model_path=Path(cfg.KERAS_MODEL)), trigger=CAM_FRAME_ID)
         else:
-            self.register(AngleRoadPart())
-        self.register(RoadEllipseDebugPart())
+            self.register(AngleRoadPart(), trigger=CAM_FRAME_ID)
+        self.register(RoadEllipseDebugPart(), trigger=CAM_FRAME_ID)
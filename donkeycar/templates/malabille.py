@@ -25,7 +25,7 @@ class MalabilleCar(BaseVehicle):
         pass
 
     def _configure_camera(self, cfg):
-        self.register(ImageListCamera(path_mask='~/src/robocars/d2rd/data/tub_1_18-02-10/*.jpg'))
+        self.register(ImageListCamera(path_mask='~/src/robocars/d2rd/data/tub_1_18-02-10/*.jpg', frame_id=True))
 
     def _configure_arduino(self, cfg):
         pass
@@ -41,4 +41,8 @@ if __name__ == '__main__':
 
         # run the vehicle
         vehicle.start(rate_hz=cfg.DRIVE_LOOP_HZ,
-                      max_loop_count=cfg.MAX_LOOPS)
+                      max_loop_count=cfg.MAX_LOOPS,
+                      scheduler=cfg.DRIVE_LOOP_SCHEDULER,
+                      max_workers=cfg.DRIVE_LOOP_WORKERS,
+                      overrun_policy=cfg.DRIVE_LOOP_OVERRUN_POLICY,
+                      prune=cfg.DRIVE_LOOP_PRUNE)
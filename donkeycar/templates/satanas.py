@@ -39,7 +39,7 @@ class Satanas(BaseVehicle):
         self.register(throttle)
 
     def _configure_camera(self, cfg):
-        self.register(PiCamera(resolution=cfg.CAMERA_RESOLUTION))
+        self.register(PiCamera(resolution=cfg.CAMERA_RESOLUTION, frame_id=True))
 
     def _configure_indicators(self, cfg):
         self.register(UserModeIndicatorLight(pin_red=23, pin_green=24, pin_blue=25))
@@ -55,4 +55,8 @@ if __name__ == '__main__':
 
         # run the vehicle
         vehicle.start(rate_hz=cfg.DRIVE_LOOP_HZ,
-                      max_loop_count=cfg.MAX_LOOPS)
+                      max_loop_count=cfg.MAX_LOOPS,
+                      scheduler=cfg.DRIVE_LOOP_SCHEDULER,
+                      max_workers=cfg.DRIVE_LOOP_WORKERS,
+                      overrun_policy=cfg.DRIVE_LOOP_OVERRUN_POLICY,
+                      prune=cfg.DRIVE_LOOP_PRUNE)
@@ -105,7 +105,8 @@ def drive(cfg, model_path=None):
            'str']
     
     th = TubHandler(path=cfg.DATA_PATH)
-    tub = th.new_tub_writer(inputs=inputs, types=types)
+    tub = th.new_tub_writer(inputs=inputs, types=types,
+                            asynchronous=cfg.TUB_ASYNC_WRITER, max_pending=cfg.TUB_MAX_PENDING)
     V.add(tub, inputs=inputs, run_condition='recording')
     
     #run the vehicle for 20 seconds
@@ -133,10 +134,12 @@ def train(cfg, tub_names, model_name):
     print('tub_names', tub_names)
     if not tub_names:
         tub_names = os.path.join(cfg.DATA_PATH, '*')
-    tubgroup = TubGroup(tub_names)
+    tubgroup = TubGroup(tub_names, image_cache_mb=cfg.TRAIN_IMAGE_CACHE_MB, frames=cfg.TRAIN_USE_FRAMES)
     train_gen, val_gen = tubgroup.get_train_val_gen(X_keys, y_keys, record_transform=rt,
                                                     batch_size=cfg.BATCH_SIZE,
-                                                    train_frac=cfg.TRAIN_TEST_SPLIT)
+                                                    train_frac=cfg.TRAIN_TEST_SPLIT,
+                                                    workers=cfg.TRAIN_WORKERS,
+                                                    prefetch=cfg.TRAIN_PREFETCH)
 
     model_path = os.path.expanduser(model_name)
 
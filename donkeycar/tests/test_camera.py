@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from donkeycar.parts.camera import FrameBuffer, MockCamera
+from donkeycar.parts.throttle import ThrottleDebugPart
+
+
+def test_frame_buffer_empty():
+    assert FrameBuffer().read() == (None, 0, 0.0)
+
+
+def test_frame_buffer_read_only_view():
+    buffer = FrameBuffer()
+    frame = np.zeros((120, 160, 3), dtype=np.uint8)
+    buffer.put(frame)
+
+    view, seq, timestamp = buffer.read()
+
+    assert seq == 1
+    assert timestamp > 0
+    assert np.shares_memory(view, frame)
+    with pytest.raises(ValueError):
+        view[0, 0, 0] = 1
+
+
+def test_frame_buffer_sequence():
+    buffer = FrameBuffer()
+    for i in range(5):
+        buffer.put(np.full((2, 2), i))
+
+    view, seq, _ = buffer.read()
+
+    assert seq == 5
+    assert view[0, 0] == 4
+
+
+def test_mock_camera(img_black):
+    camera = MockCamera(image=img_black)
+    frame = camera.run_threaded()
+    assert not frame.flags.writeable
+    assert np.shares_memory(frame, img_black)
+    assert camera.get_outputs_keys() == ['cam/image_array']
+
+
+def test_mock_camera_with_frame_id(img_black):
+    camera = MockCamera(image=img_black, frame_id=True)
+    frame, frame_id = camera.run_threaded()
+    assert not frame.flags.writeable
+    assert np.shares_memory(frame, img_black)
+    assert frame_id == 1
+
+
+def test_debug_part_draws_on_copy_of_camera_frame():
+    camera = MockCamera(image=np.zeros((120, 160, 3), dtype=np.uint8))
+    frame = camera.run_threaded()
+    img = ThrottleDebugPart(input_img_key='cam/image_array').run(frame, 0.5)
+    assert img.any()
+    assert not frame.any()
+
+
+def test_camera_frame_id_only_changes_with_new_frame(img_black):
+    camera = MockCamera(image=img_black, frame_id=True)
+    _, first_id = camera.run_threaded()
+    _, same_id = camera.run_threaded()
+    camera.frame = img_black.copy()
+    _, new_id = camera.run_threaded()
+    assert first_id == same_id
+    assert new_id == first_id + 1
+    assert camera.get_outputs_keys() == ['cam/image_array', 'cam/frame_id']
@@ -0,0 +1,161 @@
+import base64
+import json
+import logging
+import os
+import time
+
+import numpy as np
+from paho.mqtt.client import MQTTMessage
+
+from car_consumer import Consumer, _record_type
+from donkeycar import utils, wire
+from donkeycar.parts.datastore import Tub, TubStore
+
+
+def _message(topic: str, payload: bytes) -> MQTTMessage:
+    msg = MQTTMessage(topic=topic.encode('utf-8'))
+    msg.payload = payload
+    return msg
+
+
+def _record_message(index: int, record: dict, tub_name='tub_1') -> MQTTMessage:
+    return _message('car/parts', json.dumps({'content_type': 'application/json',
+                                             'application_headers': {'name': 'record_{}.json'.format(index),
+                                                                     'tub_name': tub_name, 'index': index},
+                                             'payload': record}).encode('utf-8'))
+
+
+def _image_message(index: int, content: bytes) -> MQTTMessage:
+    return _message('car/image/cam/image_array',
+                    json.dumps({'content_type': 'image/jpeg',
+                                'application_headers': {'name': 'cam-image_array_{}_.jpg'.format(index),
+                                                        'part': 'cam/image_array', 'tub_name': 'tub_1',
+                                                        'index': index},
+                                'payload': base64.standard_b64encode(content).decode('utf-8')}).encode('utf-8'))
+
+
+def test_consumer_writes_records_and_images(tmpdir):
+    consumer = Consumer(tub_path_root=str(tmpdir), workers=2)
+    for ix in range(1, 4):
+        consumer.run(_record_message(ix, {'user/angle': ix / 10, 'cam/image_array': 'cam-image_array_{}_.jpg'
+                                          .format(ix)}))
+        consumer.run(_image_message(ix, b'jpeg' + bytes([ix])))
+    consumer.run(_message('car/parts', wire.encode_record({'tub_name': 'tub_1', 'index': 4}, {'user/angle': 0.4})))
+    # shutdown waits for the decoding workers before stopping the writer
+    consumer.shutdown()
+
+    store = TubStore(os.path.join(str(tmpdir), 'tub_1'))
+    catalog_index = store.catalog_index()
+    assert sorted(catalog_index) == [1, 2, 3, 4]
+    records = store.read_records(catalog_index, [1, 4])
+    assert records[0]['user/angle'] == 0.1
+    assert records[1] == {'user/angle': 0.4}
+    offset, length = store.images_index()[(2, 'cam/image_array')]
+    assert store.read(TubStore.IMAGES, offset, length) == b'jpeg\x02'
+    assert consumer.dropped == 0
+    store.close()
+
+
+def test_consumer_drops_messages_beyond_max_pending_bytes(tmpdir, caplog):
+    consumer = Consumer(tub_path_root=str(tmpdir), max_pending_bytes=1000)
+    # a large message waiting for decoding or writing
+    consumer._pending_bytes = 900
+    consumer.run(_record_message(1, {'user/angle': 0.1}))
+    consumer.run(_record_message(2, {'user/angle': 0.2}))
+    consumer._pending_bytes = 0
+    consumer.run(_record_message(3, {'user/angle': 0.3}))
+    consumer.shutdown()
+
+    assert consumer.dropped == 2
+    assert consumer._pending_bytes == 0
+    # drops are reported once until the next ingest report
+    assert len([r for r in caplog.records if r.levelno == logging.WARNING]) == 1
+    store = TubStore(os.path.join(str(tmpdir), 'tub_1'))
+    assert list(store.catalog_index()) == [3]
+    store.close()
+
+
+def test_consumer_reports_without_writes(tmpdir, caplog):
+    consumer = Consumer(tub_path_root=str(tmpdir), max_pending_bytes=1000, report_interval=0.01)
+    consumer._pending_bytes = 1000
+    consumer.run(_record_message(1, {'user/angle': 0.1}))
+    consumer._stopped.wait(0.1)
+    consumer._pending_bytes = 0
+    consumer.shutdown()
+
+    assert any(r.levelno == logging.WARNING and '1 dropped' in r.getMessage() for r in caplog.records)
+
+
+def test_consumer_writer_survives_write_errors(tmpdir, caplog):
+    consumer = Consumer(tub_path_root=str(tmpdir))
+    store = consumer._store
+
+    def failing_store(tub_name):
+        if tub_name == 'broken':
+            raise OSError('No space left on device')
+        return store(tub_name)
+
+    consumer._store = failing_store
+    consumer.run(_record_message(1, {'user/angle': 0.1}, tub_name='broken'))
+    deadline = time.monotonic() + 5
+    while consumer._pending_bytes and time.monotonic() < deadline:
+        time.sleep(0.01)
+    consumer.run(_record_message(2, {'user/angle': 0.2}))
+    consumer.shutdown()
+
+    assert consumer._pending_bytes == 0
+    assert any('Unable to write' in r.getMessage() for r in caplog.records)
+    store = TubStore(os.path.join(str(tmpdir), 'tub_1'))
+    assert list(store.catalog_index()) == [2]
+    store.close()
+
+
+def test_record_type():
+    assert _record_type('cam/image_array', 'cam-image_array_1_.jpg', []) == 'image_array'
+    assert _record_type('img/road', 'road.png', ['img/road']) == 'image_array'
+    assert _record_type('user/mode', 'user', []) == 'str'
+    assert _record_type('ctrl/record', True, []) == 'boolean'
+    assert _record_type('cam/frame_id', 3, []) == 'int'
+    assert _record_type('user/angle', 0.5, []) == 'float'
+    assert _record_type('road/contour', [[1, 2]], []) == 'list'
+
+
+def test_consumer_tub_round_trip(tmpdir, img_black):
+    consumer = Consumer(tub_path_root=str(tmpdir))
+    consumer.run(_record_message(1, {'user/angle': 0.5, 'user/mode': 'user',
+                                     'cam/image_array': 'cam-image_array_1_.jpg'}))
+    consumer.run(_image_message(1, utils.arr_to_binary(img_black)))
+    consumer.shutdown()
+    consumer = Consumer(tub_path_root=str(tmpdir))
+    # new keys of later records are added to the meta
+    consumer.run(_record_message(2, {'user/angle': -0.5, 'user/mode': 'local', 'ctrl/record': True}))
+    consumer.shutdown()
+
+    tub = Tub(os.path.join(str(tmpdir), 'tub_1'))
+    assert tub.inputs == ['user/angle', 'user/mode', 'cam/image_array', 'ctrl/record']
+    assert tub.types == ['float', 'str', 'image_array', 'boolean']
+    assert tub.get_num_records() == 2
+    record = tub.get_record(1)
+    assert record['user/angle'] == 0.5
+    assert record['user/mode'] == 'user'
+    np.testing.assert_array_equal(record['cam/image_array'], img_black)
+    assert tub.get_record(2) == {'user/angle': -0.5, 'user/mode': 'local', 'ctrl/record': True}
+
+
+def test_consumer_tub_skips_records_without_images(tmpdir, img_black):
+    consumer = Consumer(tub_path_root=str(tmpdir))
+    consumer.run(_record_message(1, {'user/angle': 0.1, 'cam/image_array': 'cam-image_array_1_.jpg'}))
+    consumer.run(_image_message(1, utils.arr_to_binary(img_black)))
+    # image dropped by the downsampler of the car
+    consumer.run(_record_message(2, {'user/angle': 0.2, wire.IMAGES_DROPPED: True}))
+    # image not selected by the key projection for this record
+    consumer.run(_record_message(3, {'user/angle': 0.3}))
+    consumer.shutdown()
+
+    tub = Tub(os.path.join(str(tmpdir), 'tub_1'))
+    assert tub.get_df()['user/angle'].tolist() == [0.1, 0.3]
+    X, Y = next(tub.get_train_gen(['cam/image_array'], ['user/angle'], batch_size=2))
+    assert X[0].shape == (2,) + img_black.shape
+    assert Y[0].tolist() == [0.1, 0.1]
+    record = next(tub.get_record_gen(shuffle=False))
+    np.testing.assert_array_equal(record['cam/image_array'], img_black)
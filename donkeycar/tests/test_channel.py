@@ -0,0 +1,90 @@
+import time
+from multiprocessing import Event, Process, Queue
+
+import numpy as np
+
+from donkeycar.channel import DropOldestChannel
+
+
+def test_channel_round_trip(img_black):
+    channel = DropOldestChannel(slots=2, slot_size=256 * 1024)
+    assert channel.put({'cam/image_array': img_black, 'user/mode': 'user', 'user/angle': 0.5})
+
+    values = channel.get(timeout=0.1)
+
+    assert values['user/mode'] == 'user'
+    assert values['user/angle'] == 0.5
+    assert values['cam/image_array'].dtype == img_black.dtype
+    np.testing.assert_array_equal(values['cam/image_array'], img_black)
+    assert channel.get(timeout=0.01) is None
+
+
+def test_channel_drop_oldest():
+    channel = DropOldestChannel(slots=2, slot_size=1024)
+    for i in range(5):
+        channel.put({'index': i})
+
+    assert channel.sent == 5
+    assert channel.dropped == 3
+    assert len(channel) == 2
+    assert channel.get(timeout=0)['index'] == 3
+    assert channel.get(timeout=0)['index'] == 4
+
+
+def test_channel_oversized():
+    channel = DropOldestChannel(slots=2, slot_size=1024)
+    assert not channel.put({'frame': np.zeros((120, 160, 3), dtype=np.uint8)})
+    assert channel.oversized == 1
+    assert len(channel) == 0
+
+
+def test_channel_pickles_object_arrays():
+    channel = DropOldestChannel(slots=2, slot_size=1024)
+    assert channel.put({'values': np.array(['a', None], dtype=object), 'index': 1})
+
+    values = channel.get(timeout=0)
+    assert values['index'] == 1
+    assert values['values'].tolist() == ['a', None]
+
+
+def test_channel_drops_unpicklable_values():
+    channel = DropOldestChannel(slots=2, slot_size=1024)
+    assert not channel.put({'callback': lambda: None})
+    assert channel.dropped == 1
+    assert channel.sent == 0
+
+
+def _hold_lock(channel: DropOldestChannel, locked):
+    channel._lock.acquire()
+    locked.set()
+    time.sleep(60)
+
+
+def test_channel_drops_values_when_reader_dies_holding_lock():
+    channel = DropOldestChannel(slots=2, slot_size=1024, lock_timeout=0.05)
+    locked = Event()
+    process = Process(target=_hold_lock, args=(channel, locked))
+    process.start()
+    assert locked.wait(timeout=5)
+    process.kill()
+    process.join(timeout=5)
+
+    assert not channel.put({'index': 1})
+    assert channel.dropped == 1
+    assert channel.sent == 0
+
+
+def _read_values(channel: DropOldestChannel, result: Queue):
+    values = channel.get(timeout=5)
+    result.put((values['index'], values['frame'].sum()))
+
+
+def test_channel_between_processes():
+    channel = DropOldestChannel(slots=2, slot_size=64 * 1024)
+    result = Queue()
+    process = Process(target=_read_values, args=(channel, result))
+    process.start()
+    channel.put({'index': 1, 'frame': np.ones((120, 160), dtype=np.uint16)})
+
+    assert result.get(timeout=5) == (1, 120 * 160)
+    process.join(timeout=5)
@@ -15,7 +15,7 @@ class MalabilleCar(BaseVehicle):
 
     def _configure_camera(self, cfg):
         base_path = str(os.path.join(Path(__file__).parent, '..', '..'))
-        self.register(ImageListCamera(path_mask=base_path + '/test_parts/*.jpg'))
+        self.register(ImageListCamera(path_mask=base_path + '/test_parts/*.jpg', frame_id=True))
 
     def _configure_arduino(self, cfg):
         pass
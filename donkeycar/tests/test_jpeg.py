@@ -0,0 +1,69 @@
+import numpy as np
+
+from donkeycar import utils
+from donkeycar.jpeg import JpegEncoder, frame_key
+
+
+def test_encode(img_black):
+    encoder = JpegEncoder()
+    assert encoder.encode(img_black) == utils.arr_to_binary(img_black)
+
+
+def _read_only(arr: np.ndarray) -> np.ndarray:
+    arr = arr.copy()
+    arr.setflags(write=False)
+    return arr
+
+
+def test_encode_once_per_frame(img_black):
+    encoder = JpegEncoder()
+    frame = _read_only(img_black)
+    first = encoder.encode(frame)
+    second = encoder.encode(frame)
+    assert first is second
+    assert encoder.encoded == 1
+    assert encoder.hits == 1
+
+
+def test_encode_writeable_buffer_every_time():
+    encoder = JpegEncoder()
+    buffer = np.zeros((4, 4, 3), dtype=np.uint8)
+    first = encoder.encode(buffer)
+    buffer[...] = 255
+    second = encoder.encode(buffer)
+    assert first != second
+    assert encoder.hits == 0
+
+
+def test_encode_once_per_key(img_black):
+    encoder = JpegEncoder()
+    encoder.encode(img_black, key=frame_key('cam/image_array', 1))
+    encoder.encode(img_black.copy(), key=frame_key('cam/image_array', 1))
+    encoder.encode(img_black.copy(), key=frame_key('cam/image_array', 2))
+    assert encoder.encoded == 2
+
+
+def test_frame_key_without_frame_id(img_black):
+    encoder = JpegEncoder()
+    assert frame_key('cam/image_array') is None
+    encoder.encode(img_black, key=frame_key('cam/image_array'))
+    encoder.encode(img_black, key=frame_key('cam/image_array'))
+    # writeable arrays without frame id are always encoded
+    assert encoder.encoded == 2
+
+
+def test_encode_per_quality(img_straight_line):
+    encoder = JpegEncoder()
+    low = encoder.encode(img_straight_line, quality=10)
+    high = encoder.encode(img_straight_line, quality=95)
+    assert encoder.encoded == 2
+    assert len(low) < len(high)
+
+
+def test_cache_size():
+    encoder = JpegEncoder(cache_size=2)
+    frames = [_read_only(np.full((4, 4, 3), i, dtype=np.uint8)) for i in range(3)]
+    for frame in frames:
+        encoder.encode(frame)
+    encoder.encode(frames[0])
+    assert encoder.encoded == 4
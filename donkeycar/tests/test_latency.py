@@ -0,0 +1,22 @@
+import pytest
+
+from donkeycar.latency import LatencyHistogram
+
+
+def test_empty_histogram():
+    assert LatencyHistogram().stats() == {}
+
+
+def test_rolling_window():
+    histogram = LatencyHistogram(size=100)
+    for _ in range(100):
+        histogram.add(1.)
+    for i in range(100):
+        histogram.add(i / 1000)
+
+    stats = histogram.stats()
+
+    assert histogram.count == 200
+    assert stats['p50'] == pytest.approx(49.5)
+    assert stats['p99'] == pytest.approx(98.01)
+    assert stats['max'] == pytest.approx(99.)
@@ -0,0 +1,60 @@
+import pytest
+
+import donkeycar as dk
+from donkeycar.memory import Memory, SlotMemory
+from donkeycar.parts.transform import Lambda
+
+
+@pytest.fixture(params=[Memory, SlotMemory])
+def mem(request):
+    return request.param()
+
+
+def test_put_get(mem):
+    mem.put(['a', 'b'], (1, 2))
+    mem.put(['c'], 3)
+    assert mem.get(['a', 'b', 'c', 'unknown']) == [1, 2, 3, None]
+    assert mem['a'] == 1
+    assert mem['b', 'c'] == [2, 3]
+
+
+def test_put_missing_outputs(mem):
+    with pytest.raises(IndexError):
+        mem.put(['a', 'b'], (1,))
+
+
+def test_reader_writer(mem):
+    write = mem.writer(['a', 'b'])
+    read = mem.reader(['b', 'a', 'c'])
+    write((1, 2))
+    assert tuple(read()) == (2, 1, None)
+    with pytest.raises(IndexError):
+        write((1,))
+
+
+def test_slot_memory_intern():
+    mem = SlotMemory()
+    assert mem.intern(['a', 'b']) == [0, 1]
+    assert mem.intern(['b', 'c']) == [1, 2]
+    assert mem.slot('c') == 2
+    mem['c'] = 'value'
+    assert mem.d == {'a': None, 'b': None, 'c': 'value'}
+
+
+def test_write_through_dict(mem):
+    mem.put(['a'], 1)
+    mem.d['a'] = 2
+    mem.d['b'] = 3
+    assert mem.get(['a', 'b']) == [2, 3]
+    assert mem.key_count() == 2
+    assert dict(mem.d) == {'a': 2, 'b': 3}
+
+
+def test_vehicle_with_slot_memory():
+    mem = SlotMemory()
+    v = dk.Vehicle(mem=mem)
+    v.register(Lambda(lambda: (1, 2), outputs=['a', 'b']))
+    v.register(Lambda(lambda a, b: a + b, inputs=['a', 'b'], outputs=['sum']))
+    assert mem.keys() == ['a', 'b', 'sum']
+    v.update_parts()
+    assert mem.get(['sum']) == [3]
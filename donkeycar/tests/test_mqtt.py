@@ -1,14 +1,20 @@
 import json
 import logging
+from queue import Queue
 from time import sleep
 from typing import Iterator
 
 import pytest
-from paho.mqtt.client import MQTTMessage
+from paho.mqtt.client import MQTTMessage, Client
 from paho.mqtt.subscribe import simple
 
+from donkeycar import utils
+from donkeycar.channel import DropOldestChannel
+from donkeycar.jpeg import frame_key, shared_encoder
 from donkeycar.parts.arduino import DRIVE_MODE_USER
-from donkeycar.parts.mqtt import MqttMetricsPublisher, MultiProcessingMetringPublisher
+from donkeycar.parts.camera import CAM_IMAGE, CAM_FRAME_ID
+from donkeycar.parts.mqtt import MqttMetricsPublisher, MultiProcessingMetringPublisher, AdaptiveDownsampler, \
+    _EncodingWriter
 from donkeycar.vehicle import MetricsPublisher
 
 logger = logging.getLogger(__name__)
@@ -35,3 +41,113 @@ class TestMultiProcessing:
 
         assert 'value' == payload['payload']['key']
         assert 'user' == payload['payload']['user/mode']
+
+
+class TestEncodingWriter:
+
+    def test_write_encoded_images_in_order(self, img_black):
+        channel = DropOldestChannel(slots=4, slot_size=256 * 1024)
+        writer = _EncodingWriter(channel)
+        writer.put({CAM_IMAGE: img_black, CAM_FRAME_ID: 1, 'index': 1})
+        writer.put({'index': 2})
+
+        first = channel.get(timeout=5)
+        assert first[CAM_IMAGE] == utils.arr_to_binary(img_black)
+        assert first[CAM_FRAME_ID] == 1
+        assert channel.get(timeout=5) == {'index': 2}
+        assert writer.dropped == 0
+
+    def test_share_encoding_with_other_consumers(self, img_black):
+        channel = DropOldestChannel(slots=4, slot_size=256 * 1024)
+        writer = _EncodingWriter(channel)
+        frame_id = id(channel)
+        writer.put({CAM_IMAGE: img_black, CAM_FRAME_ID: frame_id})
+        content = channel.get(timeout=5)[CAM_IMAGE]
+
+        # the tub writer and the video stream key the same frame the same way
+        hits = shared_encoder().hits
+        assert shared_encoder().encode(img_black.copy(), key=frame_key(CAM_IMAGE, frame_id)) == content
+        assert shared_encoder().hits == hits + 1
+
+    def test_drop_oldest_pending(self):
+        channel = DropOldestChannel(slots=4, slot_size=1024)
+        writer = _EncodingWriter(channel, max_pending=1)
+        with writer._lock:
+            # encoder threads and the drive loop wait while values are written
+            writer._pending.append(({'index': 0}, []))
+        writer.put({'index': 1})
+        assert writer.dropped == 1
+        assert channel.get(timeout=0) == {'index': 1}
+        assert len(channel) == 0
+
+
+class TestBatch:
+
+    @pytest.fixture(name='metrics')
+    def fixture_metrics_batch(self, mqtt_address: (str, int)) -> Iterator[MqttMetricsPublisher]:
+        mqtt_publisher = MqttMetricsPublisher(client_id='test_batch', hostname=mqtt_address[0],
+                                              port=mqtt_address[1], topic='test/batch', qos=1, batch_size=3)
+        yield mqtt_publisher
+        mqtt_publisher.shutdown()
+
+    def test_mqtt_batch(self, mqtt_address: (str, int), metrics: MqttMetricsPublisher):
+        messages = Queue()
+        subscriber = Client(client_id='test_batch_subscriber')
+        subscriber.on_message = lambda client, userdata, msg: messages.put(msg)
+        subscriber.connect(mqtt_address[0], mqtt_address[1])
+        subscriber.subscribe('test/batch/#', qos=1)
+        subscriber.loop_start()
+        sleep(1)
+
+        for i in range(3):
+            metrics.publish({'key': i, 'user/mode': DRIVE_MODE_USER})
+        message: MQTTMessage = messages.get(timeout=10)
+        subscriber.loop_stop()
+        subscriber.disconnect()
+        payload = json.loads(message.payload)
+
+        assert message.topic == 'test/batch/batch'
+
+        assert payload['application_headers']['count'] == 3
+        assert [m['application_headers']['index'] for m in payload['payload']] == [1, 2, 3]
+        assert [m['payload']['key'] for m in payload['payload']] == [0, 1, 2]
+
+
+class TestAdaptiveDownsampler:
+
+    def test_degrade_on_bandwidth(self):
+        downsampler = AdaptiveDownsampler(target_bandwidth=1000, window=0.01)
+        for mid in range(10):
+            downsampler.sent(mid, 500)
+            downsampler.acked(mid)
+        sleep(0.02)
+        downsampler.update()
+
+        assert downsampler.level == 1
+        assert downsampler.quality < AdaptiveDownsampler.LEVELS[0][2]
+
+    def test_degrade_on_inflight(self):
+        downsampler = AdaptiveDownsampler(target_bandwidth=10 ** 9, max_inflight=2, window=0.01)
+        for mid in range(3):
+            downsampler.sent(mid, 10)
+        sleep(0.02)
+        downsampler.update()
+
+        assert downsampler.inflight == 3
+        assert downsampler.level == 1
+
+    def test_restore_when_link_has_room(self):
+        downsampler = AdaptiveDownsampler(target_bandwidth=10 ** 9, window=0.01)
+        downsampler.level = 3
+        downsampler.acked(1)
+        downsampler.sent(1, 10)
+        sleep(0.02)
+        downsampler.update()
+
+        assert downsampler.inflight == 0
+        assert downsampler.level == 2
+
+    def test_keep_image(self):
+        downsampler = AdaptiveDownsampler(target_bandwidth=1000)
+        downsampler.level = 2
+        assert [downsampler.keep_image(i) for i in range(4)] == [True, False, True, False]
@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 import tempfile
+import time
 import unittest
-from donkeycar.parts.datastore import TubWriter, Tub
+from donkeycar.jpeg import frame_key, shared_encoder
+from donkeycar.parts.datastore import TubWriter, Tub, TubStore, TubIndex, ImageCache, FrameStore, convert_tub
+from donkeycar.management.tub import WebServer, TubApi, TubRecordApi, TubImageApi
+import json
 import os
+from unittest.mock import Mock
 
 import pytest
+from tornado.httputil import HTTPServerRequest
+from tornado.web import HTTPError
 
 #fixtures
-from .setup import tub, tub_path
+from .setup import tub, tub_path, create_sample_tub
 
 
 def test_tub_load(tub, tub_path):
@@ -50,6 +57,26 @@ class TestTubWriter(unittest.TestCase):
         tub = TubWriter(self.path, inputs=self.inputs, types=self.types)
         tub.run('will', 323, 'asdfasdf')
 
+    def test_tub_async(self):
+        tub = TubWriter(self.path, inputs=self.inputs, types=self.types, asynchronous=True)
+        for i in range(10):
+            tub.run('will', i, 'asdfasdf')
+        tub.shutdown()
+        assert tub.written == 10
+        assert tub.dropped == 0
+        assert Tub(self.path).get_num_records() == 10
+
+    def test_tub_async_overflow(self):
+        tub = TubWriter(self.path, inputs=self.inputs, types=self.types, asynchronous=True, max_pending=2)
+        # block the writer on its first record
+        tub.put_record = lambda record, put_record=tub.put_record: (time.sleep(0.2), put_record(record))
+        for i in range(10):
+            tub.run('will', i, 'asdfasdf')
+        tub.shutdown()
+        assert tub.dropped > 0
+        assert tub.written + tub.dropped == 10
+        assert Tub(self.path).get_num_records() == tub.written
+
     def test_make_paths_absolute(self):
         tub = Tub(self.path, inputs=['file_path'], types=['image'])
         rel_file_name = 'test.jpg'
@@ -58,3 +85,324 @@ class TestTubWriter(unittest.TestCase):
 
         assert abs_record_dict['file_path'] == os.path.join(self.path, rel_file_name)
 
+
+def test_tub_writer_shares_frame_encoding(tub_path, img_black):
+    tub = TubWriter(tub_path, inputs=['cam/image_array', 'cam/frame_id'], types=['image_array', 'int'])
+    frame_id = id(tub)
+    # already sent or streamed by another consumer
+    shared_encoder().encode(img_black.copy(), key=frame_key('cam/image_array', frame_id))
+    hits = shared_encoder().hits
+    tub.run(img_black, frame_id)
+
+    assert shared_encoder().hits == hits + 1
+    assert tub.get_num_records() == 1
+
+
+def test_tub_store_append(tub_path):
+    store = TubStore(tub_path)
+    store.write_meta(inputs=['cam/image_array', 'angle'], types=['image_array', 'float'])
+    for ix in range(1, 4):
+        store.append_image(ix, 'cam/image_array', b'jpeg%d' % ix)
+        store.append_record(ix, {'cam/image_array': '%d_cam-image_array_.jpg' % ix, 'angle': ix / 10})
+    store.flush()
+
+    reader = TubStore(tub_path)
+    catalog = reader.catalog_index()
+    images = reader.images_index()
+    assert TubStore.is_packed(tub_path)
+    assert sorted(catalog) == [1, 2, 3]
+    assert reader.read(TubStore.CATALOG, *catalog[2]) == b'{"cam/image_array": "2_cam-image_array_.jpg", "angle": 0.2}\n'
+    assert reader.read(TubStore.IMAGES, *images[(3, 'cam/image_array')]) == b'jpeg3'
+    store.close()
+    reader.close()
+
+
+def test_tub_store_not_flushed(tub_path):
+    store = TubStore(tub_path)
+    store.append_record(1, {'angle': 0.1})
+    assert TubStore(tub_path).catalog_index() == {}
+    store.close()
+
+
+def test_tub_packed_add_record(tub_path):
+    """Packed tub can save records and then retrieve them."""
+    import numpy as np
+    tub = Tub(tub_path, inputs=['cam/image_array', 'angle'], types=['image_array', 'float'], packed=True)
+    img_arr = np.zeros((120, 160, 3), dtype=np.uint8)
+    indexes = [tub.put_record({'cam/image_array': img_arr, 'angle': i / 10}) for i in range(5)]
+    tub.remove_record(indexes[1])
+
+    t = Tub(tub_path)
+    assert t.store is not None
+    assert t.get_index(shuffled=False) == [1, 3, 4, 5]
+    rec_out = t.get_record(indexes[2])
+    assert rec_out['angle'] == 0.2
+    assert rec_out['cam/image_array'].shape == (120, 160, 3)
+    assert len(t.get_df()) == 4
+    batch = next(t.get_batch_gen(['cam/image_array', 'angle'], batch_size=3))
+    assert batch['cam/image_array'].shape == (3, 120, 160, 3)
+    assert t.put_record({'cam/image_array': img_arr, 'angle': 1.}) > indexes[-1]
+
+
+def test_convert_tub(tub, tmpdir):
+    packed = convert_tub(tub.path, str(tmpdir.join('packed')))
+    assert packed.store is not None
+    assert packed.get_index(shuffled=False) == tub.get_index(shuffled=False)
+    for ix in tub.get_index(shuffled=False):
+        legacy_record = tub.get_record(ix)
+        packed_record = packed.get_record(ix)
+        assert packed_record['angle'] == legacy_record['angle']
+        assert (packed_record['cam/image_array'] == legacy_record['cam/image_array']).all()
+    assert list(packed.get_df().columns) == list(tub.get_df().columns)
+
+
+def test_tub_index(tub, monkeypatch):
+    """Tub opens and counts records from its index, check rebuilds it."""
+    tub.remove_record(3)
+    monkeypatch.setattr(os, 'walk', None)
+    t = Tub(tub.path)
+    assert t.get_num_records() == 9
+    assert t.get_index(shuffled=False) == [1, 2, 4, 5, 6, 7, 8, 9, 10]
+    assert t.get_last_ix() == 10
+    monkeypatch.undo()
+
+    os.unlink(t.get_json_record_path(5))
+    t.check()
+    assert Tub(tub.path).get_index(shuffled=False) == [1, 2, 4, 6, 7, 8, 9, 10]
+
+
+def test_tub_index_rebuilt(tub):
+    """Tub without index, written by a previous version, gets one."""
+    tub.shutdown()
+    os.unlink(os.path.join(tub.path, TubIndex.FILE))
+    assert Tub(tub.path).get_num_records() == 10
+    assert os.path.exists(os.path.join(tub.path, TubIndex.FILE))
+
+
+def test_tub_index_rebuilt_when_records_copied(tub):
+    """Tub rebuilds its index when record files were added or removed without it."""
+    import shutil
+    tub.shutdown()
+    # file timestamps can be as coarse as a clock tick
+    time.sleep(0.05)
+    shutil.copy(tub.get_json_record_path(10), tub.get_json_record_path(11))
+    os.unlink(tub.get_json_record_path(2))
+    t = Tub(tub.path)
+    assert t.get_index(shuffled=False) == [1, 3, 4, 5, 6, 7, 8, 9, 10, 11]
+    assert t.get_last_ix() == 11
+    assert not t.index._is_stale()
+
+
+def test_tub_df_cache(tub, monkeypatch):
+    """Tub only parses the records added since its catalog was cached."""
+    from donkeycar.parts import datastore
+    assert len(tub.get_df()) == 10
+    assert os.path.exists(os.path.join(tub.path, Tub.CATALOG_CACHE))
+    img = tub.get_record(1)['cam/image_array']
+    tub.put_record({'cam/image_array': img, 'angle': 0.5, 'throttle': 0.1})
+    tub.remove_record(2)
+
+    parsed = []
+    read_json_records = datastore.read_json_records
+    monkeypatch.setattr(datastore, 'read_json_records', lambda paths: parsed.extend(paths) or read_json_records(paths))
+    t = Tub(tub.path)
+    df = t.get_df()
+    assert parsed == [t.get_json_record_path(t.get_last_ix())]
+    assert len(df) == 10
+    assert df['angle'].iloc[-1] == 0.5
+    assert df['cam/image_array'].iloc[0] == os.path.join(tub.path, '1_cam-image_array_.jpg')
+
+
+
+def test_tub_df_cache_is_data_only(tub):
+    """Tub catalog cache is a JSON document, not executable on load."""
+    tub.get_df()
+    with open(os.path.join(tub.path, Tub.CATALOG_CACHE), 'r') as f:
+        cache = json.load(f)
+    assert cache['index'] == list(range(1, 11))
+    assert cache['columns']['angle'] == tub.get_df()['angle'].tolist()
+
+
+def test_tub_df_cache_invalidated_by_rebuilt_index(tub, monkeypatch):
+    """Tub parses all records again when its index was rebuilt, e.g. after records were rewritten by hand."""
+    from donkeycar.parts import datastore
+    tub.get_df()
+    with open(tub.get_json_record_path(4), 'r') as f:
+        record = json.load(f)
+    record['angle'] = 42.0
+    with open(tub.get_json_record_path(4), 'w') as f:
+        json.dump(record, f)
+    tub.check()
+
+    parsed = []
+    read_json_records = datastore.read_json_records
+    monkeypatch.setattr(datastore, 'read_json_records', lambda paths: parsed.extend(paths) or read_json_records(paths))
+    df = Tub(tub.path).get_df()
+    assert len(parsed) == 10
+    assert df['angle'].iloc[3] == 42.0
+
+
+def test_read_json_records_parallel(tub):
+    from donkeycar.parts.datastore import read_json_records
+    paths = [tub.get_json_record_path(ix) for ix in tub.get_index(shuffled=False)]
+    assert read_json_records(paths, chunk_size=3) == read_json_records(paths)
+
+
+def test_tub_record_gen_epochs(tub):
+    """Each epoch of the record generator is a permutation of the records."""
+    df = tub.get_df()
+    gen = tub.get_record_gen(df=df)
+    for _ in range(3):
+        epoch = [next(gen)['angle'] for _ in range(len(df))]
+        assert sorted(epoch) == sorted(df['angle'])
+    gen = tub.get_record_gen(shuffle=False, df=df.iloc[2:5])
+    assert [next(gen)['angle'] for _ in range(4)] == list(df['angle'].iloc[2:5]) + [df['angle'].iloc[2]]
+
+
+def test_tub_prefetch_batch_gen(tub):
+    """Prefetched batches are the same as the batches loaded by the consumer."""
+    keys = ['cam/image_array', 'angle']
+    expected = tub.get_batch_gen(keys, batch_size=4, shuffle=False)
+    prefetcher = tub.get_batch_gen(keys, batch_size=4, shuffle=False, workers=2)
+    for _ in range(5):
+        batch = next(prefetcher)
+        expected_batch = next(expected)
+        for key in keys:
+            assert batch[key].shape == expected_batch[key].shape
+            assert (batch[key] == expected_batch[key]).all()
+    assert prefetcher.batches == 5
+    assert prefetcher.starved <= 5
+    prefetcher.close()
+
+
+def test_tub_prefetch_batches_are_not_reused(tub):
+    """Batches kept by the consumer are not overwritten by later ones, even taken from several threads."""
+    from concurrent.futures import ThreadPoolExecutor
+    keys = ['cam/image_array', 'angle']
+    prefetcher = tub.get_batch_gen(keys, batch_size=3, shuffle=False, workers=2, prefetch=2)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        batches = list(executor.map(lambda _: next(prefetcher), range(20)))
+    prefetcher.close()
+
+    angles = sorted(tuple(batch['angle']) for batch in batches)
+    expected = tub.get_batch_gen(keys, batch_size=3, shuffle=False)
+    assert angles == sorted(tuple(next(expected)['angle']) for _ in range(20))
+    assert len(set(id(batch['cam/image_array']) for batch in batches)) == 20
+
+
+def test_tub_batch_gen_of_empty_selection(tub):
+    """Loading batches from no record fails instead of stopping silently."""
+    df = tub.get_df().iloc[:0]
+    with pytest.raises(ValueError):
+        tub.get_batch_gen(['angle'], df=df)
+    with pytest.raises(ValueError):
+        tub.get_batch_gen(['angle'], df=df, workers=2)
+
+
+def test_tub_image_cache(tub):
+    """Images are decoded once and evicted beyond the cache budget."""
+    t = Tub(tub.path, image_cache_mb=1)
+    img = t.get_record(1)['cam/image_array']
+    assert not img.flags.writeable
+    assert t.get_record(1)['cam/image_array'] is img
+    assert (img == tub.get_record(1)['cam/image_array']).all()
+    assert (t.image_cache.hits, t.image_cache.misses) == (1, 1)
+
+    t.image_cache = ImageCache(3 * img.nbytes)
+    for ix in t.get_index(shuffled=False):
+        t.get_record(ix)
+    assert len(t.image_cache) == 3
+    assert t.image_cache.nbytes == 3 * img.nbytes
+
+
+def test_tub_frames(tub):
+    """Tub serves images from its frame store."""
+    import numpy as np
+    FrameStore.build(tub, workers=2)
+    t = Tub(tub.path, frames=True)
+    frames = t.frame_stores[0].frames
+    assert frames.shape == (10, 120, 160, 3)
+    for ix in (1, 5):
+        img = t.get_record(ix)['cam/image_array']
+        assert not img.flags.writeable
+        assert np.shares_memory(img, frames)
+        assert (img == tub.get_record(ix)['cam/image_array']).all()
+    batch = next(t.get_batch_gen(['cam/image_array'], batch_size=4, shuffle=False))
+    assert (batch['cam/image_array'] == frames[:4]).all()
+
+
+def test_tub_frames_keep_index_fresh(tub):
+    tub.get_df()
+    FrameStore.build(tub, workers=2)
+    cache_mtime = os.path.getmtime(os.path.join(tub.path, Tub.CATALOG_CACHE))
+    time.sleep(0.05)
+
+    t = Tub(tub.path, frames=True)
+    assert not t.index._is_stale()
+    t.get_df()
+    assert os.path.getmtime(os.path.join(tub.path, Tub.CATALOG_CACHE)) == cache_mtime
+
+
+def test_tub_frames_not_converted(tub, caplog):
+    t = Tub(tub.path, frames=True)
+    assert t.frame_stores == ()
+    assert any('not converted to frames' in r.getMessage() for r in caplog.records)
+    assert t.get_record(1)['cam/image_array'].shape == (120, 160, 3)
+
+
+
+
+@pytest.fixture
+def tub_server(tmpdir):
+    legacy = create_sample_tub(str(tmpdir.join('legacy')), records=5)
+    convert_tub(legacy.path, str(tmpdir.join('packed')))
+    return WebServer(str(tmpdir), debug=False)
+
+
+def _call_api(server, handler_class, method='GET', body=b'', **path_kwargs):
+    request = HTTPServerRequest(method=method, uri='/', body=body, connection=Mock())
+    kwargs = {'data_path': server.data_path} if handler_class is TubApi else {}
+    handler = handler_class(server, request, **kwargs)
+    getattr(handler, method.lower())(**path_kwargs)
+    return handler, b''.join(handler._write_buffer)
+
+
+def _clips(server, tub_id):
+    return json.loads(_call_api(server, TubApi, tub_id=tub_id)[1].decode('utf-8'))['clips']
+
+
+def _delete_records(server, tub_id, ixs):
+    clips = [[ix for ix in clip if ix not in ixs] for clip in _clips(server, tub_id)]
+    _call_api(server, TubApi, method='POST', body=json.dumps({'clips': clips}).encode('utf-8'), tub_id=tub_id)
+
+
+def test_tub_api_list_packed_tub(tub_server):
+    assert _clips(tub_server, 'packed') == [[1, 2, 3, 4, 5]]
+
+
+def test_tub_api_delete_record_of_packed_tub(tub_server):
+    _delete_records(tub_server, 'packed', [3])
+
+    assert _clips(tub_server, 'packed') == [[1, 2], [4, 5]]
+    assert Tub(os.path.join(tub_server.data_path, 'packed')).get_index(shuffled=False) == [1, 2, 4, 5]
+    with pytest.raises(HTTPError):
+        _call_api(tub_server, TubRecordApi, tub_id='packed', ix='3')
+    with pytest.raises(HTTPError):
+        _call_api(tub_server, TubImageApi, tub_id='packed', ix='3')
+
+
+def test_tub_api_delete_record_of_legacy_tub(tub_server):
+    _delete_records(tub_server, 'legacy', [3])
+
+    tub_path = os.path.join(tub_server.data_path, 'legacy')
+    assert Tub(tub_path).get_index(shuffled=False) == [1, 2, 4, 5]
+    assert not os.path.exists(os.path.join(tub_path, '3_cam-image_array_.jpg'))
+
+
+def test_tub_api_read_record_and_image_of_packed_tub(tub_server):
+    record = json.loads(_call_api(tub_server, TubRecordApi, tub_id='packed', ix='2')[1].decode('utf-8'))
+    assert 'angle' in record
+    handler, content = _call_api(tub_server, TubImageApi, tub_id='packed', ix='2')
+    assert handler._headers['Content-Type'] == 'image/jpeg'
+    with open(os.path.join(tub_server.data_path, 'legacy', '2_cam-image_array_.jpg'), 'rb') as f:
+        assert content == f.read()
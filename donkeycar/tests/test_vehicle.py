@@ -1,9 +1,13 @@
 import logging
+import threading
+import time
 
 import pytest
 
 import donkeycar as dk
+from donkeycar.parts.part import Viewer
 from donkeycar.parts.transform import Lambda
+from donkeycar.vehicle import MetricsPublisher, KeyProjection, build_stages, SCHEDULER_PARALLEL, OVERRUN_SKIP, OVERRUN_SHED, OVERRUN_DEGRADE
 
 
 @pytest.fixture()
@@ -47,3 +51,339 @@ def test_vehicle_register_part(vehicle):
     assert len(vehicle.parts) == 2
     assert vehicle.parts[1]['inputs'] == ['input1']
     assert vehicle.parts[1]['outputs'] == ['output1']
+
+
+def test_vehicle_compile_plan(vehicle):
+    vehicle.start(rate_hz=20, max_loop_count=2)
+    assert len(vehicle.plan) == 1
+    assert vehicle.mem.get(['test_out']) == [1]
+
+
+def test_vehicle_run_condition():
+    v = dk.Vehicle()
+    v.register(Lambda(lambda: (False, 1), outputs=['enabled', 'value']))
+    v.register(Lambda(lambda value: value + 1, inputs=['value'], outputs=['disabled_out']), run_condition='enabled')
+    v.register(Lambda(lambda value: value + 1, inputs=['value'], outputs=['enabled_out']))
+    v.update_parts()
+    assert v.mem.get(['disabled_out', 'enabled_out']) == [None, 2]
+
+
+def test_vehicle_trigger():
+    v = dk.Vehicle()
+    calls = []
+
+    def process(image):
+        calls.append(image)
+        return image * 10
+
+    v.register(Lambda(process, inputs=['cam/image_array'], outputs=['processed']), trigger='cam/frame_id')
+
+    # no frame yet
+    v.update_parts()
+    assert calls == []
+
+    v.mem.put(['cam/image_array', 'cam/frame_id'], (1, 1))
+    v.update_parts()
+    v.update_parts()
+    assert calls == [1]
+    assert v.mem.get(['processed']) == [10]
+
+    v.mem.put(['cam/image_array', 'cam/frame_id'], (2, 2))
+    v.update_parts()
+    assert calls == [1, 2]
+    assert 'cam/frame_id' in v.plan[0].inputs
+
+
+def test_vehicle_report_missing_trigger(caplog):
+    v = dk.Vehicle()
+    v.register(Lambda(lambda image: image, inputs=['cam/image_array'], outputs=['processed']),
+               trigger='cam/frame_id')
+    v.compile()
+    assert any(r.levelno == logging.ERROR and 'cam/frame_id' in r.getMessage() for r in caplog.records)
+
+    caplog.clear()
+    v = dk.Vehicle()
+    v.register(Lambda(lambda: (1, 1), outputs=['cam/image_array', 'cam/frame_id']))
+    v.register(Lambda(lambda image: image, inputs=['cam/image_array'], outputs=['processed']),
+               trigger='cam/frame_id')
+    v.compile()
+    assert not [r for r in caplog.records if r.levelno == logging.ERROR]
+
+
+def test_vehicle_overhead_benchmark():
+    from donkeycar.benchmark import vehicle_overhead
+    overhead = vehicle_overhead(ticks=100, repeat=1)
+    baseline = vehicle_overhead(ticks=100, repeat=1, baseline=True)
+    logging.info('Vehicle overhead: %s us/tick, baseline loop: %s us/tick', overhead, baseline)
+    assert overhead > 0
+    assert baseline > 0
+
+
+def test_vehicle_plan_same_as_baseline_loop():
+    from donkeycar.benchmark import _bench_vehicle, baseline_update_parts
+    vehicle = _bench_vehicle(6)
+    vehicle.update_parts()
+    baseline = _bench_vehicle(6)
+    baseline_update_parts(baseline)
+    assert dict(vehicle.mem.d) == dict(baseline.mem.d)
+
+
+def test_build_stages():
+    v = dk.Vehicle()
+    cam = Lambda(lambda: 1, outputs=['cam'])
+    road = Lambda(lambda img: img, inputs=['cam'], outputs=['road'])
+    web = Lambda(lambda img: 0.5, inputs=['cam'], outputs=['user/angle'])
+    angle = Lambda(lambda road: road, inputs=['road'], outputs=['pilot/angle'])
+    # Overwrite a key read by `angle`: must wait for it
+    reset = Lambda(lambda: None, outputs=['road'])
+    for p in [cam, road, web, angle, reset]:
+        v.register(p)
+
+    stages = build_stages(v.compile())
+
+    assert [[s.part for s in stage] for stage in stages] == [[cam], [road, web], [angle], [reset]]
+
+
+def test_vehicle_parallel_scheduler():
+    v = dk.Vehicle()
+    # only passes if the 3 parts run at the same time, a serial run breaks the barrier
+    barrier = threading.Barrier(3, timeout=5)
+
+    def concurrent(value):
+        barrier.wait()
+        return value + 1
+
+    v.register(Lambda(lambda: 1, outputs=['value']))
+    for i in range(3):
+        v.register(Lambda(concurrent, inputs=['value'], outputs=['out{}'.format(i)]))
+    v.register(Lambda(lambda *values: sum(values), inputs=['out0', 'out1', 'out2'], outputs=['sum']))
+    v.compile(scheduler=SCHEDULER_PARALLEL)
+
+    v.update_parts()
+    v.stop()
+
+    assert v.mem.get(['sum']) == [6]
+    assert not barrier.broken
+
+
+def test_vehicle_latency_stats():
+    v = dk.Vehicle()
+    v.register(Lambda(lambda: time.sleep(0.01), outputs=['sleep']))
+    v.register(Lambda(lambda: time.sleep(0.01), outputs=['sleep']))
+    for _ in range(3):
+        v.update_parts()
+
+    stats = v.latency_stats()
+
+    assert list(stats.keys()) == ['Lambda', 'Lambda#2']
+    assert stats['Lambda']['p50'] >= 10
+    assert set(stats['Lambda#2'].keys()) == {'p50', 'p95', 'p99', 'max'}
+
+
+def test_vehicle_latency_sampling():
+    v = dk.Vehicle()
+    v.register(Lambda(lambda: 1, outputs=['one']))
+    v.latency_sampling = 4
+    for _ in range(8):
+        v.update_parts()
+    assert v.parts[0]['latency'].count == 2
+
+    v.latency_sampling = 0
+    for _ in range(8):
+        v.update_parts()
+    assert v.parts[0]['latency'].count == 2
+    assert v.mem.get(['one']) == [1]
+
+
+def _overloaded_vehicle():
+    v = dk.Vehicle()
+    # runs are counted by the latency histograms
+    v.latency_sampling = 1
+    v.register(Lambda(lambda: 1, outputs=['debug']), optional=True)
+    v.register(Lambda(lambda: time.sleep(0.03), outputs=['critical']))
+    return v
+
+
+def test_vehicle_deadline_overrun():
+    v = _overloaded_vehicle()
+    v.start(rate_hz=50, max_loop_count=4)
+    assert v.missed_deadlines == 5
+    assert v.sleep_time < 0
+
+
+def test_vehicle_overrun_skip():
+    v = _overloaded_vehicle()
+    start = time.monotonic()
+    v.start(rate_hz=50, max_loop_count=4)
+    elapsed_no_policy = time.monotonic() - start
+
+    v = _overloaded_vehicle()
+    start = time.monotonic()
+    v.start(rate_hz=50, max_loop_count=4, overrun_policy=OVERRUN_SKIP)
+
+    assert v.skipped_ticks >= 5
+    assert time.monotonic() - start > elapsed_no_policy
+
+
+def test_vehicle_overrun_shed():
+    v = _overloaded_vehicle()
+    v.start(rate_hz=50, max_loop_count=4, overrun_policy=OVERRUN_SHED)
+    assert v.shed_ticks == 5
+    # optional part only ran during the first tick
+    assert v.parts[0]['latency'].count == 1
+
+
+def test_vehicle_overrun_degrade():
+    v = _overloaded_vehicle()
+    v.start(rate_hz=50, max_loop_count=4, overrun_policy=OVERRUN_DEGRADE)
+    assert v.rate_hz < 50
+
+
+class DebugPart(Lambda):
+    sheddable = True
+
+
+class FakeViewer(Lambda, Viewer):
+    watched = False
+
+    def is_watched(self, keys=None) -> bool:
+        return self.watched
+
+
+def test_vehicle_sheddable_part():
+    v = dk.Vehicle()
+    v.latency_sampling = 1
+    viewer = FakeViewer(lambda: None)
+    v.register(viewer)
+    v.register(Lambda(lambda: time.sleep(0.03), outputs=['critical']))
+    debug = DebugPart(lambda: 1, outputs=['debug'])
+    v.register(debug)
+    assert v.parts[2]['optional']
+
+    # Loop is late, nobody watches the debug output
+    v.start(rate_hz=50, max_loop_count=2)
+    assert v.parts[2]['latency'].count == 0
+
+    viewer.watched = True
+    v.start(rate_hz=50, max_loop_count=2)
+    assert v.parts[2]['latency'].count == 3
+
+    # No deadline when parts are updated outside the drive loop
+    viewer.watched = False
+    v.update_parts()
+    assert v.parts[2]['latency'].count == 4
+
+
+class FakePublisher(MetricsPublisher):
+    def __init__(self):
+        self.values = []
+
+    def publish(self, values):
+        self.values.append(values)
+
+    def shutdown(self):
+        pass
+
+
+def test_vehicle_shed_parts_not_published():
+    publisher = FakePublisher()
+    publisher.projection = KeyProjection(exclude=['img/*'])
+    v = dk.Vehicle(metrics_publisher=publisher)
+    v.latency_sampling = 1
+    v.register(Lambda(lambda: time.sleep(0.03), outputs=['critical']))
+    v.register(DebugPart(lambda: 1, outputs=['img/debug']))
+    v.register(DebugPart(lambda: 1, outputs=['user/debug']))
+
+    # Loop is late: only the part with a published output keeps running
+    v.start(rate_hz=50, max_loop_count=2)
+    assert v.parts[1]['latency'].count == 0
+    assert v.parts[2]['latency'].count == 3
+
+
+def test_vehicle_watched_keys_follow_dependent_parts():
+    v = dk.Vehicle()
+    v.register(DebugPart(lambda: 1, outputs=['img/gray']))
+    v.register(Lambda(lambda img: img, inputs=['img/gray'], outputs=['img/blur']))
+    v.register(Lambda(lambda img: img, inputs=['img/blur'], outputs=['user/angle']))
+    v.register(DebugPart(lambda: 1, outputs=['img/debug']))
+    v.compile()
+    assert v.plan[0].watched_keys == ('img/blur', 'img/gray', 'user/angle')
+    assert v.plan[3].watched_keys == ('img/debug',)
+
+
+def _vehicle_with_debug_outputs(metrics_publisher=None):
+    v = dk.Vehicle(metrics_publisher=metrics_publisher)
+    v.register(Lambda(lambda: (1, 2), outputs=['cam', 'horizon']))
+    v.register(Lambda(lambda img: img, inputs=['cam'], outputs=['gray']))
+    v.register(Lambda(lambda img: img, inputs=['gray'], outputs=['blur']))
+    v.register(Lambda(lambda img: img, inputs=['cam'], outputs=['angle']))
+    v.register(Lambda(lambda angle: None, inputs=['angle']))
+    return v
+
+
+def test_vehicle_report_dead_parts():
+    v = _vehicle_with_debug_outputs()
+    v.compile()
+    assert v.dead_outputs == {'horizon', 'gray', 'blur'}
+    assert v.pruned == []
+    assert len(v.plan) == 5
+
+
+def test_vehicle_prune_dead_parts():
+    v = _vehicle_with_debug_outputs()
+    v.compile(prune=True)
+    v.update_parts()
+    assert v.pruned == ['Lambda#2', 'Lambda#3']
+    assert v.mem.get(['gray', 'blur', 'angle']) == [None, None, 1]
+
+
+def test_vehicle_prune_published_outputs():
+    v = _vehicle_with_debug_outputs(metrics_publisher=FakePublisher())
+    v.compile(prune=True)
+    assert v.pruned == []
+    assert v.dead_outputs == set()
+
+
+def test_key_projection():
+    projection = KeyProjection(include=['*', 'img/road_ellipse'], exclude=['img/*'])
+    assert projection.select(['cam/image_array', 'img/gray', 'img/road_ellipse', 'user/angle']) == \
+        ['cam/image_array', 'img/road_ellipse', 'user/angle']
+
+
+def test_key_projection_rates():
+    projection = KeyProjection(rates={'cam/*': 2})
+    published = []
+    for now in (0.0, 0.1, 0.4, 0.5, 0.9, 1.0):
+        values = {'cam/image_array': now, 'user/angle': now}
+        projection.limit_rates(values, now)
+        published.append(sorted(values))
+    assert published == [['cam/image_array', 'user/angle'], ['user/angle'], ['user/angle'],
+                          ['cam/image_array', 'user/angle'], ['user/angle'], ['cam/image_array', 'user/angle']]
+
+
+def test_vehicle_publish_projection():
+    publisher = FakePublisher()
+    publisher.projection = KeyProjection(exclude=['gray', 'blur'])
+    v = _vehicle_with_debug_outputs(metrics_publisher=publisher)
+    v.compile(prune=True)
+    v.update_parts()
+    v._publish_metrics(10)
+
+    assert v.pruned == ['Lambda#2', 'Lambda#3']
+    assert {k: v for k, v in publisher.values[0].items() if k in ('cam', 'horizon', 'angle', 'gray', 'blur')} == \
+        {'cam': 1, 'horizon': 2, 'angle': 1}
+
+
+def test_vehicle_publish_projection_of_loop_metrics():
+    publisher = FakePublisher()
+    publisher.projection = KeyProjection(exclude=['latency/*', 'sleep_time'], rates={'rate_htz': 1})
+    v = _vehicle_with_debug_outputs(metrics_publisher=publisher)
+    v.compile()
+    v.update_parts()
+    v._publish_metrics(10)
+    v._publish_metrics(10)
+
+    assert not [k for k in publisher.values[0] if k.startswith('latency/')]
+    assert 'sleep_time' not in publisher.values[0]
+    assert 'rate_htz' in publisher.values[0]
+    assert 'rate_htz' not in publisher.values[1]
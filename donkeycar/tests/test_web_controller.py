@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import pytest
 import json
-from donkeycar.parts.web_controller.web import LocalWebController
+from donkeycar.parts.web_controller.web import LocalWebController, VideoAPI, VideoAPI2
 
 
 @pytest.fixture
@@ -22,3 +22,15 @@ def test_json_output(server):
 
 
 
+
+
+def test_is_watched_by_any_video_handler(server):
+    assert not server.is_watched()
+    for handler_class in (VideoAPI, VideoAPI2):
+        handler = handler_class.__new__(handler_class)
+        handler.on_stream_start()
+        assert server.is_watched()
+        assert server.is_watched(['cam/image_array'])
+        assert not server.is_watched(['img/debug'])
+        handler.on_stream_end()
+        assert not server.is_watched()
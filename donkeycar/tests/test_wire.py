@@ -0,0 +1,50 @@
+import json
+
+import numpy
+
+from donkeycar import wire
+
+
+def test_record_round_trip():
+    headers = {'name': 'record_3.json', 'tub_name': '20180101_120000', 'index': 3}
+    payload = {'user/mode': 'user', 'user/angle': numpy.float32(0.5), 'user/throttle': 0.25, 'ctrl/record': True,
+               'pilot/angle': None, 'cam/frame_id': 42, 'road/contour': [[1, 2], [3, 4]]}
+
+    message = wire.encode_record(headers, payload)
+    assert wire.is_binary(message)
+
+    decoded = wire.decode(message)
+    assert decoded['content_type'] == 'application/json'
+    assert decoded['application_headers'] == headers
+    assert decoded['payload'] == {'user/mode': 'user', 'user/angle': 0.5, 'user/throttle': 0.25, 'ctrl/record': True,
+                                  'pilot/angle': None, 'cam/frame_id': 42, 'road/contour': [[1, 2], [3, 4]]}
+
+
+def test_image_round_trip():
+    headers = {'name': 'cam-image_array_3_.jpg', 'part': 'cam/image_array', 'tub_name': 'tub', 'index': 3}
+    jpeg = b'\xff\xd8\xff\xe0fake jpeg\xff\xd9'
+
+    decoded = wire.decode(wire.encode_image(headers, jpeg))
+
+    assert decoded['content_type'] == 'image/jpeg'
+    assert decoded['application_headers'] == headers
+    assert decoded['payload'] == jpeg
+
+
+def test_json_message_is_not_binary():
+    assert not wire.is_binary(json.dumps({'content_type': 'application/json'}).encode('utf-8'))
+
+
+def test_batch_round_trip():
+    records = [wire.encode_record({'name': 'record_{}.json'.format(i), 'tub_name': 'tub', 'index': i},
+                                  {'user/angle': i / 10}) for i in range(1, 4)]
+    image = wire.encode_image({'name': 'cam-image_array_3_.jpg', 'part': 'cam/image_array', 'tub_name': 'tub',
+                               'index': 3}, b'jpeg')
+
+    decoded = wire.decode(wire.encode_batch(records + [image]))
+
+    assert decoded['content_type'] == wire.CONTENT_TYPE_BATCH
+    assert decoded['application_headers'] == {'count': 4}
+    assert [m['application_headers']['index'] for m in decoded['payload']] == [1, 2, 3, 3]
+    assert decoded['payload'][1]['payload'] == {'user/angle': 0.2}
+    assert decoded['payload'][3]['payload'] == b'jpeg'
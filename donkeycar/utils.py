@@ -31,23 +31,23 @@ def scale(im, size=128):
     return im
 
 
-def img_to_binary(img: Image) -> bytes:
+def img_to_binary(img: Image, quality=75) -> bytes:
     '''
-    accepts: PIL image
+    accepts: PIL image, jpeg quality
     returns: binary stream (used to save to database)
     '''
     f = BytesIO()
-    img.save(f, format='jpeg')
+    img.save(f, format='jpeg', quality=quality)
     return f.getvalue()
 
 
-def arr_to_binary(arr: np.ndarray) -> bytes:
+def arr_to_binary(arr: np.ndarray, quality=75) -> bytes:
     '''
-    accepts: numpy array with shape (Hight, Width, Channels)
+    accepts: numpy array with shape (Hight, Width, Channels), jpeg quality
     returns: binary stream (used to save to database)
     '''
     img = arr_to_img(arr)
-    return img_to_binary(img)
+    return img_to_binary(img, quality=quality)
 
 
 def arr_to_img(arr: np.ndarray) -> Image:
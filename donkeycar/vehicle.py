@@ -7,17 +7,88 @@ Created on Sun Jun 25 10:44:24 2017
 """
 import logging
 import time
+from fnmatch import fnmatchcase
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
-from typing import Any, Dict
+from time import perf_counter
+from typing import Any, Dict, Iterable, List, Set, Tuple, Sequence
 
-from donkeycar.parts.part import Part, ThreadedPart
+from donkeycar.parts.part import Part, ThreadedPart, Viewer
+from .latency import LatencyHistogram
 from .memory import Memory
 
 logger = logging.getLogger(__name__)
 
-
-class MetricsPublisher(ABC):
+SCHEDULER_SERIAL = 'serial'
+SCHEDULER_PARALLEL = 'parallel'
+
+# What to do when a tick ends after its deadline
+# skip: wait for the next slot of the schedule, the missed ones are skipped
+OVERRUN_SKIP = 'skip'
+# shed: start next tick immediately without optional parts, until a tick meets its deadline
+OVERRUN_SHED = 'shed'
+# degrade: lower the loop frequency, it is restored step by step once ticks meet their deadline
+OVERRUN_DEGRADE = 'degrade'
+
+
+class KeyProjection:
+    """
+    Select the memory keys sent to a metrics publisher.
+
+    A key is published when it matches an `include` pattern and no `exclude` pattern (shell-style wildcards); keys
+    listed in `include` without wildcard are published even if an `exclude` pattern matches them. `rates` limits
+    the frequency (Hz) of the keys matching a pattern.
+    """
+
+    def __init__(self, include: Sequence[str] = ('*',), exclude: Sequence[str] = (), rates: Dict[str, float] = None):
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.rates = dict(rates or {})
+        self._explicit = set(k for k in self.include if not any(c in k for c in '*?['))
+        self._periods = {}
+        self._last_published = {}
+        self._selected = {}
+
+    def selects(self, key: str) -> bool:
+        selected = self._selected.get(key)
+        if selected is None:
+            selected = key in self._explicit or (any(fnmatchcase(key, p) for p in self.include)
+                                                 and not any(fnmatchcase(key, p) for p in self.exclude))
+            self._selected[key] = selected
+        return selected
+
+    def select(self, keys: Iterable[str]) -> List[str]:
+        return [k for k in keys if self.selects(k)]
+
+    def _period(self, key: str) -> float:
+        period = self._periods.get(key)
+        if period is None:
+            rates = [rate for pattern, rate in self.rates.items() if fnmatchcase(key, pattern)]
+            period = 1.0 / min(rates) if rates else 0.0
+            self._periods[key] = period
+        return period
+
+    def limit_rates(self, values: Dict[str, Any], now: float):
+        """
+        Remove from `values` the rate limited keys published less than a period ago.
+        """
+        if not self.rates:
+            return
+        last_published = self._last_published
+        for key in list(values):
+            period = self._period(key)
+            if not period:
+                continue
+            if now - last_published.get(key, float('-inf')) < period:
+                del values[key]
+            else:
+                last_published[key] = now
+
+
+class MetricsPublisher(Viewer):
+    # KeyProjection of the published keys, all public keys when None
+    projection = None
 
     @abstractmethod
     def publish(self, values: Dict[str, Any]):
@@ -27,6 +98,150 @@ class MetricsPublisher(ABC):
     def shutdown(self):
         pass
 
+    def is_watched(self, keys: Iterable[str] = None) -> bool:
+        return keys is None or bool(self.select_keys(keys))
+
+    def select_keys(self, keys: Iterable[str]) -> List[str]:
+        """
+        Return the memory keys this publisher needs among `keys`.
+        """
+        keys = [k for k in keys if isinstance(k, str) and not k.startswith('_')]
+        if self.projection is not None:
+            keys = self.projection.select(keys)
+        return keys
+
+
+class PlanStep:
+    """
+    A registered part compiled for the drive loop: the method to call and the memory accessors are resolved once
+    so that a tick does no lookup in the part entries.
+    """
+    __slots__ = ('part', 'name', 'optional', 'threaded', 'inputs', 'outputs', 'run', 'read_inputs',
+                 'write_outputs', 'run_condition', 'trigger', 'last_trigger', 'latency', 'check')
+
+    def __init__(self, entry: Dict[str, Any], mem: Memory):
+        p = entry['part']
+        self.part = p
+        self.name = entry['name']
+        self.optional = entry['optional']
+        self.threaded = bool(entry.get('thread'))
+        self.latency = entry['latency']
+        run_condition = entry.get('run_condition')
+        trigger = entry.get('trigger')
+        self.inputs = tuple(entry['inputs']) + tuple(k for k in (run_condition, trigger) if k)
+        self.outputs = tuple(entry['outputs'])
+        self.run = p.run_threaded if self.threaded else p.run
+        self.read_inputs = mem.reader(entry['inputs'])
+        self.write_outputs = mem.writer(entry['outputs'])
+        self.run_condition = mem.reader([run_condition]) if run_condition else None
+        self.trigger = mem.reader([trigger]) if trigger else None
+        self.last_trigger = None
+        # other condition than the run condition to run the part, None for most parts
+        self.check = self._trigger_changed if trigger else None
+
+    def _trigger_changed(self) -> bool:
+        # don't run again until the trigger value changes (a new camera frame...), outputs of the last run stay
+        # in memory
+        value = self.trigger()[0]
+        if value is None or value == self.last_trigger:
+            return False
+        self.last_trigger = value
+        return True
+
+    def __call__(self, timed=False):
+        # don't run if there is a run condition that is False
+        if self.run_condition is not None and not self.run_condition()[0]:
+            return
+        if self.check is not None and not self.check():
+            return
+
+        if timed:
+            start = perf_counter()
+            outputs = self.run(*self.read_inputs())
+            self.latency.add(perf_counter() - start)
+        else:
+            outputs = self.run(*self.read_inputs())
+
+        # save the output to memory
+        if outputs is not None:
+            self.write_outputs(outputs)
+
+
+class OptionalPlanStep(PlanStep):
+    """
+    Plan step of an optional part: it only runs when the vehicle allows its last measured duration or one of
+    `watched_keys` (its outputs and the outputs of parts depending on them) is watched.
+    """
+    __slots__ = ('allowed', '_check_trigger', 'watched_keys')
+
+    def __init__(self, entry: Dict[str, Any], mem: Memory, allowed):
+        super().__init__(entry, mem)
+        self.allowed = allowed
+        self.watched_keys = self.outputs
+        self._check_trigger = self.check
+        self.check = self._allowed_to_run
+
+    def _allowed_to_run(self) -> bool:
+        if not self.allowed(self.latency.last, self.watched_keys):
+            return False
+        return self._check_trigger is None or self._check_trigger()
+
+
+def find_dead_parts(plan: Tuple[PlanStep, ...], published_keys: Iterable[str] = ()) \
+        -> Tuple[List[PlanStep], Set[str]]:
+    """
+    Find parts whose outputs are all dead, and dead outputs of remaining parts.
+
+    An output is live when it is read by another live part (as input or run condition) or published. Parts without
+    outputs (actuators, recorders...), threaded parts and viewers work for the outside world and are always live.
+    """
+    published_keys = set(published_keys)
+    dead_parts = []
+    changed = True
+    while changed:
+        changed = False
+        live = [step for step in plan if step not in dead_parts]
+        for step in live:
+            if not step.outputs or step.threaded or isinstance(step.part, Viewer):
+                continue
+            consumed = set(published_keys)
+            for other in live:
+                if other is not step:
+                    consumed.update(other.inputs)
+            if not consumed.intersection(step.outputs):
+                dead_parts.append(step)
+                changed = True
+
+    consumed = set(published_keys)
+    for step in plan:
+        if step not in dead_parts:
+            consumed.update(step.inputs)
+    dead_keys = set(k for step in plan for k in step.outputs if k not in consumed)
+    return [step for step in plan if step in dead_parts], dead_keys
+
+
+def build_stages(plan: Tuple[PlanStep, ...]) -> List[Tuple[PlanStep, ...]]:
+    """
+    Group plan steps into stages whose steps share no data and can run concurrently.
+
+    A step depends on every previously registered step that writes a key it reads, or that reads or writes a key it
+    writes. Running stages in order gives the same memory state than running the plan serially.
+    """
+    levels = []
+    for i, step in enumerate(plan):
+        level = 0
+        for j in range(i):
+            previous = plan[j]
+            if (set(step.inputs) & set(previous.outputs)
+                    or set(step.outputs) & (set(previous.inputs) | set(previous.outputs))):
+                level = max(level, levels[j] + 1)
+        levels.append(level)
+
+    stages = [[] for _ in range(max(levels) + 1)] if levels else []
+    for step, level in zip(plan, levels):
+        stages[level].append(step)
+    return [tuple(stage) for stage in stages]
+
 
 class Vehicle:
     def __init__(self, mem=None, metrics_publisher: MetricsPublisher = None):
@@ -35,20 +250,48 @@ class Vehicle:
             mem = Memory()
         self.mem = mem
         self.parts = []
+        self.plan = None
+        self.stages = None
+        self.scheduler = SCHEDULER_SERIAL
+        self.max_workers = 4
+        self._executor = None
+        self._critical_plan = None
+        self._critical_stages = None
+        self._viewers = []
+        self._deadline = None
+        self.shedding = False
+        self.prune = False
+        self.pruned = []
+        self.dead_outputs = set()
         self.on = True
         self.threads = []
         self.metrics_publisher = metrics_publisher
+        self._published_keys = ()
+        self._read_published = tuple
+        self._memory_size = -1
         self.sleep_time = 0.0
-
-    def register(self, part: Part, run_condition=None):
+        self.loop_count = 0
+        self.rate_hz = None
+        self.missed_deadlines = 0
+        # parts are timed every `latency_sampling` ticks only, timing every run costs as much as the loop itself
+        self.latency_sampling = 16
+        self._ticks = 0
+        self.skipped_ticks = 0
+        self.shed_ticks = 0
+        self._period = None
+        self._on_time_ticks = 0
+
+    def register(self, part: Part, run_condition=None, optional=None, trigger=None):
         self.add(part=part,
                  inputs=part.get_inputs_keys(),
                  outputs=part.get_outputs_keys(),
                  threaded=isinstance(part, ThreadedPart),
-                 run_condition=run_condition)
+                 run_condition=run_condition,
+                 optional=part.sheddable if optional is None else optional,
+                 trigger=trigger)
 
     def add(self, part, inputs=None, outputs=None,
-            threaded=False, run_condition=None):
+            threaded=False, run_condition=None, optional=False, trigger=None):
         """
         Method to add a part to the vehicle drive loop.
 
@@ -62,6 +305,13 @@ class Vehicle:
             :param threaded : boolean
                 If a part should be run in a separate thread.
             :param run_condition:
+            :param optional : boolean
+                If the part can be shed: it then only runs when a viewer
+                consumes its outputs or when the loop has time left before
+                its deadline.
+            :param trigger : str
+                Channel name of a sequence number (e.g. `cam/frame_id`): the
+                part only runs when its value changed since the last run.
         """
 
         if outputs is None:
@@ -70,10 +320,20 @@ class Vehicle:
             inputs = []
         p = part
         logger.info('Adding part %s with inputs: %s and outputs: %s.', p.__class__.__name__, inputs, outputs)
+        self.mem.intern(list(outputs) + list(inputs) + [k for k in (run_condition, trigger) if k])
+
+        name = p.__class__.__name__
+        homonyms = len([e for e in self.parts if e['part'].__class__.__name__ == name])
+        if homonyms:
+            name = '{}#{}'.format(name, homonyms + 1)
         entry = {'part': p,
+                 'name': name,
                  'inputs': inputs,
                  'outputs': outputs,
-                 'run_condition': run_condition}
+                 'run_condition': run_condition,
+                 'trigger': trigger,
+                 'optional': optional,
+                 'latency': LatencyHistogram()}
 
         if threaded:
             t = Thread(target=part.update, args=())
@@ -81,8 +341,81 @@ class Vehicle:
             entry['thread'] = t
 
         self.parts.append(entry)
+        self.plan = None
+
+    def compile(self, scheduler=None, max_workers=None, prune=None):
+        """
+        Freeze registered parts into the execution plan used by the drive loop.
 
-    def start(self, rate_hz=10, max_loop_count=None):
+        Parts whose outputs are read by nobody are reported and, with `prune`, removed from the plan.
+        With the parallel scheduler, the plan is also split into stages of independent parts run on a thread pool.
+        A second plan without optional parts is used while the loop is shedding load.
+        """
+        if scheduler is not None:
+            if scheduler not in (SCHEDULER_SERIAL, SCHEDULER_PARALLEL):
+                raise ValueError('Unknown scheduler {}'.format(scheduler))
+            self.scheduler = scheduler
+        if max_workers is not None:
+            self.max_workers = max_workers
+        if prune is not None:
+            self.prune = prune
+
+        self.plan = tuple(OptionalPlanStep(entry, self.mem, self._allow_optional) if entry['optional']
+                          else PlanStep(entry, self.mem)
+                          for entry in self.parts)
+        self._report_dead_parts()
+        self._report_missing_triggers()
+        self._find_watched_keys()
+        self._viewers = [entry['part'] for entry in self.parts if isinstance(entry['part'], Viewer)]
+        if self.metrics_publisher:
+            self._viewers.append(self.metrics_publisher)
+        self._critical_plan = tuple(step for step in self.plan if not step.optional)
+        self.stages = self._critical_stages = None
+        if self.scheduler == SCHEDULER_PARALLEL:
+            self.stages = build_stages(self.plan)
+            self._critical_stages = build_stages(self._critical_plan)
+            for i, stage in enumerate(self.stages):
+                logger.info('Stage %s: %s', i, [step.name for step in stage])
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self.plan
+
+    def _report_missing_triggers(self):
+        # a trigger nobody writes is never set: the part would silently never run
+        outputs = {k for entry in self.parts for k in entry['outputs']}
+        for entry in self.parts:
+            if entry['trigger'] and entry['trigger'] not in outputs:
+                logger.error('Part %s is triggered by %s but no part outputs it, it only runs when this key is '
+                             'written outside of the drive loop', entry['name'], entry['trigger'])
+
+    def _find_watched_keys(self):
+        # an optional part is needed by a viewer of its outputs or of the outputs computed from them
+        for step in self.plan:
+            if not isinstance(step, OptionalPlanStep):
+                continue
+            keys = set(step.outputs)
+            for other in self.plan[self.plan.index(step) + 1:]:
+                if keys.intersection(other.inputs):
+                    keys.update(other.outputs)
+            step.watched_keys = tuple(sorted(keys))
+
+    def _report_dead_parts(self):
+        published_keys = []
+        if self.metrics_publisher:
+            published_keys = self.metrics_publisher.select_keys(k for step in self.plan for k in step.outputs)
+        dead_parts, self.dead_outputs = find_dead_parts(self.plan, published_keys)
+        self.pruned = [step.name for step in dead_parts] if self.prune else []
+
+        if self.dead_outputs:
+            logger.info('Outputs read by nobody: %s', sorted(self.dead_outputs))
+        if dead_parts and self.prune:
+            logger.info('Pruned parts: %s', self.pruned)
+            self.plan = tuple(step for step in self.plan if step not in dead_parts)
+        elif dead_parts:
+            logger.info('Parts that could be pruned: %s', [step.name for step in dead_parts])
+
+    def start(self, rate_hz=10, max_loop_count=None, scheduler=SCHEDULER_SERIAL, max_workers=4,
+              overrun_policy=None, prune=False):
         """
         Start vehicle's main drive loop.
 
@@ -99,11 +432,23 @@ class Vehicle:
         max_loop_count : int
             Maxiumum number of loops the drive loop should execute. This is
             used for testing the all the parts of the vehicle work.
+        scheduler : str
+            `serial` runs parts one after another in registration order,
+            `parallel` runs parts that share no inputs/outputs concurrently.
+        max_workers : int
+            Size of the thread pool used by the parallel scheduler.
+        overrun_policy : str
+            What to do when a tick misses its deadline: `skip`, `shed`,
+            `degrade` or None to start the next tick immediately.
+        prune : bool
+            Don't run parts whose outputs are neither read by another part
+            nor published.
         """
 
         try:
 
             self.on = True
+            self.compile(scheduler=scheduler, max_workers=max_workers, prune=prune)
 
             for entry in self.parts:
                 if entry.get('thread'):
@@ -114,57 +459,127 @@ class Vehicle:
             logger.info('Starting vehicle...')
             time.sleep(1)
 
-            loop_count = 0
+            self.loop_count = 0
+            self.rate_hz = rate_hz
+            self._period = 1.0 / rate_hz
+            deadline = time.monotonic() + self._period
             while self.on:
-                start_time = time.time()
-                loop_count += 1
+                self.loop_count += 1
+                self._deadline = deadline
 
                 self.update_parts()
-                self._publish_metrics(rate_hz)
+                self._publish_metrics(self.rate_hz)
 
                 # stop drive loop if loop_count exceeds max_loopcount
-                if max_loop_count and loop_count > max_loop_count:
+                if max_loop_count and self.loop_count > max_loop_count:
                     self.on = False
 
-                sleep_time = 1.0 / rate_hz - (time.time() - start_time)
-                self.sleep_time = sleep_time
-                if sleep_time > 0.0:
-                    time.sleep(sleep_time)
+                deadline = self._wait_next_tick(deadline, rate_hz, overrun_policy)
 
         except KeyboardInterrupt:
             pass
         finally:
+            self._deadline = None
             self.stop()
 
-    def update_parts(self):
+    def _wait_next_tick(self, deadline, rate_hz, overrun_policy):
         """
-        loop over all parts
+        Sleep until the deadline of the tick and return the deadline of the next one.
+
+        Deadlines are absolute on a monotonic clock so that the loop frequency doesn't drift.
         """
-        for entry in self.parts:
-            # don't run if there is a run condition that is False
-            run = True
-            if entry.get('run_condition'):
-                run_condition = entry.get('run_condition')
-                run = self.mem.get([run_condition])[0]
-                # print('run_condition', entry['part'], entry.get('run_condition'), run)
-
-            if run:
-                p = entry['part']
-                # get inputs from memory
-                inputs = self.mem.get(entry['inputs'])
-
-                # run the part
-                if entry.get('thread'):
-                    outputs = p.run_threaded(*inputs)
-                else:
-                    outputs = p.run(*inputs)
+        now = time.monotonic()
+        self.sleep_time = deadline - now
+
+        if self.sleep_time >= 0.0:
+            self._on_time_ticks += 1
+            self.shedding = False
+            nominal_period = 1.0 / rate_hz
+            if self._period > nominal_period and self._on_time_ticks >= self.rate_hz:
+                # a second without overrun, try a higher frequency
+                self._period = max(nominal_period, self._period / 1.25)
+                self.rate_hz = 1.0 / self._period
+                self._on_time_ticks = 0
+            time.sleep(self.sleep_time)
+            return deadline + self._period
+
+        self.missed_deadlines += 1
+        self._on_time_ticks = 0
+        logger.debug('Drive loop overrun: %.1f ms late', -self.sleep_time * 1000)
+
+        if overrun_policy == OVERRUN_SKIP:
+            missed = int((now - deadline) / self._period) + 1
+            self.skipped_ticks += missed
+            next_start = deadline + missed * self._period
+            time.sleep(max(0.0, next_start - time.monotonic()))
+            return next_start + self._period
+        if overrun_policy == OVERRUN_SHED:
+            self.shedding = True
+            self.shed_ticks += 1
+        elif overrun_policy == OVERRUN_DEGRADE:
+            self._period = min(self._period * 1.25, 4.0 / rate_hz)
+            self.rate_hz = 1.0 / self._period
+        elif overrun_policy is not None:
+            raise ValueError('Unknown overrun policy {}'.format(overrun_policy))
+        return now + self._period
+
+    def _allow_optional(self, cost: float, keys: Tuple[str, ...]) -> bool:
+        """
+        Optional parts run when they should end before the tick deadline, or when someone watches one of `keys`.
+        """
+        if self._deadline is None or time.monotonic() + cost < self._deadline:
+            return True
+        return any(viewer.is_watched(keys) for viewer in self._viewers)
 
-                # save the output to memory
+    def update_parts(self):
+        """
+        loop over all parts of the execution plan
+        """
+        if self.plan is None:
+            self.compile()
+        plan = self._critical_plan if self.shedding else self.plan
+        stages = self._critical_stages if self.shedding else self.stages
+        timed = bool(self.latency_sampling) and self._ticks % self.latency_sampling == 0
+        self._ticks += 1
+
+        if stages is None:
+            if timed:
+                for step in plan:
+                    step(True)
+                return
+            # same as calling each step, inlined: the call of a step costs as much as running a small part
+            for step in plan:
+                if step.run_condition is not None and not step.run_condition()[0]:
+                    continue
+                if step.check is not None and not step.check():
+                    continue
+                outputs = step.run(*step.read_inputs())
                 if outputs is not None:
-                    self.mem.put(entry['outputs'], outputs)
+                    step.write_outputs(outputs)
+            return
+
+        submit = self._executor.submit
+        for stage in stages:
+            futures = [submit(step, timed) for step in stage[1:]]
+            stage[0](timed)
+            for future in futures:
+                future.result()
+
+    def latency_stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Rolling p50/p95/p99/max run durations of each part, in milliseconds.
+        """
+        return {entry['name']: entry['latency'].stats() for entry in self.parts}
 
     def stop(self):
         logger.info('Shutting down vehicle and its parts...')
+        logger.info('Missed deadlines: %s/%s loops (skipped ticks: %s, shed ticks: %s)',
+                    self.missed_deadlines, self.loop_count, self.skipped_ticks, self.shed_ticks)
+        logger.info('Parts latency (ms):')
+        for name, stats in self.latency_stats().items():
+            if stats:
+                logger.info('  %-30s p50=%.2f p95=%.2f p99=%.2f max=%.2f', name,
+                            stats['p50'], stats['p95'], stats['p99'], stats['max'])
         for entry in self.parts:
             try:
                 entry['part'].shutdown()
@@ -172,11 +587,32 @@ class Vehicle:
                 logging.exception(e)
         if self.metrics_publisher:
             self.metrics_publisher.shutdown()
+        if self._executor:
+            self._executor.shutdown(wait=False)
+            self._executor = None
         logger.debug(self.mem.d)
 
     def _publish_metrics(self, rate_htz):
         if self.metrics_publisher:
-            metrics = dict([x for x in self.mem.d.items() if isinstance(x[0], str) and not x[0].startswith('_')])
+            memory_size = self.mem.key_count()
+            if memory_size != self._memory_size:
+                # keys are only added to memory, select published keys again when new ones appear
+                self._memory_size = memory_size
+                self._published_keys = tuple(self.metrics_publisher.select_keys(list(self.mem.keys())))
+                self._read_published = self.mem.reader(self._published_keys)
+            metrics = dict(zip(self._published_keys, self._read_published()))
             metrics['sleep_time'] = self.sleep_time
             metrics['rate_htz'] = rate_htz
+            metrics['missed_deadlines'] = self.missed_deadlines
+            if self.loop_count % max(int(rate_htz), 1) == 0:
+                # Percentiles are costly to compute, refresh them once a second
+                for name, stats in self.latency_stats().items():
+                    for stat, value in stats.items():
+                        metrics['latency/{}/{}'.format(name, stat)] = float(value)
+            projection = self.metrics_publisher.projection
+            if projection is not None:
+                # memory keys are already selected, loop and latency metrics are not
+                for key in [k for k in metrics if not projection.selects(k)]:
+                    del metrics[key]
+                projection.limit_rates(metrics, time.monotonic())
             self.metrics_publisher.publish(metrics)
@@ -0,0 +1,168 @@
+"""
+wire.py
+
+Compact binary envelope for the telemetry sent by the car, an alternative to JSON messages with base64 images.
+
+A message is the magic `DKT`, a version byte, a content type byte, the application headers fields and then either
+the record fields, the raw JPEG bytes or, for a batch, the length prefixed messages of the batch. Fields are a count
+followed by, for each field, its utf-8 key, a type code and the packed value.
+"""
+import json
+import struct
+from typing import Any, Dict, List, Tuple
+
+import numpy
+
+MAGIC = b'DKT'
+VERSION = 1
+
+CONTENT_TYPE_JSON = 'application/json'
+CONTENT_TYPE_JPEG = 'image/jpeg'
+CONTENT_TYPE_BATCH = 'application/vnd.donkeycar.batch'
+_CONTENT_TYPES = (CONTENT_TYPE_JSON, CONTENT_TYPE_JPEG, CONTENT_TYPE_BATCH)
+
+# Record field set when the images of a record were not published (link downsampling): such records are kept in
+# tubs as telemetry but can't be used for training
+IMAGES_DROPPED = 'tub/images_dropped'
+
+_ENVELOPE = struct.Struct('<3sBB')
+_COUNT = struct.Struct('<H')
+_KEY = struct.Struct('<B')
+_LENGTH = struct.Struct('<I')
+_INT = struct.Struct('<q')
+_FLOAT = struct.Struct('<d')
+
+# Type codes of the fields
+_NONE = b'n'
+_TRUE = b't'
+_FALSE = b'f'
+_INT_CODE = b'q'
+_FLOAT_CODE = b'd'
+_STR = b's'
+_JSON = b'j'
+
+
+def _encode_fields(fields: Dict[str, Any], out: bytearray):
+    out += _COUNT.pack(len(fields))
+    for key, value in fields.items():
+        key = key.encode('utf-8')
+        out += _KEY.pack(len(key))
+        out += key
+        if isinstance(value, numpy.generic):
+            value = value.item()
+        if value is None:
+            out += _NONE
+        elif value is True:
+            out += _TRUE
+        elif value is False:
+            out += _FALSE
+        elif isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+            out += _INT_CODE + _INT.pack(value)
+        elif isinstance(value, float):
+            out += _FLOAT_CODE + _FLOAT.pack(value)
+        elif isinstance(value, str):
+            value = value.encode('utf-8')
+            out += _STR + _LENGTH.pack(len(value)) + value
+        else:
+            value = json.dumps(value, default=_to_json).encode('utf-8')
+            out += _JSON + _LENGTH.pack(len(value)) + value
+
+
+def _to_json(obj):
+    if isinstance(obj, numpy.ndarray):
+        return obj.tolist()
+    if isinstance(obj, numpy.generic):
+        return obj.item()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+def _decode_fields(data: memoryview, offset: int) -> Tuple[Dict[str, Any], int]:
+    count, = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+    fields = {}
+    for _ in range(count):
+        key_length, = _KEY.unpack_from(data, offset)
+        offset += _KEY.size
+        key = bytes(data[offset:offset + key_length]).decode('utf-8')
+        offset += key_length
+        code = bytes(data[offset:offset + 1])
+        offset += 1
+        if code == _NONE:
+            value = None
+        elif code == _TRUE:
+            value = True
+        elif code == _FALSE:
+            value = False
+        elif code == _INT_CODE:
+            value, = _INT.unpack_from(data, offset)
+            offset += _INT.size
+        elif code == _FLOAT_CODE:
+            value, = _FLOAT.unpack_from(data, offset)
+            offset += _FLOAT.size
+        elif code in (_STR, _JSON):
+            length, = _LENGTH.unpack_from(data, offset)
+            offset += _LENGTH.size
+            value = bytes(data[offset:offset + length]).decode('utf-8')
+            offset += length
+            if code == _JSON:
+                value = json.loads(value)
+        else:
+            raise ValueError('Unknown type code {} for field {}'.format(code, key))
+        fields[key] = value
+    return fields, offset
+
+
+def encode_record(application_headers: Dict[str, Any], payload: Dict[str, Any]) -> bytes:
+    out = bytearray(_ENVELOPE.pack(MAGIC, VERSION, _CONTENT_TYPES.index(CONTENT_TYPE_JSON)))
+    _encode_fields(application_headers, out)
+    _encode_fields(payload, out)
+    return bytes(out)
+
+
+def encode_image(application_headers: Dict[str, Any], img_content: bytes) -> bytes:
+    out = bytearray(_ENVELOPE.pack(MAGIC, VERSION, _CONTENT_TYPES.index(CONTENT_TYPE_JPEG)))
+    _encode_fields(application_headers, out)
+    out += img_content
+    return bytes(out)
+
+
+def encode_batch(messages: List[bytes]) -> bytes:
+    out = bytearray(_ENVELOPE.pack(MAGIC, VERSION, _CONTENT_TYPES.index(CONTENT_TYPE_BATCH)))
+    _encode_fields({'count': len(messages)}, out)
+    for message in messages:
+        out += _LENGTH.pack(len(message))
+        out += message
+    return bytes(out)
+
+
+def is_binary(message: bytes) -> bool:
+    return message[:len(MAGIC)] == MAGIC
+
+
+def decode(message: bytes) -> Dict[str, Any]:
+    """
+    Decode a binary message into the same structure as a JSON message: `content_type`, `application_headers`
+    and `payload`, the record fields, the raw JPEG bytes or the list of decoded messages of a batch.
+    """
+    data = memoryview(message)
+    magic, version, content_type = _ENVELOPE.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError('Not a binary telemetry message')
+    if version != VERSION:
+        raise ValueError('Unsupported binary telemetry version {}'.format(version))
+    content_type = _CONTENT_TYPES[content_type]
+    application_headers, offset = _decode_fields(data, _ENVELOPE.size)
+    if content_type == CONTENT_TYPE_JSON:
+        payload, _ = _decode_fields(data, offset)
+    elif content_type == CONTENT_TYPE_BATCH:
+        payload = []
+        for _ in range(application_headers['count']):
+            length, = _LENGTH.unpack_from(data, offset)
+            offset += _LENGTH.size
+            payload.append(decode(data[offset:offset + length]))
+            offset += length
+    else:
+        payload = bytes(data[offset:])
+    return {'content_type': content_type,
+            'application_headers': application_headers,
+            'payload': payload}